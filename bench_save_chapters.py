@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сохранения списка глав: старый построчный путь save_chapters_to_db
+против пакетного database.upsert_chapters.
+
+Синтетическая манга на N глав (по умолчанию 5000), три сценария:
+  1. первичная загрузка в пустую таблицу
+  2. повторная синхронизация без изменений
+  3. повторная синхронизация: 1 новая глава + 10 перенумерованных
+
+Запуск:
+  python bench_save_chapters.py                # SQLite во временном файле
+  python bench_save_chapters.py --chapters 20000
+  python bench_save_chapters.py --pg           # текущая БД из DATABASE_URL
+                                               # (тестовые строки удаляются)
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+
+import database
+from database import get_db, upsert_chapters
+
+BENCH_MANGA_ID = 'bench-manga-chapters'
+
+
+def make_chapters(n, manga_id=BENCH_MANGA_ID):
+    return [{
+        'chapter_id': f'{manga_id}-{i}',
+        'chapter_slug': f'chapter-{i}',
+        'chapter_number': str(i),
+        'chapter_volume': str(i // 50 + 1),
+        'chapter_name': None,
+        'created_at': None,
+        'manga_id': manga_id,
+        'manga_slug': 'bench-manga',
+    } for i in range(n, 0, -1)]
+
+
+def resync_chapters(n):
+    """Тот же список: одна новая глава сверху и 10 перенумерованных."""
+    chapters = make_chapters(n)
+    for ch in chapters[100:110]:
+        ch['chapter_number'] += '.5'
+    new = make_chapters(n + 1)[0]
+    return [new] + chapters
+
+
+def legacy_save(conn, chapters, manga_id):
+    """Старая реализация: SELECT на каждую главу, INSERT/UPDATE построчно."""
+    c = conn.cursor()
+    for i, chapter in enumerate(chapters):
+        c.execute('SELECT chapter_id, chapter_number FROM chapters WHERE chapter_id = ?',
+                  (chapter['chapter_id'],))
+        existing = c.fetchone()
+        if not existing:
+            chapter_url = f"/read/{chapter['manga_slug']}/{chapter['chapter_slug']}"
+            c.execute('''INSERT INTO chapters
+                        (manga_id, chapter_id, chapter_slug, chapter_number,
+                         chapter_volume, chapter_name, chapter_url, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (manga_id, chapter['chapter_id'], chapter['chapter_slug'],
+                       chapter['chapter_number'], chapter['chapter_volume'],
+                       chapter['chapter_name'], chapter_url, chapter['created_at']))
+        elif existing['chapter_number'] != chapter['chapter_number']:
+            c.execute('UPDATE chapters SET chapter_number = ? WHERE chapter_id = ?',
+                      (chapter['chapter_number'], chapter['chapter_id']))
+        if (i + 1) % 50 == 0:
+            conn.commit()
+    conn.commit()
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chapters_manga_number ON chapters(manga_id, chapter_number)')
+    conn.commit()
+
+
+def bulk_save(conn, chapters, manga_id):
+    upsert_chapters(conn, manga_id, chapters)
+
+
+def prepare(conn):
+    # chapters.manga_id ссылается на manga — в PostgreSQL внешний ключ проверяется
+    conn.execute('INSERT OR IGNORE INTO manga (manga_id, manga_slug, manga_title) VALUES (?, ?, ?)',
+                 (BENCH_MANGA_ID, 'bench-manga', 'Bench'))
+    cleanup(conn)
+
+
+def cleanup(conn, drop_manga=False):
+    conn.execute('DELETE FROM chapters WHERE manga_id = ?', (BENCH_MANGA_ID,))
+    if drop_manga:
+        conn.execute('DELETE FROM manga WHERE manga_id = ?', (BENCH_MANGA_ID,))
+    conn.commit()
+
+
+def run(connect, n):
+    """connect — фабрика соединений (get_db)."""
+    scenarios = [
+        ('первичная загрузка', lambda: make_chapters(n), False),
+        ('без изменений', lambda: make_chapters(n), True),
+        ('1 новая + 10 изменённых', lambda: resync_chapters(n), True),
+    ]
+    print(f"{'сценарий':<26} {'старый путь':>12} {'пакетный':>12} {'ускорение':>10}")
+    for title, build, preload in scenarios:
+        timings = []
+        for save in (legacy_save, bulk_save):
+            conn = connect()
+            try:
+                prepare(conn)
+                if preload:
+                    upsert_chapters(conn, BENCH_MANGA_ID, make_chapters(n))
+                chapters = build()
+                started = time.perf_counter()
+                save(conn, chapters, BENCH_MANGA_ID)
+                timings.append(time.perf_counter() - started)
+                cleanup(conn)
+            finally:
+                conn.close()
+        old, new = timings
+        print(f"{title:<26} {old:>11.3f}s {new:>11.3f}s {old / new if new else 0:>9.1f}x")
+    conn = connect()
+    try:
+        cleanup(conn, drop_manga=True)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк сохранения глав')
+    parser.add_argument('--chapters', type=int, default=5000, help='глав в синтетической манге')
+    parser.add_argument('--pg', action='store_true', help='PostgreSQL из DATABASE_URL')
+    args = parser.parse_args()
+
+    if args.pg:
+        if not database._USE_PG:
+            print('❌ DATABASE_URL не задан или psycopg2 не установлен')
+            sys.exit(1)
+        print(f'PostgreSQL, {args.chapters} глав')
+        run(get_db, args.chapters)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # init_db / get_db работают с manga.db в текущем каталоге
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            database._USE_PG = False
+            database.init_db()
+            print(f'SQLite {sqlite3.sqlite_version}, {args.chapters} глав')
+            run(get_db, args.chapters)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
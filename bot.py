@@ -36,6 +36,7 @@ from telegram.ext import (
 )
 
 from database import get_db
+import leaderboard
 
 logger = logging.getLogger(__name__)
 
@@ -270,6 +271,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         (referrer['id'], 'referral', str(user['id']), 100),
                     )
                     ref_conn.commit()
+                    leaderboard.add_xp(referrer['id'], 100)
             ref_conn.close()
         except Exception as _re:
             logger.warning(f"Referral processing error: {_re}")
@@ -0,0 +1,114 @@
+"""
+catalog_cache.py — кеш результатов каталога по нормализованному набору фильтров.
+
+/api/catalog на каждую прокрутку заново считал COUNT(*) и страницу для любой
+комбинации фильтров, хотя почти весь трафик приходится на несколько популярных
+комбинаций. Теперь:
+
+  - ключ — нормализованный кортеж (тип, статус, отсортированные жанры,
+    сортировка, offset, limit): ?genres=A,B и ?genres=B,A дают одну запись
+  - в кеше только (список manga_id, total) на TTL секунд; карточки
+    подтягиваются отдельно по id
+  - теги: у записи есть версия тега 'all' и тега её типа ('type:MANHWA' или
+    'type:*'); invalidate() меняет версию — старые записи больше не находятся
+    и просто истекают
+  - защита от лавины: промах ставит блокировку cache.add(ключ:lock)
+    (атомарный SET NX в Redis); остальные запросы с тем же ключом ждут
+    готовое значение до WAIT секунд, а не считают его параллельно
+
+Хранилище — Flask-Caching из main (Redis, если доступен, иначе SimpleCache),
+передаётся через configure().
+"""
+
+import time
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+TTL = 60
+# Сколько держится блокировка пересчёта и сколько ждут её снятия остальные
+LOCK_TTL = 10
+WAIT = 2.0
+_POLL = 0.05
+
+_PREFIX = 'catalog:'
+_cache = None
+_stats = {'hits': 0, 'misses': 0, 'waits': 0, 'invalidations': 0}
+
+
+def configure(cache):
+    global _cache
+    _cache = cache
+
+
+def normalize(manga_type, manga_status, genres, sort, offset, limit):
+    """Кортеж-ключ: одинаковые по смыслу запросы дают одинаковый ключ."""
+    return (manga_type or '', manga_status or '',
+            tuple(sorted({g for g in genres if g})), sort, int(offset), int(limit))
+
+
+def _tags(key):
+    return ('all', f'type:{key[0] or "*"}')
+
+
+def _versions(tags):
+    keys = [f'{_PREFIX}tag:{t}' for t in tags]
+    return tuple(v or 0 for v in _cache.get_many(*keys))
+
+
+def _entry_key(key):
+    versions = _versions(_tags(key))
+    digest = hashlib.md5(repr((key, versions)).encode()).hexdigest()
+    return f'{_PREFIX}ids:{digest}'
+
+
+def get_ids(key, compute):
+    """(ids, total) из кеша или из compute(); compute считается один раз на ключ."""
+    if _cache is None:
+        return compute()
+    entry = _entry_key(key)
+    value = _cache.get(entry)
+    if value is not None:
+        _stats['hits'] += 1
+        return value
+
+    lock = f'{entry}:lock'
+    owner = _cache.add(lock, 1, timeout=LOCK_TTL)
+    if not owner:
+        # Ту же страницу уже считает другой запрос — ждём его результат
+        _stats['waits'] += 1
+        deadline = time.monotonic() + WAIT
+        while time.monotonic() < deadline:
+            time.sleep(_POLL)
+            value = _cache.get(entry)
+            if value is not None:
+                _stats['hits'] += 1
+                return value
+    _stats['misses'] += 1
+    try:
+        value = compute()
+        _cache.set(entry, value, timeout=TTL)
+    finally:
+        if owner:
+            _cache.delete(lock)
+    return value
+
+
+def invalidate(manga_type=None):
+    """Сбросить страницы, которые могла изменить запись манги.
+
+    Тип известен — сбрасываются страницы этого типа и без фильтра по типу;
+    иначе — все страницы каталога.
+    """
+    if _cache is None:
+        return
+    tags = (f'type:{manga_type}', 'type:*') if manga_type else ('all',)
+    version = time.time_ns()
+    for tag in tags:
+        _cache.set(f'{_PREFIX}tag:{tag}', version, timeout=0)
+    _stats['invalidations'] += 1
+
+
+def status():
+    return dict(_stats, ttl=TTL)
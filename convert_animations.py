@@ -1,76 +1,212 @@
 #!/usr/bin/env python3
-"""Pre-converts all animated GIF/WebP in static/uploads to WebM."""
+"""
+Pre-converts animated GIF/WebP in static/ to WebM (side-by-side `<file>.webm`).
+
+Runs ffmpeg conversions on a process pool, skips files whose output is up
+to date (mtime/size or content-hash manifest) and can be interrupted and
+re-run at any time — finished files are recorded in the manifest as they
+complete.
+
+Usage examples:
+    python convert_animations.py
+    python convert_animations.py --workers 4 --dirs static/uploads static/frame
+    python convert_animations.py --hash          # compare by sha1 instead of mtime
+    python convert_animations.py --force         # re-encode everything
+"""
+import argparse
+import hashlib
+import json
 import os
 import sys
-import subprocess
-import tempfile
-
-BASE = os.path.dirname(__file__)
-UPLOADS = os.path.join(BASE, 'static', 'uploads')
-
-def webp_to_tmp_gif(webp_path):
-    from PIL import Image, ImageSequence
-    img = Image.open(webp_path)
-    frames, durations = [], []
-    for frame in ImageSequence.Iterator(img):
-        rgba = frame.convert('RGBA')
-        frames.append(rgba.convert('P', palette=Image.ADAPTIVE, colors=256))
-        durations.append(frame.info.get('duration', 50))
-    tmp = tempfile.NamedTemporaryFile(suffix='.gif', delete=False)
-    frames[0].save(tmp.name, save_all=True, append_images=frames[1:],
-                   loop=0, duration=durations, optimize=False)
-    tmp.close()
-    return tmp.name
-
-def to_webm(src, dst):
-    ext = src.rsplit('.', 1)[-1].lower()
-    tmp_gif = None
-    ffmpeg_input = src
-
-    if ext == 'webp':
-        print('  (webp→gif intermediate)', end=' ', flush=True)
-        tmp_gif = webp_to_tmp_gif(src)
-        ffmpeg_input = tmp_gif
-
-    cmd = [
-        'ffmpeg', '-y', '-i', ffmpeg_input,
-        '-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '35',
-        '-cpu-used', '5', '-deadline', 'realtime',
-        '-auto-alt-ref', '0', '-an', dst
-    ]
-    result = subprocess.run(cmd, capture_output=True, timeout=300)
-    if tmp_gif:
-        try: os.unlink(tmp_gif)
-        except OSError: pass
-    return result.returncode == 0, result.stderr.decode()[-200:] if result.returncode != 0 else ''
-
-converted = 0
-skipped = 0
-failed = 0
-
-for root, dirs, files in os.walk(UPLOADS):
-    for fname in files:
-        ext = fname.rsplit('.', 1)[-1].lower() if '.' in fname else ''
-        if ext not in ('gif', 'webp'):
-            continue
-        src = os.path.join(root, fname)
-        dst = src + '.webm'
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import media
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DIRS = [
+    os.path.join(BASE, 'static', d)
+    for d in ('avatar', 'frame', 'banner', 'wallpaper', 'uploads')
+]
+DEFAULT_MANIFEST = os.path.join(BASE, 'static', 'cache', 'convert_manifest.json')
+ANIM_EXTS = ('gif', 'webp')
+
+# Сохраняем манифест не реже, чем раз в N готовых файлов
+MANIFEST_FLUSH_EVERY = 10
+
+
+# ── Manifest ─────────────────────────────────────────────────────────────────
+
+def load_manifest(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=0, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def file_sha1(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def src_signature(path, use_hash):
+    st = os.stat(path)
+    sig = {'mtime': int(st.st_mtime), 'size': st.st_size}
+    if use_hash:
+        sig['sha1'] = file_sha1(path)
+    return sig
+
+
+def is_up_to_date(entry, sig, src, dst):
+    """Выход актуален, если манифест совпадает с исходником и WebM на месте.
+    Без записи в манифесте (первый запуск) сравниваем mtime исходника и WebM.
+    С --hash (в sig есть sha1) и известным хешем сравнивается только содержимое:
+    touch без изменений не вызывает повторную конвертацию."""
+    if not entry:
+        return os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)
+    if entry.get('status') != 'static' and not os.path.exists(dst):
+        return False
+    if 'sha1' in sig and 'sha1' in entry:
+        return entry['sha1'] == sig['sha1']
+    return all(entry.get(k) == v for k, v in sig.items() if k != 'sha1')
+
+
+# ── Worker (выполняется в отдельном процессе) ────────────────────────────────
 
-        if os.path.exists(dst):
+def convert_one(src, dst):
+    """Returns (status, src_bytes, dst_bytes, err). status: ok | static | failed."""
+    from PIL import Image
+
+    src_size = os.path.getsize(src)
+    try:
+        with Image.open(src) as img:
+            animated = getattr(img, 'is_animated', False)
+    except Exception as e:
+        return 'failed', src_size, 0, str(e)
+    if not animated:
+        return 'static', src_size, 0, ''
+    try:
+        ok, err = media.to_webm(src, dst, timeout=300)
+    except Exception as e:
+        ok, err = False, str(e)
+    if not ok:
+        return 'failed', src_size, 0, err
+    return 'ok', src_size, os.path.getsize(dst), ''
+
+
+# ── Main ─────────────────────────────────────────────────────────────────────
+
+def collect_sources(dirs):
+    for d in dirs:
+        for root, _dirs, files in os.walk(d):
+            for fname in sorted(files):
+                ext = fname.rsplit('.', 1)[-1].lower() if '.' in fname else ''
+                if ext in ANIM_EXTS:
+                    yield os.path.join(root, fname)
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Convert animated GIF/WebP under static/ to WebM')
+    p.add_argument('--dirs', nargs='+', default=DEFAULT_DIRS,
+                   help='Directories to scan (default: avatar, frame, banner, wallpaper, uploads)')
+    p.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                   help='Parallel ffmpeg processes (default: CPU count)')
+    p.add_argument('--manifest', default=DEFAULT_MANIFEST,
+                   help='Path to the incremental manifest (JSON)')
+    p.add_argument('--hash', action='store_true',
+                   help='Detect changes by sha1 of the source instead of mtime/size')
+    p.add_argument('--force', action='store_true',
+                   help='Re-encode files even if the output is up to date')
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    manifest = load_manifest(args.manifest)
+
+    todo = []
+    skipped = 0
+    for src in collect_sources(args.dirs):
+        rel = os.path.relpath(src, BASE)
+        dst = src + '.webm'
+        sig = src_signature(src, args.hash)
+        if not args.force and is_up_to_date(manifest.get(rel), sig, src, dst):
+            # Освежаем mtime/size (и дописываем sha1) — статус сохраняется
+            manifest[rel] = dict(manifest.get(rel) or {'status': 'ok'}, **sig)
             skipped += 1
             continue
+        todo.append((rel, src, dst, sig))
 
-        rel = os.path.relpath(src, BASE)
-        print(f'Converting {rel}', end=' ... ', flush=True)
-        ok, err = to_webm(src, dst)
-        if ok:
-            orig = os.path.getsize(src)
-            new = os.path.getsize(dst)
-            pct = new * 100 // orig if orig else 0
-            print(f'OK  {orig//1024}KB → {new//1024}KB ({pct}%)')
-            converted += 1
-        else:
-            print(f'FAILED: {err}')
-            failed += 1
-
-print(f'\nДone: {converted} converted, {skipped} skipped, {failed} failed.')
+    total = len(todo)
+    total_bytes = sum(sig['size'] for *_, sig in todo)
+    print(f'{total} files to convert ({total_bytes // (1 << 20)} MB), '
+          f'{skipped} up to date, {args.workers} workers')
+
+    converted = static = failed = 0
+    done_bytes = 0
+    start = time.time()
+    since_flush = 0
+
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+            futures = {pool.submit(convert_one, src, dst): (rel, sig) for rel, src, dst, sig in todo}
+            try:
+                for idx, fut in enumerate(as_completed(futures), 1):
+                    rel, sig = futures[fut]
+                    try:
+                        status, src_b, dst_b, err = fut.result()
+                    except Exception as e:
+                        status, src_b, dst_b, err = 'failed', sig['size'], 0, str(e)
+                    done_bytes += src_b
+
+                    elapsed = max(time.time() - start, 1e-6)
+                    rate = done_bytes / elapsed
+                    eta = (total_bytes - done_bytes) / rate if rate else 0
+                    prefix = f'[{idx}/{total}] {rel}'
+                    if status == 'ok':
+                        converted += 1
+                        pct = dst_b * 100 // src_b if src_b else 0
+                        print(f'{prefix} OK  {src_b // 1024}KB → {dst_b // 1024}KB ({pct}%)'
+                              f'  {rate / (1 << 20):.1f} MB/s, ETA {eta:.0f}s')
+                    elif status == 'static':
+                        static += 1
+                        print(f'{prefix} not animated, skipped')
+                    else:
+                        failed += 1
+                        print(f'{prefix} FAILED: {err[-200:]}')
+                        continue  # не записываем — повторим при следующем запуске
+
+                    manifest[rel] = dict(sig, status=status)
+                    since_flush += 1
+                    if since_flush >= MANIFEST_FLUSH_EVERY:
+                        save_manifest(args.manifest, manifest)
+                        since_flush = 0
+            except KeyboardInterrupt:
+                # Иначе __exit__ пула (shutdown(wait=True)) дождался бы всей очереди
+                pool.shutdown(wait=False, cancel_futures=True)
+                print('\nInterrupted — progress saved, re-run to resume.')
+    finally:
+        save_manifest(args.manifest, manifest)
+
+    elapsed = time.time() - start
+    print(f'\nDone: {converted} converted, {static} not animated, {skipped} up to date, '
+          f'{failed} failed in {elapsed:.1f}s '
+          f'({total / elapsed if elapsed else 0:.1f} files/s, '
+          f'{done_bytes / (1 << 20) / elapsed if elapsed else 0:.1f} MB/s).')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,10 @@ database.py — слой доступа к данным для BubbleManga.
   - init_db()       — создание схемы SQLite
   - init_pg_schema() — PostgreSQL-специфичные триггеры / таблицы
   - get_db()        — возвращает соединение нужного типа
+  - reconcile_user_counters() — сверка счётчиков user_counters с исходными таблицами
+  - seed_chapter_watermarks() — начальное заполнение chapter_watermarks
+  - seed_search_query_stats() — начальное заполнение search_query_stats из истории
+  - bulk_upsert() / upsert_chapters() — пакетная запись (executemany / execute_values)
 """
 
 import os
@@ -21,6 +25,14 @@ logger = logging.getLogger(__name__)
 
 _USE_PG = bool(_DATABASE_URL)
 
+# Денормализованные счётчики: (таблица, колонка пользователя, колонка user_counters)
+USER_COUNTERS = [
+    ('subscriptions',   'user_id',   'subscriptions_count'),
+    ('comments',        'user_id',   'comments_count'),
+    ('collections',     'user_id',   'collections_count'),
+    ('curator_follows', 'author_id', 'followers_count'),
+]
+
 
 def _to_dt(val):
     """Приводит datetime-объект или ISO-строку к naive UTC datetime."""
@@ -204,9 +216,17 @@ class _CompatConn:
         c.execute(sql, params)
         return c
 
+    def executemany(self, sql, seq):
+        c = self.cursor()
+        c.executemany(sql, seq)
+        return c
+
     def commit(self):
         self._conn.commit()
 
+    def rollback(self):
+        self._conn.rollback()
+
     def close(self):
         self._conn.close()
 
@@ -299,6 +319,7 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (manga_id) REFERENCES manga(manga_id)
     )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chapters_manga_number ON chapters(manga_id, chapter_number)')
 
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -587,8 +608,31 @@ def init_db():
     c.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_manga ON subscriptions(manga_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_search_user ON search_history(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_search_history_created ON search_history(created_at)')
+    # Популярность запросов (search_stats): одна строка на нормализованный запрос
+    c.execute('''CREATE TABLE IF NOT EXISTS search_query_stats (
+        query_norm TEXT PRIMARY KEY,
+        query TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        last_seen TIMESTAMP
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_search_query_stats_count ON search_query_stats(count DESC)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_user_stats ON user_stats(xp DESC)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_xp_log ON xp_log(user_id, ref_id)')
+    # Антиспам-проверка (user_id, ref_id, reason, created_at) целиком по индексу;
+    # старый idx_xp_log(user_id, ref_id) — его префикс
+    c.execute('DROP INDEX IF EXISTS idx_xp_log')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_xp_log_dedup ON xp_log(user_id, ref_id, reason, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_xp_log_created ON xp_log(created_at)')
+    # Дневные агрегаты свёрнутого xp_log (см. xp_ledger.compact)
+    c.execute('''CREATE TABLE IF NOT EXISTS xp_log_daily (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        reason TEXT NOT NULL,
+        amount INTEGER NOT NULL DEFAULT 0,
+        entries INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day, reason)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_xp_log_daily_day ON xp_log_daily(day)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_chapters_read_user_manga ON chapters_read(user_id, manga_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_collections_user ON collections(user_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_collection_items ON collection_items(collection_id)')
@@ -596,6 +640,24 @@ def init_db():
     c.execute('CREATE INDEX IF NOT EXISTS idx_collection_likes_user ON collection_likes(user_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_notification_queue_user ON notification_queue(user_id)')
 
+    # Последняя глава каждой манги, о которой уже разосланы уведомления
+    # (check_new_chapters сравнивает ленту с этой таблицей, а не с памятью процесса)
+    c.execute('''CREATE TABLE IF NOT EXISTS chapter_watermarks (
+        manga_id TEXT PRIMARY KEY,
+        chapter_id TEXT NOT NULL,
+        chapter_number TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Расписание краулера подписок (update_crawler)
+    c.execute('''CREATE TABLE IF NOT EXISTS crawl_state (
+        manga_id TEXT PRIMARY KEY,
+        next_check_at TIMESTAMP,
+        last_checked_at TIMESTAMP,
+        interval_seconds INTEGER
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_crawl_state_next ON crawl_state(next_check_at)')
+
     c.execute('''CREATE TABLE IF NOT EXISTS comments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         manga_slug TEXT NOT NULL,
@@ -869,6 +931,12 @@ def init_db():
         except Exception:
             pass
 
+    # Частичные индексы для sweeper.sweep_expired — в них только строки со сроком
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_users_premium_expires ON users(premium_expires_at)
+                 WHERE premium_expires_at IS NOT NULL''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_user_items_expires ON user_items(expires_at)
+                 WHERE expires_at IS NOT NULL''')
+
     c.execute('''CREATE TABLE IF NOT EXISTS premium_gifts (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         sender_id INTEGER NOT NULL,
@@ -894,6 +962,30 @@ def init_db():
     c.execute('CREATE INDEX IF NOT EXISTS idx_curator_follows ON curator_follows(author_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_curator_follows_follower ON curator_follows(follower_id)')
 
+    # ── Счётчики пользователя (поддерживаются триггерами) ─────────────────
+    c.execute('''CREATE TABLE IF NOT EXISTS user_counters (
+        user_id INTEGER PRIMARY KEY,
+        subscriptions_count INTEGER NOT NULL DEFAULT 0,
+        comments_count INTEGER NOT NULL DEFAULT 0,
+        collections_count INTEGER NOT NULL DEFAULT 0,
+        followers_count INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+    for table, user_col, counter in USER_COUNTERS:
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_counter_ins
+                      AFTER INSERT ON {table}
+                      BEGIN
+                          INSERT OR IGNORE INTO user_counters (user_id) VALUES (NEW.{user_col});
+                          UPDATE user_counters SET {counter} = {counter} + 1
+                          WHERE user_id = NEW.{user_col};
+                      END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_counter_del
+                      AFTER DELETE ON {table}
+                      BEGIN
+                          UPDATE user_counters SET {counter} = MAX({counter} - 1, 0)
+                          WHERE user_id = OLD.{user_col};
+                      END''')
+
     c.execute('''CREATE TABLE IF NOT EXISTS manga_user_ratings (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
@@ -906,16 +998,22 @@ def init_db():
     )''')
     c.execute('CREATE INDEX IF NOT EXISTS idx_manga_user_ratings_manga ON manga_user_ratings(manga_id)')
 
-    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS manga_fts
-                 USING fts5(manga_id UNINDEXED, manga_title, original_name, description,
-                            tokenize="unicode61 remove_diacritics 1")''')
-    row = conn.execute('SELECT COUNT(*) FROM manga_fts').fetchone()
-    if row[0] == 0:
-        c.execute('''INSERT INTO manga_fts(manga_id, manga_title, original_name, description)
-                     SELECT manga_id, manga_title, COALESCE(original_name,''), COALESCE(description,'')
-                     FROM manga''')
-
     conn.commit()
+
+    # manga_fts и триггеры синхронизации с manga
+    import search_engine
+    search_engine.ensure_schema(conn)
+
+    # Первый запуск после появления user_counters — заполняем из исходных таблиц
+    if conn.execute('SELECT COUNT(*) FROM user_counters').fetchone()[0] == 0:
+        reconcile_user_counters(conn)
+    # Первый запуск после появления chapter_watermarks — берём известные главы из manga
+    if conn.execute('SELECT COUNT(*) FROM chapter_watermarks').fetchone()[0] == 0:
+        seed_chapter_watermarks(conn)
+    # ... и после появления search_query_stats — сворачиваем накопленную search_history
+    if conn.execute('SELECT COUNT(*) FROM search_query_stats').fetchone()[0] == 0:
+        seed_search_query_stats(conn)
+
     conn.close()
     print("✅ База данных инициализирована")
 
@@ -923,30 +1021,15 @@ def init_db():
 # ==================== БАЗА ДАННЫХ: init_pg_schema ====================
 
 def init_pg_schema():
-    """Проверяет/создаёт триггер обновления search_vector в PostgreSQL."""
+    """Проверяет/создаёт PostgreSQL-специфичные триггеры, индексы и таблицы."""
     conn = get_db()
     try:
-        conn.execute(
-            "CREATE OR REPLACE FUNCTION manga_search_vector_update() "
-            "RETURNS trigger AS $func$ "
-            "BEGIN "
-            "  NEW.search_vector := to_tsvector('simple', "
-            "    COALESCE(NEW.manga_title,'') || ' ' || "
-            "    COALESCE(NEW.original_name,'') || ' ' || "
-            "    COALESCE(NEW.description,'')); "
-            "  RETURN NEW; "
-            "END; "
-            "$func$ LANGUAGE plpgsql"
-        )
-        conn.execute("DROP TRIGGER IF EXISTS manga_search_vector_trig ON manga")
-        conn.execute(
-            "CREATE TRIGGER manga_search_vector_trig "
-            "BEFORE INSERT OR UPDATE ON manga "
-            "FOR EACH ROW EXECUTE FUNCTION manga_search_vector_update()"
-        )
-        conn.commit()
-        print("✅ PostgreSQL: триггер search_vector установлен")
+        # Триггер search_vector и триграммный индекс
+        import search_engine
+        search_engine.ensure_schema(conn)
+        print("✅ PostgreSQL: поисковые индексы и триггер search_vector установлены")
     except Exception as e:
+        conn.rollback()
         logger.warning(f"init_pg_schema: {e}")
 
     try:
@@ -965,5 +1048,255 @@ def init_pg_schema():
         print("✅ PostgreSQL: таблица manga_user_ratings готова")
     except Exception as e:
         logger.warning(f"init_pg_schema manga_user_ratings: {e}")
+
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS user_counters (
+            user_id INTEGER PRIMARY KEY REFERENCES users(id),
+            subscriptions_count INTEGER NOT NULL DEFAULT 0,
+            comments_count INTEGER NOT NULL DEFAULT 0,
+            collections_count INTEGER NOT NULL DEFAULT 0,
+            followers_count INTEGER NOT NULL DEFAULT 0
+        )''')
+        # Одна функция на все таблицы: TG_ARGV[0] — счётчик, TG_ARGV[1] — колонка пользователя
+        conn.execute(
+            "CREATE OR REPLACE FUNCTION user_counter_update() "
+            "RETURNS trigger AS $func$ "
+            "DECLARE uid INTEGER; col TEXT := quote_ident(TG_ARGV[0]); "
+            "BEGIN "
+            "  IF TG_OP = 'INSERT' THEN "
+            "    uid := (to_jsonb(NEW) ->> TG_ARGV[1])::INTEGER; "
+            "    EXECUTE 'INSERT INTO user_counters (user_id, ' || col || ') VALUES ($1, 1) "
+            "             ON CONFLICT (user_id) DO UPDATE "
+            "             SET ' || col || ' = user_counters.' || col || ' + 1' USING uid; "
+            "    RETURN NEW; "
+            "  END IF; "
+            "  uid := (to_jsonb(OLD) ->> TG_ARGV[1])::INTEGER; "
+            "  EXECUTE 'UPDATE user_counters SET ' || col || ' = GREATEST(' || col || ' - 1, 0) "
+            "           WHERE user_id = $1' USING uid; "
+            "  RETURN OLD; "
+            "END; "
+            "$func$ LANGUAGE plpgsql"
+        )
+        for table, user_col, counter in USER_COUNTERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_{table}_counter ON {table}")
+            conn.execute(
+                f"CREATE TRIGGER trg_{table}_counter "
+                f"AFTER INSERT OR DELETE ON {table} "
+                f"FOR EACH ROW EXECUTE FUNCTION user_counter_update('{counter}', '{user_col}')"
+            )
+        conn.commit()
+        if conn.execute('SELECT COUNT(*) AS cnt FROM user_counters').fetchone()['cnt'] == 0:
+            reconcile_user_counters(conn)
+        print("✅ PostgreSQL: счётчики user_counters готовы")
+    except Exception as e:
+        logger.warning(f"init_pg_schema user_counters: {e}")
+
+    try:
+        conn.execute('DROP INDEX IF EXISTS idx_xp_log')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_xp_log_dedup ON xp_log(user_id, ref_id, reason, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_xp_log_created ON xp_log(created_at)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS xp_log_daily (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            amount INTEGER NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, reason)
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_xp_log_daily_day ON xp_log_daily(day)')
+        conn.commit()
+        print("✅ PostgreSQL: индексы xp_log и xp_log_daily готовы")
+    except Exception as e:
+        logger.warning(f"init_pg_schema xp_log: {e}")
+
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS chapter_watermarks (
+            manga_id TEXT PRIMARY KEY,
+            chapter_id TEXT NOT NULL,
+            chapter_number TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        if conn.execute('SELECT COUNT(*) AS cnt FROM chapter_watermarks').fetchone()['cnt'] == 0:
+            seed_chapter_watermarks(conn)
+        conn.execute('''CREATE TABLE IF NOT EXISTS crawl_state (
+            manga_id TEXT PRIMARY KEY,
+            next_check_at TIMESTAMP,
+            last_checked_at TIMESTAMP,
+            interval_seconds INTEGER
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_crawl_state_next ON crawl_state(next_check_at)')
+        conn.commit()
+    except Exception as e:
+        logger.warning(f"init_pg_schema chapter_watermarks/crawl_state: {e}")
+
+    try:
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_search_history_created ON search_history(created_at)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS search_query_stats (
+            query_norm TEXT PRIMARY KEY,
+            query TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            last_seen TIMESTAMP
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_search_query_stats_count '
+                     'ON search_query_stats(count DESC)')
+        if conn.execute('SELECT COUNT(*) AS cnt FROM search_query_stats').fetchone()['cnt'] == 0:
+            seed_search_query_stats(conn)
+        conn.commit()
+    except Exception as e:
+        logger.warning(f"init_pg_schema search_query_stats: {e}")
+
+    try:
+        # Раньше создавался в save_chapters_to_db при каждом сохранении
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_chapters_manga_number ON chapters(manga_id, chapter_number)')
+        conn.commit()
+    except Exception as e:
+        logger.warning(f"init_pg_schema chapters index: {e}")
+
+    try:
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_users_premium_expires ON users(premium_expires_at)
+                        WHERE premium_expires_at IS NOT NULL''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_user_items_expires ON user_items(expires_at)
+                        WHERE expires_at IS NOT NULL''')
+        conn.commit()
+    except Exception as e:
+        logger.warning(f"init_pg_schema expiry indexes: {e}")
     finally:
         conn.close()
+
+
+# ==================== СЧЁТЧИКИ ПОЛЬЗОВАТЕЛЯ ====================
+
+def reconcile_user_counters(conn=None):
+    """Сверяет user_counters с исходными таблицами и исправляет расхождения.
+
+    Триггеры держат счётчики точными, но после ручных правок БД, миграций или
+    массовых удалений в обход триггеров значения могут разъехаться.
+    Возвращает число исправленных строк.
+    """
+    close = conn is None
+    if conn is None:
+        conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute('INSERT OR IGNORE INTO user_counters (user_id) SELECT id FROM users')
+        fixed = 0
+        for table, user_col, counter in USER_COUNTERS:
+            actual = f'(SELECT COUNT(*) FROM {table} t WHERE t.{user_col} = user_counters.user_id)'
+            c.execute(f'UPDATE user_counters SET {counter} = {actual} WHERE {counter} <> {actual}')
+            fixed += max(c.rowcount, 0)
+        conn.commit()
+        if fixed:
+            logger.info(f"reconcile_user_counters: исправлено {fixed} значений")
+        return fixed
+    finally:
+        if close:
+            conn.close()
+
+
+# ==================== ВОДЯНЫЕ ЗНАКИ НОВЫХ ГЛАВ ====================
+
+def seed_chapter_watermarks(conn):
+    """Заполняет пустую chapter_watermarks последними главами из manga.
+
+    Считаем, что о главах, уже лежащих в БД на момент появления таблицы,
+    уведомления разосланы — иначе первый прогон разослал бы их повторно.
+    """
+    conn.execute('''INSERT INTO chapter_watermarks (manga_id, chapter_id, chapter_number)
+                    SELECT manga_id, last_chapter_id, last_chapter_number FROM manga
+                    WHERE last_chapter_id IS NOT NULL
+                    ON CONFLICT(manga_id) DO NOTHING''')
+    conn.commit()
+
+
+# ==================== СТАТИСТИКА ПОИСКА ====================
+
+def seed_search_query_stats(conn):
+    """Заполняет пустую search_query_stats из накопленной search_history.
+
+    Запросы сворачиваются по тому же ключу, что и search_stats.record().
+    """
+    from search_index import normalize
+
+    stats = {}
+    rows = conn.execute('''SELECT query, COUNT(*) AS cnt, MAX(created_at) AS last_seen
+                           FROM search_history GROUP BY query''').fetchall()
+    for text, cnt, seen in rows:
+        key = normalize(text)
+        if len(key) < 2:
+            continue
+        query, count, last_seen = stats.get(key, (text, 0, None))
+        stats[key] = (query, count + cnt, max(filter(None, (last_seen, seen)),
+                                              default=None, key=str))
+    if stats:
+        conn.executemany('''INSERT INTO search_query_stats (query_norm, query, count, last_seen)
+                            VALUES (?, ?, ?, ?) ON CONFLICT(query_norm) DO NOTHING''',
+                         [(key,) + v for key, v in stats.items()])
+    conn.commit()
+
+
+# ==================== ПАКЕТНАЯ ЗАПИСЬ ====================
+
+def bulk_upsert(conn, table, columns, rows, conflict, update_cols, page_size=1000):
+    """INSERT ... ON CONFLICT (conflict) DO UPDATE пачкой.
+
+    Строки обновляются, только если хотя бы одна из update_cols изменилась —
+    иначе запись не трогается. SQLite — executemany нативного upsert,
+    PostgreSQL — execute_values (одна многострочная команда на page_size строк).
+    """
+    if not rows:
+        return
+    cols = ', '.join(columns)
+    sets = ', '.join(f'{c} = excluded.{c}' for c in update_cols)
+    distinct = 'IS DISTINCT FROM' if _USE_PG else 'IS NOT'
+    changed = ' OR '.join(f'{table}.{c} {distinct} excluded.{c}' for c in update_cols)
+    tail = f'ON CONFLICT ({conflict}) DO UPDATE SET {sets} WHERE {changed}'
+    if _USE_PG:
+        cur = conn._conn.cursor()
+        psycopg2.extras.execute_values(cur, f'INSERT INTO {table} ({cols}) VALUES %s {tail}',
+                                       rows, page_size=page_size)
+    else:
+        ph = ', '.join('?' * len(columns))
+        conn.executemany(f'INSERT INTO {table} ({cols}) VALUES ({ph}) {tail}', rows)
+
+
+_CHAPTER_COLUMNS = ('manga_id', 'chapter_id', 'chapter_slug', 'chapter_number',
+                    'chapter_volume', 'chapter_name', 'chapter_url', 'created_at')
+
+
+def existing_chapters(conn, manga_id):
+    """{chapter_id: chapter_number} уже сохранённых глав манги (один запрос)."""
+    rows = conn.execute('SELECT chapter_id, chapter_number FROM chapters WHERE manga_id = ?',
+                        (manga_id,)).fetchall()
+    return {r['chapter_id']: r['chapter_number'] for r in rows}
+
+
+def upsert_chapters(conn, manga_id, chapters, existing=None, batch_size=1000):
+    """Пакетно сохранить список глав манги (без страниц).
+
+    Разность с existing (загружается одним запросом, если не передан)
+    отсекает главы без изменений; новые и перенумерованные уходят одним
+    upsert'ом, по batch_size строк на транзакцию.
+
+    Returns:
+        tuple: (вставлено, обновлено)
+    """
+    if existing is None:
+        existing = existing_chapters(conn, manga_id)
+    rows, inserted, updated = [], 0, 0
+    for ch in chapters:
+        known = ch['chapter_id'] in existing
+        # В БД номер хранится TEXT — сравниваем строковые представления
+        if known and str(existing[ch['chapter_id']]) == str(ch['chapter_number']):
+            continue
+        if known:
+            updated += 1
+        else:
+            inserted += 1
+        rows.append((manga_id, ch['chapter_id'], ch['chapter_slug'], ch['chapter_number'],
+                     ch['chapter_volume'], ch['chapter_name'],
+                     f"/read/{ch['manga_slug']}/{ch['chapter_slug']}", ch['created_at']))
+    for i in range(0, len(rows), batch_size):
+        bulk_upsert(conn, 'chapters', _CHAPTER_COLUMNS, rows[i:i + batch_size],
+                    'chapter_id', ['chapter_number'])
+        conn.commit()
+    return inserted, updated
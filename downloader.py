@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+downloader.py — параллельная докачиваемая загрузка ассетов (рамки, аватары, обои).
+
+Используется shop_parser.py и scrape_senkuro_frames.py.
+
+Возможности:
+  - ограниченный пул потоков + общий rate limit (запросов в секунду на весь пул)
+  - HTTP keep-alive через общий requests.Session
+  - ревалидация по ETag / Last-Modified (304 → файл не перекачивается)
+  - дедупликация по sha256: одинаковый контент под разными именами → hardlink
+  - атомарная запись (<file>.part → os.replace) и манифест для докачки
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.download_manifest.json'
+
+# Статусы результата загрузки
+DOWNLOADED   = 'downloaded'
+NOT_MODIFIED = 'not_modified'
+DUPLICATE    = 'duplicate'
+SKIPPED      = 'skipped'
+FAILED       = 'failed'
+
+
+class _RateLimiter:
+    """Глобальный лимит: не чаще rate запросов в секунду на все потоки."""
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AssetDownloader:
+    """Пул загрузчиков с манифестом в каталоге назначения.
+
+    Манифест: {filename: {url, etag, last_modified, sha256, size}}.
+    """
+
+    def __init__(self, download_dir, max_workers=8, rate=10.0, headers=None,
+                 timeout=30, revalidate=True):
+        self.download_dir = download_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.revalidate = revalidate
+        self._limiter = _RateLimiter(rate)
+        self._lock = threading.Lock()
+
+        os.makedirs(download_dir, exist_ok=True)
+        self.manifest_path = os.path.join(download_dir, MANIFEST_NAME)
+        self.manifest = self._load_manifest()
+        # sha256 → filename, для дедупликации
+        self._by_hash = {v['sha256']: k for k, v in self.manifest.items() if v.get('sha256')}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+    # ── Манифест ─────────────────────────────────────────────────────────────
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_manifest(self):
+        with self._lock:
+            data = json.dumps(self.manifest, ensure_ascii=False, indent=1, sort_keys=True)
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self.manifest_path)
+
+    # ── Загрузка одного файла ────────────────────────────────────────────────
+
+    def download(self, url, filename):
+        """Скачивает url в download_dir/filename. Возвращает (status, filename, bytes)."""
+        path = os.path.join(self.download_dir, filename)
+        with self._lock:
+            entry = self.manifest.get(filename)
+
+        exists = os.path.exists(path)
+        known = bool(entry) and entry.get('url') == url
+        if exists and not self.revalidate:
+            if not entry:
+                # Файл без записи (процесс упал до save_manifest) — хешируем и принимаем
+                self._adopt(url, filename, path)
+            if not entry or known:
+                return SKIPPED, filename, 0
+        # Нет записи или у имени сменился url — качаем заново без условных заголовков
+
+        headers = {}
+        if known and exists:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        self._limiter.acquire()
+        tmp = f'{path}.part'
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                if r.status_code == 304:
+                    return NOT_MODIFIED, filename, 0
+                r.raise_for_status()
+                h = hashlib.sha256()
+                size = 0
+                with open(tmp, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=64 * 1024):
+                        if chunk:
+                            f.write(chunk)
+                            h.update(chunk)
+                            size += len(chunk)
+                etag = r.headers.get('ETag')
+                last_modified = r.headers.get('Last-Modified')
+        except Exception:
+            _unlink(tmp)
+            raise
+
+        digest = h.hexdigest()
+        status = DOWNLOADED
+        with self._lock:
+            twin = self._by_hash.get(digest)
+            # Связываем только с файлом, чьё содержимое по манифесту всё ещё такое же
+            if twin and (self.manifest.get(twin) or {}).get('sha256') != digest:
+                twin = None
+        twin_path = os.path.join(self.download_dir, twin) if twin and twin != filename else None
+        if twin_path and os.path.exists(twin_path):
+            try:
+                _unlink(path)
+                os.link(twin_path, path)
+                _unlink(tmp)
+                status = DUPLICATE
+            except OSError:
+                os.replace(tmp, path)
+        else:
+            os.replace(tmp, path)
+
+        self._record(filename, {
+            'url': url, 'etag': etag, 'last_modified': last_modified,
+            'sha256': digest, 'size': size,
+        })
+        return status, filename, size
+
+    def _adopt(self, url, filename, path):
+        """Записать в манифест уже лежащий на диске файл."""
+        digest, size = _sha256(path)
+        self._record(filename, {
+            'url': url, 'etag': None, 'last_modified': None,
+            'sha256': digest, 'size': size,
+        })
+
+    def _record(self, filename, entry):
+        """Обновить запись манифеста и индекс sha256 → имя файла.
+
+        Если у имени сменилось содержимое, старый хеш больше не должен указывать
+        на него — иначе следующий файл со старым хешем станет hardlink'ом на новое
+        содержимое.
+        """
+        digest = entry['sha256']
+        with self._lock:
+            old = (self.manifest.get(filename) or {}).get('sha256')
+            self.manifest[filename] = entry
+            if old and old != digest and self._by_hash.get(old) == filename:
+                other = next((k for k, v in self.manifest.items() if v.get('sha256') == old), None)
+                if other:
+                    self._by_hash[old] = other
+                else:
+                    del self._by_hash[old]
+            self._by_hash.setdefault(digest, filename)
+
+    # ── Пакетная загрузка ────────────────────────────────────────────────────
+
+    def download_many(self, jobs, on_result=None, flush_every=20):
+        """Скачивает [(url, filename), ...] в пуле потоков.
+
+        on_result(status, filename, nbytes, error) вызывается по мере готовности.
+        Возвращает dict {status: count}. Манифест сохраняется каждые flush_every файлов,
+        поэтому прерванная загрузка продолжается с места остановки.
+        """
+        counts = {DOWNLOADED: 0, NOT_MODIFIED: 0, DUPLICATE: 0, SKIPPED: 0, FAILED: 0}
+        seen = set()
+        unique_jobs = []
+        for url, filename in jobs:
+            if filename not in seen:
+                seen.add(filename)
+                unique_jobs.append((url, filename))
+
+        started = time.monotonic()
+        total_bytes = 0
+        done = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {pool.submit(self.download, url, fn): fn for url, fn in unique_jobs}
+                for fut in as_completed(futures):
+                    fn = futures[fut]
+                    err = None
+                    try:
+                        status, _, nbytes = fut.result()
+                    except Exception as e:
+                        status, nbytes, err = FAILED, 0, e
+                        logger.warning(f'download failed {fn}: {e}')
+                    counts[status] += 1
+                    total_bytes += nbytes
+                    done += 1
+                    if on_result:
+                        on_result(status, fn, nbytes, err)
+                    if done % flush_every == 0:
+                        self.save_manifest()
+        finally:
+            self.save_manifest()
+
+        elapsed = max(time.monotonic() - started, 1e-6)
+        counts['bytes'] = total_bytes
+        counts['elapsed'] = elapsed
+        logger.info(
+            f'downloaded {counts[DOWNLOADED]} (+{counts[DUPLICATE]} dup), '
+            f'{counts[NOT_MODIFIED]} not modified, {counts[SKIPPED]} skipped, '
+            f'{counts[FAILED]} failed — {total_bytes / (1 << 20) / elapsed:.2f} MB/s'
+        )
+        return counts
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _sha256(path, chunk=1 << 20):
+    h = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+            size += len(block)
+    return h.hexdigest(), size
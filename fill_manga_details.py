@@ -5,33 +5,42 @@
 Находит в БД манги у которых отсутствует описание или жанры,
 запрашивает полные данные через SenkuroAPI.fetch_manga() и обновляет БД.
 
+БД — та же, что у приложения (database.get_db): PostgreSQL при заданном
+DATABASE_URL, иначе manga.db рядом со скриптом.
+
+Запросы к API идут в пуле потоков; результаты пишет в БД отдельный поток
+DBWriter пачками (по числу строк или по времени) — воркеры API никогда не
+ждут БД, а коммит один на пачку, а не на каждую мангу.
+
 Использование:
-    python fill_manga_details.py [--db manga.db] [--delay 0.6] [--limit N]
-                                 [--force] [--slug some-slug] [--workers N]
+    python fill_manga_details.py [--delay 0.6] [--limit N] [--force]
+                                 [--slug some-slug] [--workers N]
+                                 [--commit-every N]
 
 Флаги:
-    --db       путь к manga.db (по умолчанию рядом со скриптом)
     --delay    пауза между запросами к API (сек, по умолчанию 0.6)
     --limit    остановиться после N обновлений (0 = без ограничения)
     --force    обновить ВСЕ манги, даже у которых уже есть данные
     --slug     обновить одну конкретную мангу по slug
     --workers  число параллельных потоков (по умолчанию 1; ≤4 безопасно)
+    --commit-every  коммитить БД каждые N манг (по умолчанию 100)
 """
 
 import argparse
 import json
 import logging
 import os
-import sqlite3
+import queue
 import sys
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, BASE_DIR)
 
 from senkuro_api import SenkuroAPI
+from database import get_db, _USE_PG
 
 # ── Логирование ────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -41,23 +50,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger("fill_manga_details")
 
-DEFAULT_DB    = os.path.join(BASE_DIR, "manga.db")
-DEFAULT_DELAY = 0.6
+DEFAULT_DELAY        = 0.6
+DEFAULT_COMMIT_EVERY = 100   # манг на один коммит
+FLUSH_INTERVAL       = 2.0   # но не реже, чем раз в столько секунд
 
 
 # ── БД ─────────────────────────────────────────────────────────────────────
 
-def open_db(path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA synchronous=NORMAL")
-    conn.execute("PRAGMA busy_timeout=10000")
-    conn.execute("PRAGMA cache_size=-32000")
-    conn.row_factory = sqlite3.Row
-    return conn
-
-
-def get_incomplete(conn: sqlite3.Connection, force: bool) -> list[dict]:
+def get_incomplete(conn, force: bool) -> list[dict]:
     """Вернуть список манг которым нужно дозаполнение."""
     if force:
         sql = "SELECT manga_id, manga_slug, manga_title FROM manga ORDER BY manga_title"
@@ -89,7 +89,8 @@ UPDATE_SQL = """
 """
 
 
-def apply_update(conn: sqlite3.Connection, lock: Lock, slug: str, d: dict) -> None:
+def update_params(slug: str, d: dict) -> tuple:
+    """Параметры UPDATE_SQL для данных манги из API."""
     tags_json = json.dumps(d.get("tags") or [], ensure_ascii=False)
     cover     = d.get("cover_url") or ""
     mtype     = d.get("manga_type") or ""
@@ -101,7 +102,7 @@ def apply_update(conn: sqlite3.Connection, lock: Lock, slug: str, d: dict) -> No
     score     = float(d.get("score") or 0)
     desc      = d.get("description") or ""
 
-    params = (
+    return (
         desc,
         tags_json,
         score,
@@ -114,17 +115,82 @@ def apply_update(conn: sqlite3.Connection, lock: Lock, slug: str, d: dict) -> No
         branch, branch,
         slug,
     )
-    with lock:
-        conn.execute(UPDATE_SQL, params)
-        conn.commit()
+
+
+class DBWriter(threading.Thread):
+    """Единственный поток, который пишет в БД.
+
+    Воркеры кладут параметры в неограниченную очередь и сразу идут за
+    следующей мангой. Писатель копит строки и выполняет их одним
+    executemany + commit, когда набралось commit_every строк или с первой
+    незакоммиченной строки прошло FLUSH_INTERVAL секунд.
+    """
+
+    _STOP = object()
+
+    def __init__(self, commit_every: int = DEFAULT_COMMIT_EVERY):
+        super().__init__(name="db-writer", daemon=True)
+        self.commit_every = max(1, commit_every)
+        self.queue: queue.Queue = queue.Queue()
+        self.written = 0
+        self.errors  = 0
+        self.commits = 0
+
+    def submit(self, params: tuple) -> None:
+        self.queue.put(params)
+
+    def close(self) -> None:
+        """Дописать всё из очереди и остановить поток."""
+        self.queue.put(self._STOP)
+        self.join()
+
+    def _flush(self, conn, pending: list) -> None:
+        try:
+            conn.executemany(UPDATE_SQL, pending)
+            conn.commit()
+            self.written += len(pending)
+            self.commits += 1
+        except Exception as e:
+            self.errors += len(pending)
+            logger.error(f"❌ Ошибка записи пачки ({len(pending)} манг): {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        pending.clear()
+
+    def run(self) -> None:
+        conn = get_db()
+        pending: list = []
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+                if item is self._STOP:
+                    break
+                if item is not None:
+                    pending.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + FLUSH_INTERVAL
+                if pending and (len(pending) >= self.commit_every
+                                or time.monotonic() >= deadline):
+                    self._flush(conn, pending)
+                    deadline = None
+            if pending:
+                self._flush(conn, pending)
+        finally:
+            conn.close()
 
 
 # ── Воркер ─────────────────────────────────────────────────────────────────
 
-def process_one(api: SenkuroAPI, conn: sqlite3.Connection, lock: Lock,
-                manga: dict, delay: float) -> str:
+def process_one(api: SenkuroAPI, writer: DBWriter, manga: dict, delay: float) -> str:
     """
-    Запросить детали одной манги и обновить БД.
+    Запросить детали одной манги и передать обновление писателю БД.
     Возвращает строку-статус для лога.
     """
     slug  = manga["manga_slug"]
@@ -135,7 +201,7 @@ def process_one(api: SenkuroAPI, conn: sqlite3.Connection, lock: Lock,
         if not data:
             return f"⚠️  не найдена в API: {slug}"
 
-        apply_update(conn, lock, slug, data)
+        writer.submit(update_params(slug, data))
 
         tags_count = len(data.get("tags") or [])
         has_desc   = bool((data.get("description") or "").strip())
@@ -157,7 +223,6 @@ def process_one(api: SenkuroAPI, conn: sqlite3.Connection, lock: Lock,
 
 def parse_args():
     p = argparse.ArgumentParser(description="Дозаполнение деталей манг")
-    p.add_argument("--db",      default=DEFAULT_DB,   help="Путь к manga.db")
     p.add_argument("--delay",   default=DEFAULT_DELAY, type=float,
                    help="Пауза между запросами (сек)")
     p.add_argument("--limit",   default=0, type=int,
@@ -168,6 +233,8 @@ def parse_args():
                    help="Обновить одну конкретную мангу по slug")
     p.add_argument("--workers", default=1, type=int,
                    help="Число параллельных потоков (рекомендуется ≤4)")
+    p.add_argument("--commit-every", default=DEFAULT_COMMIT_EVERY, type=int,
+                   help="Коммитить БД каждые N манг")
     return p.parse_args()
 
 
@@ -175,10 +242,12 @@ def parse_args():
 
 def main():
     args = parse_args()
+    # get_db() открывает manga.db относительно рабочего каталога, как приложение
+    os.chdir(BASE_DIR)
 
     logger.info("═" * 65)
     logger.info("🔍 fill_manga_details — дозаполнение описаний и жанров")
-    logger.info(f"   DB:      {args.db}")
+    logger.info(f"   DB:      {'PostgreSQL' if _USE_PG else os.path.join(BASE_DIR, 'manga.db')}")
     logger.info(f"   Задержка: {args.delay}s | Воркеры: {args.workers}")
     logger.info(f"   Режим:   {'FORCE (все манги)' if args.force else 'только пустые'}")
     if args.slug:
@@ -187,8 +256,7 @@ def main():
         logger.info(f"   Лимит:   {args.limit}")
     logger.info("═" * 65)
 
-    conn = open_db(args.db)
-    lock = Lock()
+    conn = get_db()
     api  = SenkuroAPI()
 
     # Список манг для обработки
@@ -204,10 +272,10 @@ def main():
         mangas = [dict(row)]
     else:
         mangas = get_incomplete(conn, args.force)
+    conn.close()
 
     if not mangas:
         logger.info("✅ Все манги уже имеют описания и жанры. Нечего обновлять.")
-        conn.close()
         return
 
     if args.limit:
@@ -219,40 +287,16 @@ def main():
     done    = 0
     errors  = 0
     started = time.time()
+    writer  = DBWriter(args.commit_every)
+    writer.start()
 
-    # Однопоточный режим
-    if args.workers <= 1:
-        for manga in mangas:
-            status = process_one(api, conn, lock, manga, args.delay)
-            done += 1
-            is_err = status.startswith("❌") or status.startswith("⚠️")
-            if is_err:
-                errors += 1
-            logger.info(f"[{done:>5}/{total}] {status}")
-
-            if done % 50 == 0:
-                elapsed = time.time() - started
-                rps = done / elapsed if elapsed > 0 else 0
-                eta = (total - done) / rps if rps > 0 else 0
-                logger.info(
-                    f"📊 Прогресс: {done}/{total} | "
-                    f"ошибок: {errors} | "
-                    f"скорость: {rps:.2f}/с | "
-                    f"осталось: {eta/60:.1f} мин"
-                )
-
-    # Многопоточный режим
-    else:
-        workers = min(args.workers, 4)
-        logger.info(f"🧵 Запуск с {workers} потоками (delay={args.delay}s на поток)")
-
-        with ThreadPoolExecutor(max_workers=workers) as pool:
-            futures = {
-                pool.submit(process_one, api, conn, lock, m, args.delay): m
-                for m in mangas
-            }
-            for fut in as_completed(futures):
-                status = fut.result()
+    # close() и в finally: DBWriter — daemon-поток, при исключении или Ctrl+C
+    # недописанная пачка иначе пропала бы вместе с процессом
+    try:
+        # Однопоточный режим
+        if args.workers <= 1:
+            for manga in mangas:
+                status = process_one(api, writer, manga, args.delay)
                 done += 1
                 is_err = status.startswith("❌") or status.startswith("⚠️")
                 if is_err:
@@ -270,11 +314,41 @@ def main():
                         f"осталось: {eta/60:.1f} мин"
                     )
 
-    conn.close()
+        # Многопоточный режим
+        else:
+            workers = min(args.workers, 4)
+            logger.info(f"🧵 Запуск с {workers} потоками (delay={args.delay}s на поток)")
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(process_one, api, writer, m, args.delay): m
+                    for m in mangas
+                }
+                for fut in as_completed(futures):
+                    status = fut.result()
+                    done += 1
+                    is_err = status.startswith("❌") or status.startswith("⚠️")
+                    if is_err:
+                        errors += 1
+                    logger.info(f"[{done:>5}/{total}] {status}")
+
+                    if done % 50 == 0:
+                        elapsed = time.time() - started
+                        rps = done / elapsed if elapsed > 0 else 0
+                        eta = (total - done) / rps if rps > 0 else 0
+                        logger.info(
+                            f"📊 Прогресс: {done}/{total} | "
+                            f"ошибок: {errors} | "
+                            f"скорость: {rps:.2f}/с | "
+                            f"осталось: {eta/60:.1f} мин"
+                        )
+    finally:
+        writer.close()
+    errors += writer.errors
     elapsed = time.time() - started
     logger.info("═" * 65)
-    logger.info(f"✅ Готово! Обновлено: {done - errors}/{total} | "
-                f"ошибок: {errors} | время: {elapsed:.1f}с")
+    logger.info(f"✅ Готово! Обновлено: {writer.written}/{total} | "
+                f"ошибок: {errors} | коммитов: {writer.commits} | время: {elapsed:.1f}с")
     logger.info("═" * 65)
 
 
@@ -7,7 +7,6 @@ keepalive = 5
 reload = True
 
 def post_fork(server, worker):
-    import threading
     import sys
     sys.path.insert(0, '/var/tgbot/manga')
     from main import run_telegram_bot, background_checker, init_pg_schema, _USE_PG, init_db
@@ -17,7 +16,6 @@ def post_fork(server, worker):
     else:
         init_pg_schema()
 
-    checker_thread = threading.Thread(target=background_checker, daemon=True)
-    checker_thread.start()
+    background_checker()
 
     run_telegram_bot()
@@ -0,0 +1,321 @@
+"""
+leaderboard.py — таблица лидеров, поддерживаемая инкрементально.
+
+Раньше /top считал «моё место» через COUNT(*) WHERE xp > (...) — полный проход
+по user_stats на каждый просмотр, а award_xp сбрасывал кеш топа при каждом
+начислении. Теперь каждое изменение XP обновляет упорядоченную структуру,
+из которой место любого пользователя берётся за O(log n), а топ-N — срезом:
+
+  - Redis sorted set (ZINCRBY / ZCOUNT / ZREVRANGE), если Redis доступен —
+    одна таблица на все воркеры, обновление тоже O(log n)
+  - иначе in-process отсортированный список (bisect): поиск O(log n), но
+    вставка/удаление сдвигают хвост списка — O(n) memmove на обновление,
+    что при десятках тысяч пользователей — микросекунды
+
+Доски:
+  'all'              — весь XP (user_stats.xp)
+  'week:<YYYY>-<WW>' — XP из xp_log за текущую ISO-неделю
+  'season:<id>'      — XP из xp_log (+ свёрнутые дни xp_log_daily) за активный сезон
+
+Источник истины — БД: rebuild() периодически перестраивает доски из
+user_stats / xp_log, подбирая начисления, прошедшие мимо add_xp().
+"""
+
+import time
+import bisect
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+BOARD_ALL = 'all'
+PERIODS = ('all', 'week', 'season')
+
+# Полная пересборка из БД не чаще, чем раз в REBUILD_INTERVAL секунд
+REBUILD_INTERVAL = 600
+# Периодические доски в Redis живут чуть дольше своего периода
+_PERIOD_TTL = 60 * 60 * 24 * 120
+
+_REDIS_PREFIX = 'lb:'
+
+
+class _MemoryBoard:
+    """Отсортированный список (-score, user_id) + словарь user_id → score.
+
+    rank/score — O(log n); set/incr — O(n) из-за сдвига элементов списка.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scores = {}
+        self._sorted = []
+
+    def _remove(self, user_id):
+        old = self._scores.pop(user_id, None)
+        if old is not None:
+            i = bisect.bisect_left(self._sorted, (-old, user_id))
+            if i < len(self._sorted) and self._sorted[i] == (-old, user_id):
+                del self._sorted[i]
+
+    def set(self, user_id, score):
+        with self._lock:
+            self._remove(user_id)
+            self._scores[user_id] = score
+            bisect.insort(self._sorted, (-score, user_id))
+
+    def incr(self, user_id, delta):
+        with self._lock:
+            score = self._scores.get(user_id, 0) + delta
+            self._remove(user_id)
+            self._scores[user_id] = score
+            bisect.insort(self._sorted, (-score, user_id))
+
+    def rank(self, user_id):
+        """1 + число пользователей со строго большим счётом (равные делят место)."""
+        with self._lock:
+            score = self._scores.get(user_id)
+            if score is None:
+                return None
+            return bisect.bisect_left(self._sorted, (-score,)) + 1
+
+    def score(self, user_id):
+        with self._lock:
+            return self._scores.get(user_id)
+
+    def top(self, n):
+        with self._lock:
+            return [(uid, -neg) for neg, uid in self._sorted[:n]]
+
+    def size(self):
+        with self._lock:
+            return len(self._scores)
+
+    def load(self, pairs):
+        scores = {uid: score for uid, score in pairs}
+        ordered = sorted((-score, uid) for uid, score in scores.items())
+        with self._lock:
+            self._scores, self._sorted = scores, ordered
+
+
+class _RedisBoard:
+    """Та же доска поверх Redis sorted set."""
+
+    def __init__(self, client, name, ttl=None):
+        self._r = client
+        self._key = _REDIS_PREFIX + name
+        self._ttl = ttl
+
+    def set(self, user_id, score):
+        self._r.zadd(self._key, {user_id: score})
+
+    def incr(self, user_id, delta):
+        pipe = self._r.pipeline()
+        pipe.zincrby(self._key, delta, user_id)
+        if self._ttl:
+            pipe.expire(self._key, self._ttl)
+        pipe.execute()
+
+    def rank(self, user_id):
+        score = self._r.zscore(self._key, user_id)
+        if score is None:
+            return None
+        return self._r.zcount(self._key, f'({score}', '+inf') + 1
+
+    def score(self, user_id):
+        score = self._r.zscore(self._key, user_id)
+        return None if score is None else int(score)
+
+    def top(self, n):
+        return [(int(uid), int(score))
+                for uid, score in self._r.zrevrange(self._key, 0, n - 1, withscores=True)]
+
+    def size(self):
+        return self._r.zcard(self._key)
+
+    def load(self, pairs):
+        # Собираем во временный ключ и атомарно подменяем — читатели не видят пустую доску
+        tmp = f'{self._key}:tmp'
+        pipe = self._r.pipeline()
+        pipe.delete(tmp)
+        chunk = {}
+        for uid, score in pairs:
+            chunk[uid] = score
+            if len(chunk) >= 1000:
+                pipe.zadd(tmp, chunk)
+                chunk = {}
+        if chunk:
+            pipe.zadd(tmp, chunk)
+        pipe.execute()
+        if self._r.exists(tmp):
+            self._r.rename(tmp, self._key)
+            if self._ttl:
+                self._r.expire(self._key, self._ttl)
+        else:
+            self._r.delete(self._key)
+
+
+_redis = None
+_boards = {}
+_boards_lock = threading.Lock()
+_season = {'id': None, 'starts_at': None, 'checked': 0.0}
+_last_rebuild = 0.0
+_rebuild_lock = threading.Lock()
+
+
+def configure(redis_client):
+    """Использовать Redis sorted sets вместо in-process досок (вызывается из main)."""
+    global _redis
+    with _boards_lock:
+        _redis = redis_client
+        _boards.clear()
+
+
+def week_board(now=None):
+    year, week, _ = (now or datetime.utcnow()).isocalendar()
+    return f'week:{year}-{week:02d}'
+
+
+def _week_start(now=None):
+    now = now or datetime.utcnow()
+    monday = now.date() - timedelta(days=now.weekday())
+    return monday.isoformat()
+
+
+def _active_season(conn=None):
+    """(id, starts_at) активного сезона; проверяется не чаще раза в минуту."""
+    now = time.monotonic()
+    if now - _season['checked'] < 60:
+        return _season['id'], _season['starts_at']
+    close = conn is None
+    if conn is None:
+        conn = get_db()
+    try:
+        row = conn.execute(
+            'SELECT id, starts_at FROM seasons WHERE is_active=1 AND ends_at >= ? ORDER BY id DESC LIMIT 1',
+            (datetime.utcnow().isoformat()[:10],)
+        ).fetchone()
+    finally:
+        if close:
+            conn.close()
+    _season.update(id=row['id'] if row else None,
+                   starts_at=str(row['starts_at']) if row else None, checked=now)
+    return _season['id'], _season['starts_at']
+
+
+def board_name(period):
+    """Имя доски для периода 'all' / 'week' / 'season' (None — сезона нет)."""
+    if period == 'week':
+        return week_board()
+    if period == 'season':
+        season_id, _ = _active_season()
+        return f'season:{season_id}' if season_id else None
+    return BOARD_ALL
+
+
+def _board(name):
+    with _boards_lock:
+        b = _boards.get(name)
+        if b is None:
+            if _redis is not None:
+                b = _RedisBoard(_redis, name, None if name == BOARD_ALL else _PERIOD_TTL)
+            else:
+                b = _MemoryBoard()
+                # Прошлые недели/сезоны больше не нужны
+                for old in [k for k in _boards if k.split(':')[0] == name.split(':')[0]]:
+                    del _boards[old]
+            _boards[name] = b
+        return b
+
+
+def _ensure_built():
+    if not _last_rebuild:
+        rebuild()
+
+
+# ── Обновление ───────────────────────────────────────────────────────────────
+
+def add_xp(user_id, amount, periods=True):
+    """Учесть начисление XP. periods=False — только общая доска (ручная правка админом)."""
+    if not user_id or not amount:
+        return
+    try:
+        _board(BOARD_ALL).incr(user_id, amount)
+        if periods:
+            _board(week_board()).incr(user_id, amount)
+            season = board_name('season')
+            if season:
+                _board(season).incr(user_id, amount)
+    except Exception as e:
+        logger.warning(f"leaderboard.add_xp: {e}")
+
+
+def set_xp(user_id, xp):
+    """Задать общий XP пользователя (после ручной правки)."""
+    try:
+        _board(BOARD_ALL).set(user_id, xp)
+    except Exception as e:
+        logger.warning(f"leaderboard.set_xp: {e}")
+
+
+def rebuild(conn=None, force=False):
+    """Перестроить доски из БД. Без force — не чаще REBUILD_INTERVAL."""
+    global _last_rebuild
+    with _rebuild_lock:
+        if not force and _last_rebuild and time.monotonic() - _last_rebuild < REBUILD_INTERVAL:
+            return
+        close = conn is None
+        if conn is None:
+            conn = get_db()
+        try:
+            rows = conn.execute('SELECT user_id, xp FROM user_stats').fetchall()
+            _board(BOARD_ALL).load((r['user_id'], r['xp']) for r in rows)
+
+            period_sql = ('SELECT user_id, SUM(amount) AS xp FROM xp_log '
+                          'WHERE created_at >= ? GROUP BY user_id HAVING SUM(amount) > 0')
+            rows = conn.execute(period_sql, (_week_start(),)).fetchall()
+            _board(week_board()).load((r['user_id'], r['xp']) for r in rows)
+
+            season_id, starts_at = _active_season(conn)
+            if season_id:
+                # Сезон длиннее срока хранения xp_log — старые дни берём из агрегатов
+                rows = conn.execute(
+                    '''SELECT user_id, SUM(amount) AS xp FROM (
+                           SELECT user_id, amount FROM xp_log WHERE created_at >= ?
+                           UNION ALL
+                           SELECT user_id, amount FROM xp_log_daily WHERE day >= ?
+                       ) t GROUP BY user_id HAVING SUM(amount) > 0''',
+                    (starts_at, starts_at[:10])
+                ).fetchall()
+                _board(f'season:{season_id}').load((r['user_id'], r['xp']) for r in rows)
+        finally:
+            if close:
+                conn.close()
+        _last_rebuild = time.monotonic()
+
+
+# ── Чтение ───────────────────────────────────────────────────────────────────
+
+def top(n=50, period='all'):
+    """[(user_id, score), ...] по убыванию счёта."""
+    _ensure_built()
+    name = board_name(period)
+    return _board(name).top(n) if name else []
+
+
+def rank(user_id, period='all'):
+    """(место, счёт) пользователя или (None, 0), если он не в таблице."""
+    _ensure_built()
+    name = board_name(period)
+    if not name:
+        return None, 0
+    b = _board(name)
+    return b.rank(user_id), b.score(user_id) or 0
+
+
+def size(period='all'):
+    _ensure_built()
+    name = board_name(period)
+    return _board(name).size() if name else 0
@@ -68,12 +68,16 @@ Compress(app)
 
 # Flask-Caching: Redis если доступен, иначе SimpleCache (в памяти)
 # _REDIS_URL импортирован из config.py как _REDIS_URL
+import leaderboard
+import manga_cards
 try:
     import redis as _redis_lib
     _r = _redis_lib.from_url(_REDIS_URL, socket_connect_timeout=1)
     _r.ping()
     _CACHE_TYPE = 'RedisCache'
     _CACHE_OPTS = {'CACHE_REDIS_URL': _REDIS_URL}
+    leaderboard.configure(_r)
+    manga_cards.configure(_r)
     print('✅ Flask-Cache: Redis backend')
 except Exception:
     _CACHE_TYPE = 'SimpleCache'
@@ -84,6 +88,8 @@ app.config['CACHE_TYPE'] = _CACHE_TYPE
 app.config['CACHE_DEFAULT_TIMEOUT'] = 300
 app.config.update(_CACHE_OPTS)
 cache = Cache(app)
+import catalog_cache
+catalog_cache.configure(cache)
 
 socketio = SocketIO(
     app,
@@ -119,7 +125,7 @@ def filter_rating_ru(v):
     return _RATING_RU.get((v or '').upper(), v or '')
 
 import bot as _bot_module
-from bot import run_telegram_bot, send_telegram_notification, send_daily_digest, _revoke_premium_loans
+from bot import run_telegram_bot, send_telegram_notification, send_daily_digest
 
 # Клиент API Senkuro
 api = SenkuroAPI()
@@ -167,8 +173,18 @@ from database import (
     _DATABASE_URL, _USE_PG, _to_dt,
     _CompatRow, _CompatCursor, _CompatConn,
     _translate_sql, _build_on_conflict, _get_pg_conn,
-    get_db, init_db, init_pg_schema,
+    get_db, init_db, init_pg_schema, reconcile_user_counters,
+    existing_chapters, upsert_chapters,
 )
+import rules as _rules
+import xp_ledger
+import sweeper
+import scheduler
+import update_crawler
+import search_index
+import suggest_store
+import search_stats
+import search_engine
 
 
 def create_site_notification(user_id, notif_type, title, body=None, url=None, ref_id=None, conn=None):
@@ -237,41 +253,17 @@ os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
 
 def _convert_to_webm_bg(abs_path):
     """Конвертирует анимированный файл в WebM в фоновом потоке."""
-    import subprocess
-    import tempfile
-    from PIL import Image, ImageSequence
+    from media import to_webm
 
     dst = abs_path + '.webm'
     if os.path.exists(dst):
         return
-    ext = abs_path.rsplit('.', 1)[-1].lower()
-    tmp_gif = None
-    ffmpeg_input = abs_path
     try:
-        if ext == 'webp':
-            img = Image.open(abs_path)
-            frames, durations = [], []
-            for frame in ImageSequence.Iterator(img):
-                rgba = frame.convert('RGBA')
-                frames.append(rgba.convert('P', palette=Image.ADAPTIVE, colors=256))
-                durations.append(frame.info.get('duration', 50))
-            tmp = tempfile.NamedTemporaryFile(suffix='.gif', delete=False)
-            frames[0].save(tmp.name, save_all=True, append_images=frames[1:],
-                           loop=0, duration=durations, optimize=False)
-            tmp.close()
-            tmp_gif = tmp.name
-            ffmpeg_input = tmp_gif
-        cmd = ['ffmpeg', '-y', '-i', ffmpeg_input,
-               '-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '35',
-               '-cpu-used', '5', '-deadline', 'realtime',
-               '-auto-alt-ref', '0', '-an', dst]
-        subprocess.run(cmd, capture_output=True, timeout=300)
+        ok, err = to_webm(abs_path, dst, timeout=300)
+        if not ok:
+            logger.error(f'WebM bg convert failed {abs_path}: {err}')
     except Exception as e:
         logger.error(f'WebM bg convert error {abs_path}: {e}')
-    finally:
-        if tmp_gif:
-            try: os.unlink(tmp_gif)
-            except OSError: pass
 
 
 def schedule_webm_conversion(abs_path):
@@ -314,7 +306,7 @@ def get_or_create_user_stats(user_id, conn=None):
     return dict(stats) if stats else None
 
 
-def award_xp(user_id, amount, reason, ref_id=None):
+def award_xp(user_id, amount, reason, ref_id=None, changed=()):
     """
     Начислить XP и монеты пользователю.
 
@@ -323,6 +315,8 @@ def award_xp(user_id, amount, reason, ref_id=None):
         amount: количество XP
         reason: причина (строка для лога)
         ref_id: ID связанного объекта (chapter_id и т.п.) для антиспама
+        changed: condition_type, значения которых изменились вместе с начислением
+                 (уровень учитывается автоматически)
 
     Returns:
         dict: {'xp': new_xp, 'level': new_level, 'leveled_up': bool, 'achievements': [...]}
@@ -334,15 +328,9 @@ def award_xp(user_id, amount, reason, ref_id=None):
     c = conn.cursor()
 
     # Антиспам: не начислять XP дважды за один и тот же ref_id
-    if ref_id:
-        c.execute(
-            'SELECT id FROM xp_log WHERE user_id = ? AND ref_id = ? AND reason = ? '
-            'AND created_at > datetime("now", "-1 hour")',
-            (user_id, str(ref_id), reason)
-        )
-        if c.fetchone():
-            conn.close()
-            return None
+    if ref_id and xp_ledger.is_duplicate(conn, user_id, reason, ref_id):
+        conn.close()
+        return None
 
     # Создаём запись статистики если нет
     c.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
@@ -369,6 +357,7 @@ def award_xp(user_id, amount, reason, ref_id=None):
     )
 
     conn.commit()
+    leaderboard.add_xp(user_id, amount)
 
     # Уведомление о новом уровне
     if new_level > old_level:
@@ -376,9 +365,17 @@ def award_xp(user_id, amount, reason, ref_id=None):
                                  f'Поздравляем с {new_level} уровнем!',
                                  f'/profile/{user_id}', conn=conn)
 
-    # Проверяем ачивки и квесты
-    new_achievements = check_achievements(user_id, conn)
-    check_quests(user_id, conn)
+    # Проверяем только правила, чьи значения изменились. Новый уровень открывает
+    # задания с required_level, поэтому при level up задания проверяются все.
+    leveled_up = new_level > old_level
+    changed = set(changed)
+    if leveled_up:
+        changed.add('level')
+    new_achievements = check_achievements(user_id, conn, changed) if changed else []
+    if leveled_up:
+        check_quests(user_id, conn)
+    elif changed:
+        check_quests(user_id, conn, changed)
 
     conn.close()
 
@@ -386,9 +383,6 @@ def award_xp(user_id, amount, reason, ref_id=None):
     with _stats_cache_lock:
         _stats_cache.pop(user_id, None)
 
-    # Инвалидируем кеш таблицы лидеров
-    cache.delete('top_leaders')
-
     return {
         'xp': new_xp,
         'level': new_level,
@@ -397,154 +391,160 @@ def award_xp(user_id, amount, reason, ref_id=None):
     }
 
 
-def check_achievements(user_id, conn=None):
+def check_achievements(user_id, conn=None, changed=None):
     """
     Проверить и выдать новые ачивки пользователю.
 
+    Args:
+        changed: набор condition_type, значения которых изменились
+                 (None — проверить все правила)
+
     Returns:
         list[dict]: список только что выданных ачивок
     """
     close = conn is None
     if conn is None:
         conn = get_db()
-    c = conn.cursor()
-
-    # Получаем текущую статистику
-    c.execute('SELECT * FROM user_stats WHERE user_id = ?', (user_id,))
-    stats = c.fetchone()
-    if not stats:
-        if close:
-            conn.close()
-        return []
+    try:
+        rules = _rules.rule_cache.achievements(conn, changed)
+        if not rules:
+            return []
 
-    # Количество подписок
-    c.execute('SELECT COUNT(*) as cnt FROM subscriptions WHERE user_id = ?', (user_id,))
-    sub_count = c.fetchone()['cnt']
+        c = conn.cursor()
+        c.execute('SELECT * FROM user_stats WHERE user_id = ?', (user_id,))
+        stats = c.fetchone()
+        if not stats:
+            return []
 
-    stat_values = {
-        'chapters_read': stats['total_chapters_read'],
-        'subscriptions': sub_count,
-        'level': stats['level'],
-    }
+        values = _rules.stat_values(conn, user_id, stats, rules.keys())
+        # Правила отсортированы по condition_value — берём префикс выполненных
+        candidates = []
+        for ctype, group in rules.items():
+            val = values.get(ctype, 0)
+            for ach in group:
+                if ach['condition_value'] > val:
+                    break
+                candidates.append(ach)
+        if not candidates:
+            return []
 
-    # Все ачивки которых у пользователя ещё нет
-    c.execute(
-        '''SELECT a.* FROM achievements a
-           WHERE a.id NOT IN (
-               SELECT achievement_id FROM user_achievements WHERE user_id = ?
-           )''',
-        (user_id,)
-    )
-    pending = c.fetchall()
+        c.execute('SELECT achievement_id FROM user_achievements WHERE user_id = ?', (user_id,))
+        have = {r['achievement_id'] for r in c.fetchall()}
+        unlocked = [a for a in candidates if a['id'] not in have]
+        if not unlocked:
+            return []
 
-    unlocked = []
-    for ach in pending:
-        val = stat_values.get(ach['condition_type'], 0)
-        if val >= ach['condition_value']:
+        c.executemany(
+            'INSERT OR IGNORE INTO user_achievements (user_id, achievement_id) VALUES (?, ?)',
+            [(user_id, a['id']) for a in unlocked]
+        )
+        # Бонус XP за ачивки (без рекурсии и без антиспама)
+        bonus = sum(a['xp_reward'] for a in unlocked if a['xp_reward'] > 0)
+        if bonus:
             c.execute(
-                'INSERT OR IGNORE INTO user_achievements (user_id, achievement_id) VALUES (?, ?)',
-                (user_id, ach['id'])
+                'UPDATE user_stats SET xp = xp + ?, coins = coins + ? WHERE user_id = ?',
+                (bonus, bonus, user_id)
             )
-            # Бонус XP за ачивку (без рекурсии и без антиспама)
-            if ach['xp_reward'] > 0:
-                c.execute(
-                    'UPDATE user_stats SET xp = xp + ?, coins = coins + ? WHERE user_id = ?',
-                    (ach['xp_reward'], ach['xp_reward'], user_id)
-                )
-            unlocked.append(dict(ach))
-            create_site_notification(user_id, 'achievement', f'Достижение: {ach["name"]}',
-                                     ach['description'],
-                                     f'/profile/{user_id}', conn=conn)
-
-    conn.commit()
-    if close:
-        conn.close()
-    return unlocked
+            # В xp_log — иначе недельная/сезонная доска теряет бонус при rebuild()
+            c.executemany(
+                'INSERT INTO xp_log (user_id, reason, ref_id, amount) VALUES (?, ?, ?, ?)',
+                [(user_id, f'achievement:{a["id"]}', str(a['id']), a['xp_reward'])
+                 for a in unlocked if a['xp_reward'] > 0]
+            )
+        c.executemany(
+            'INSERT INTO site_notifications (user_id, type, title, body, url) VALUES (?,?,?,?,?)',
+            [(user_id, 'achievement', f'Достижение: {a["name"]}', a['description'],
+              f'/profile/{user_id}') for a in unlocked]
+        )
+        conn.commit()
+        leaderboard.add_xp(user_id, bonus)
+        return [dict(a) for a in unlocked]
+    finally:
+        if close:
+            conn.close()
 
 
-def check_quests(user_id, conn=None):
+def check_quests(user_id, conn=None, changed=None):
     """
     Проверить и обновить прогресс заданий пользователя.
+    changed — набор condition_type, значения которых изменились (None — все).
     Возвращает список только что завершённых заданий.
     """
     close = conn is None
     if conn is None:
         conn = get_db()
-    c = conn.cursor()
-
-    c.execute('SELECT * FROM user_stats WHERE user_id = ?', (user_id,))
-    stats = c.fetchone()
-    if not stats:
-        if close:
-            conn.close()
-        return []
-
-    c.execute('SELECT COUNT(*) as cnt FROM comments WHERE user_id = ?', (user_id,))
-    comments_cnt = c.fetchone()['cnt']
-    c.execute('SELECT COUNT(*) as cnt FROM subscriptions WHERE user_id = ?', (user_id,))
-    subs_cnt = c.fetchone()['cnt']
+    try:
+        rules = _rules.rule_cache.quests(conn, changed)
+        if not rules:
+            return []
 
-    stat_values = {
-        'chapters_read':   stats['total_chapters_read'],
-        'subscriptions':   subs_cnt,
-        'level':           stats['level'],
-        'comments_posted': comments_cnt,
-    }
-    current_level = stats['level']
+        c = conn.cursor()
+        c.execute('SELECT * FROM user_stats WHERE user_id = ?', (user_id,))
+        stats = c.fetchone()
+        if not stats:
+            return []
+        current_level = stats['level']
 
-    # Активные квесты доступные пользователю (required_level <= current_level)
-    c.execute(
-        'SELECT * FROM quests WHERE is_active = 1 AND required_level <= ?',
-        (current_level,)
-    )
-    all_quests = c.fetchall()
+        # Только квесты, доступные по уровню
+        available = [q for group in rules.values() for q in group
+                     if q['required_level'] <= current_level]
+        if not available:
+            return []
 
-    just_completed = []
-    for q in all_quests:
-        current_progress = stat_values.get(q['condition_type'], 0)
-        c.execute(
-            'SELECT progress, completed_at FROM user_quests WHERE user_id = ? AND quest_id = ?',
-            (user_id, q['id'])
-        )
-        uq = c.fetchone()
-        already_done = uq and uq['completed_at'] is not None
+        values = _rules.stat_values(conn, user_id, stats, rules.keys())
+        c.execute('SELECT quest_id, progress, completed_at FROM user_quests WHERE user_id = ?',
+                  (user_id,))
+        user_quests = {r['quest_id']: r for r in c.fetchall()}
 
-        if already_done:
-            continue
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        upserts, just_completed = [], []
+        for q in available:
+            uq = user_quests.get(q['id'])
+            if uq and uq['completed_at'] is not None:
+                continue
+            progress = min(values.get(q['condition_type'], 0), q['condition_value'])
+            done = progress >= q['condition_value']
+            if uq and uq['progress'] == progress and not done:
+                continue  # прогресс не изменился — не пишем
+            upserts.append((user_id, q['id'], progress, now if done else None))
+            if done:
+                just_completed.append(q)
+
+        if not upserts:
+            return []
 
-        # Upsert progress
-        c.execute(
-            '''INSERT INTO user_quests (user_id, quest_id, progress)
-               VALUES (?, ?, ?)
-               ON CONFLICT(user_id, quest_id) DO UPDATE SET progress = excluded.progress''',
-            (user_id, q['id'], min(current_progress, q['condition_value']))
+        c.executemany(
+            '''INSERT INTO user_quests (user_id, quest_id, progress, completed_at)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(user_id, quest_id) DO UPDATE
+               SET progress = excluded.progress, completed_at = excluded.completed_at''',
+            upserts
         )
-
-        if current_progress >= q['condition_value']:
+        # Награды за выполненные задания
+        rewarded = [q for q in just_completed if q['xp_reward'] > 0 or q['coins_reward'] > 0]
+        if rewarded:
             c.execute(
-                '''UPDATE user_quests SET completed_at = datetime("now"), progress = ?
-                   WHERE user_id = ? AND quest_id = ?''',
-                (q['condition_value'], user_id, q['id'])
+                'UPDATE user_stats SET xp = xp + ?, coins = coins + ? WHERE user_id = ?',
+                (sum(q['xp_reward'] for q in rewarded),
+                 sum(q['coins_reward'] for q in rewarded), user_id)
             )
-            # Выдаём награды
-            if q['xp_reward'] > 0 or q['coins_reward'] > 0:
-                c.execute(
-                    'UPDATE user_stats SET xp = xp + ?, coins = coins + ? WHERE user_id = ?',
-                    (q['xp_reward'], q['coins_reward'], user_id)
-                )
-                c.execute(
-                    'INSERT INTO xp_log (user_id, reason, ref_id, amount) VALUES (?, ?, ?, ?)',
-                    (user_id, f'quest:{q["id"]}', str(q['id']), q['xp_reward'])
-                )
-            just_completed.append(dict(q))
-            create_site_notification(user_id, 'quest', f'Задание выполнено: {q["title"]}',
-                                     f'+{q["xp_reward"]} XP',
-                                     f'/profile/{user_id}', conn=conn)
-
-    conn.commit()
-    if close:
-        conn.close()
-    return just_completed
+            c.executemany(
+                'INSERT INTO xp_log (user_id, reason, ref_id, amount) VALUES (?, ?, ?, ?)',
+                [(user_id, f'quest:{q["id"]}', str(q['id']), q['xp_reward']) for q in rewarded]
+            )
+        if just_completed:
+            c.executemany(
+                'INSERT INTO site_notifications (user_id, type, title, body, url) VALUES (?,?,?,?,?)',
+                [(user_id, 'quest', f'Задание выполнено: {q["title"]}', f'+{q["xp_reward"]} XP',
+                  f'/profile/{user_id}') for q in just_completed]
+            )
+        conn.commit()
+        if rewarded:
+            leaderboard.add_xp(user_id, sum(q['xp_reward'] for q in rewarded))
+        return [dict(q) for q in just_completed]
+    finally:
+        if close:
+            conn.close()
 
 
 def get_user_full_profile(user_id):
@@ -620,9 +620,10 @@ def get_user_full_profile(user_id):
     )
     wishlist = [dict(row) for row in c.fetchall()]
 
-    # Количество подписчиков (как куратора)
-    c.execute('SELECT COUNT(*) FROM curator_follows WHERE author_id=?', (user_id,))
-    followers_count = c.fetchone()[0]
+    # Количество подписчиков (как куратора) — из счётчиков user_counters
+    c.execute('SELECT followers_count FROM user_counters WHERE user_id=?', (user_id,))
+    row = c.fetchone()
+    followers_count = row[0] if row else 0
 
     conn.close()
 
@@ -706,6 +707,7 @@ def update_reading_streak(user_id, conn):
             (user_id, f'streak_{new_streak}', None, bonus)
         )
         conn.commit()
+        leaderboard.add_xp(user_id, bonus)
 
 
 def get_or_create_daily_quests(user_id, conn):
@@ -749,6 +751,7 @@ def update_daily_quest_progress(user_id, condition_type, conn):
                     'INSERT INTO xp_log (user_id, reason, ref_id, amount) VALUES (?, ?, ?, ?)',
                     (user_id, f'daily_quest:{row["id"]}', str(row['id']), row['xp_reward'])
                 )
+                leaderboard.add_xp(user_id, row['xp_reward'])
         else:
             conn.execute('UPDATE user_daily_quests SET progress=? WHERE id=?', (new_progress, row['id']))
     conn.commit()
@@ -798,6 +801,7 @@ def update_season_quest_progress(user_id, condition_type, amount, conn):
                     'INSERT INTO xp_log (user_id, reason, ref_id, amount) VALUES (?, ?, ?, ?)',
                     (user_id, f'season_quest:{q["id"]}', str(q['id']), q['xp_reward'])
                 )
+                leaderboard.add_xp(user_id, q['xp_reward'])
             # Выдать предметную награду
             if q['item_reward_id']:
                 conn.execute(
@@ -813,7 +817,7 @@ def update_season_quest_progress(user_id, condition_type, amount, conn):
 
 
 def award_weekly_collection_trophy():
-    """Выдать трофей коллекции недели. Вызывается по понедельникам из background_checker."""
+    """Выдать трофей коллекции недели. Запускается планировщиком по понедельникам."""
     try:
         conn = get_db()
         # ISO-неделя
@@ -848,6 +852,7 @@ def award_weekly_collection_trophy():
             (row['user_id'], 'weekly_trophy', iso_week, 500)
         )
         conn.commit()
+        leaderboard.add_xp(row['user_id'], 500)
         logger.info(f"🏆 Трофей коллекции недели {iso_week} выдан user_id={row['user_id']}")
         conn.close()
     except Exception as e:
@@ -1087,6 +1092,7 @@ def save_manga_from_spotlight(manga_data):
                        manga_data['cover_url'], datetime.now()))
         
         conn.commit()
+        _manga_changed(manga_data['id'], manga_data.get('type'))
         logger.debug(f"✅ Сохранена манга из спотлайта: {manga_data['title']}")
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения манги из спотлайта: {e}")
@@ -1281,6 +1287,12 @@ def get_most_read_manga(period="WEEK", limit=12):
 
 # ==================== ФУНКЦИИ ПОИСКА ====================
 
+def _manga_changed(manga_id, manga_type=None):
+    """Сообщить кешам о записи в manga: индекс поиска, страницы каталога, карточка."""
+    search_index.refresh(manga_id)
+    catalog_cache.invalidate(manga_type)
+    manga_cards.invalidate(manga_id)
+
 def search_manga_api(query, limit=50):
     """Поиск манги через API с кешированием результатов в БД"""
     results = api.search(query, max_results=limit)
@@ -1306,38 +1318,24 @@ def save_manga_search_result(manga_data):
                    manga_data['manga_status'], manga_data['cover_url'],
                    manga_data.get('rating', 'GENERAL'), datetime.now()))
         conn.commit()
-        # Обновляем FTS индекс
-        try:
-            manga_id = manga_data['manga_id']
-            title = manga_data['manga_title']
-            original_name = manga_data.get('original_name')
-            description = manga_data.get('description')
-            if not _USE_PG:
-                c.execute('DELETE FROM manga_fts WHERE manga_id = ?', (manga_id,))
-                c.execute('''INSERT INTO manga_fts(manga_id, manga_title, original_name, description)
-                             VALUES (?, ?, ?, ?)''',
-                          (manga_id, title, original_name or '', description or ''))
-            conn.commit()
-        except Exception:
-            pass
+        # manga_fts / search_vector обновляют триггеры (search_engine.ensure_schema)
+        _manga_changed(manga_data['manga_id'], manga_data.get('manga_type'))
     except Exception as e:
         print(f"❌ Ошибка сохранения манги: {e}")
     finally:
         conn.close()
 
 def save_search_history(user_id, query):
-    """Сохранить историю поиска"""
+    """Учесть запрос в статистике и сохранить его в историю пользователя.
+
+    Лимит истории на пользователя и срок хранения — search_stats.prune_history.
+    """
+    search_stats.record(query)
     if not user_id:
         return
     
     conn = get_db()
     c = conn.cursor()
-    
-    # Удаляем старые записи если их больше 50
-    c.execute('DELETE FROM search_history WHERE id IN '
-              '(SELECT id FROM search_history WHERE user_id = ? ORDER BY created_at DESC LIMIT -1 OFFSET 50)',
-              (user_id,))
-    
     c.execute('INSERT INTO search_history (user_id, query) VALUES (?, ?)',
               (user_id, query))
     conn.commit()
@@ -1345,16 +1343,7 @@ def save_search_history(user_id, query):
 
 def get_search_suggestions(query, limit=100):
     """Получить предложения для автодополнения"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''SELECT DISTINCT query FROM search_history 
-                 WHERE query LIKE ? 
-                 ORDER BY created_at DESC 
-                 LIMIT ?''',
-              (f'{query}%', limit))
-    suggestions = [row[0] for row in c.fetchall()]
-    conn.close()
-    return suggestions
+    return suggest_store.lookup(query, limit)
 
 # ==================== ПОЛЬЗОВАТЕЛИ ====================
 
@@ -1509,14 +1498,21 @@ def save_manga_details_to_db(manga_data):
             }
         )
         conn.commit()
+        _manga_changed(manga_data['manga_id'], manga_data.get('manga_type'))
         logger.info(f"✅ Сохранена манга в БД: {manga_data['manga_title']}")
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения деталей манги: {e}")
     finally:
         conn.close()
 
-def get_manga_chapters_api(manga_slug, limit=10000):
-    """Получить ВСЕ главы манги через API с пагинацией"""
+def get_manga_chapters_api(manga_slug, limit=10000, incremental=True):
+    """Получить главы манги через API с пагинацией.
+
+    incremental=True — страницы читаются от новых глав к старым, и обход
+    останавливается на первой странице, все главы которой уже есть в БД
+    с тем же номером. Тогда возвращаются только прочитанные из API главы.
+    incremental=False — полный обход (до 50 страниц).
+    """
     # Сначала получаем детали манги чтобы узнать ID ветки
     manga_details = get_manga_details_api(manga_slug)
     if not manga_details:
@@ -1526,14 +1522,23 @@ def get_manga_chapters_api(manga_slug, limit=10000):
     # Получаем ID манги и ветки
     manga_id = manga_details['manga_id']
     branch_id = manga_details.get('branch_id', manga_id)
-    
-    logger.info(f"🔄 Загрузка ВСЕХ глав для {manga_slug}, manga_id: {manga_id}, branch_id: {branch_id}")
+
+    conn = get_db()
+    try:
+        existing = existing_chapters(conn, manga_id)
+    finally:
+        conn.close()
+    incremental = incremental and bool(existing)
+
+    mode = "новых" if incremental else "ВСЕХ"
+    logger.info(f"🔄 Загрузка {mode} глав для {manga_slug}, manga_id: {manga_id}, branch_id: {branch_id}")
     
     chapters = []
     after = None
     has_next_page = True
     page_num = 0
     max_pages = 50  # Максимум 50 страниц (5000 глав) на всякий случай
+    complete = False  # дошли до последней страницы — список глав полный
 
     while has_next_page and page_num < max_pages:
         page_num += 1
@@ -1548,6 +1553,7 @@ def get_manga_chapters_api(manga_slug, limit=10000):
         page_info = chapters_connection.get("pageInfo", {})
         has_next_page = page_info.get("hasNextPage", False)
         after = page_info.get("endCursor")
+        complete = not has_next_page
 
         edges = chapters_connection.get("edges", [])
         logger.info(
@@ -1556,10 +1562,14 @@ def get_manga_chapters_api(manga_slug, limit=10000):
             f"hasNextPage={has_next_page}, endCursor={after}"
         )
 
+        page_known = True
         for edge in edges:
             node = edge.get("node") or {}
             if not node:
                 continue
+            if node.get('id') not in existing or \
+                    str(existing[node.get('id')]) != str(node.get('number')):
+                page_known = False
             chapters.append({
                 'chapter_id': node.get('id'),
                 'chapter_slug': node.get('slug'),
@@ -1571,6 +1581,11 @@ def get_manga_chapters_api(manga_slug, limit=10000):
                 'manga_slug': manga_slug
             })
 
+        # Вся страница уже в БД — более старые главы тоже
+        if incremental and page_known:
+            logger.info(f"✅ Страница {page_num} целиком известна — остальные главы уже в БД")
+            break
+
         # Прерываем при достижении лимита
         if limit and len(chapters) >= limit:
             logger.info(f"✅ Достигнут лимит {limit} глав")
@@ -1582,11 +1597,13 @@ def get_manga_chapters_api(manga_slug, limit=10000):
     
     # Кешируем главы в БД
     if chapters:
-        save_chapters_to_db(chapters, manga_id)
+        save_chapters_to_db(chapters, manga_id, existing=existing)
         logger.info(f"✅ Получено и сохранено {len(chapters)} глав для {manga_slug}")
         
-        # Обновляем счетчик глав в таблице manga
-        update_manga_chapters_count(manga_id, len(chapters))
+        # Счётчик — только после полного обхода: после ранней остановки объединение
+        # с локальными главами занизило бы ожидаемое число и спрятало пропуски
+        if complete:
+            update_manga_chapters_count(manga_id, len(existing.keys() | {ch['chapter_id'] for ch in chapters}))
     else:
         logger.warning(f"⚠️ Главы не найдены для {manga_slug}")
     
@@ -1601,64 +1618,27 @@ def update_manga_chapters_count(manga_id, chapters_count):
         c.execute('UPDATE manga SET chapters_count = ? WHERE manga_id = ?', 
                  (chapters_count, manga_id))
         conn.commit()
+        _manga_changed(manga_id)
         logger.info(f"📊 Обновлен счетчик глав: {manga_id} -> {chapters_count} глав")
     except Exception as e:
         logger.error(f"❌ Ошибка обновления счетчика глав: {e}")
     finally:
         conn.close()
 
-def save_chapters_to_db(chapters, manga_id):
-    """Сохранить главы в БД с улучшенной обработкой"""
+def save_chapters_to_db(chapters, manga_id, existing=None):
+    """Сохранить главы в БД пакетно (database.upsert_chapters).
+
+    Существующие главы манги загружаются одним запросом (или передаются в
+    existing); в БД уходят только новые и перенумерованные главы.
+    """
     if not chapters:
         return
 
-    BATCH_SIZE = 50  # коммитить каждые N глав чтобы не держать write-lock долго
-
     conn = get_db()
-    c = conn.cursor()
-
     try:
-        saved_count = 0
-        updated_count = 0
-        errors = 0
-
-        for i, chapter in enumerate(chapters):
-            try:
-                c.execute('SELECT chapter_id, chapter_number FROM chapters WHERE chapter_id = ?',
-                         (chapter['chapter_id'],))
-                existing = c.fetchone()
-
-                if not existing:
-                    chapter_url = f"/read/{chapter['manga_slug']}/{chapter['chapter_slug']}"
-                    c.execute('''INSERT INTO chapters
-                                (manga_id, chapter_id, chapter_slug, chapter_number,
-                                 chapter_volume, chapter_name, chapter_url, created_at)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                              (manga_id, chapter['chapter_id'], chapter['chapter_slug'],
-                               chapter['chapter_number'], chapter['chapter_volume'],
-                               chapter['chapter_name'], chapter_url,
-                               chapter['created_at']))
-                    saved_count += 1
-                else:
-                    if existing['chapter_number'] != chapter['chapter_number']:
-                        c.execute('UPDATE chapters SET chapter_number = ? WHERE chapter_id = ?',
-                                 (chapter['chapter_number'], chapter['chapter_id']))
-                        updated_count += 1
-
-            except Exception as e:
-                errors += 1
-                logger.error(f"❌ Ошибка сохранения главы {chapter.get('chapter_id', 'unknown')}: {e}")
-
-            # Промежуточный коммит — освобождаем write-lock
-            if (i + 1) % BATCH_SIZE == 0:
-                conn.commit()
-
-        conn.commit()
-        logger.info(f"✅ Сохранено {saved_count} новых глав, обновлено {updated_count}, ошибок: {errors}")
-
-        c.execute('CREATE INDEX IF NOT EXISTS idx_chapters_manga_number ON chapters(manga_id, chapter_number)')
-        conn.commit()
-
+        inserted, updated = upsert_chapters(conn, manga_id, chapters, existing)
+        logger.info(f"✅ Сохранено {inserted} новых глав, обновлено {updated}, "
+                    f"без изменений {len(chapters) - inserted - updated}")
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения глав: {e}")
         import traceback
@@ -1734,6 +1714,59 @@ def get_recent_chapters(limit=20):
     conn.close()
     return [dict(ch) for ch in chapters]
 
+def _parse_latest_chapters(edges, limit=None):
+    """Разобрать edges из fetchMainPage в список последних глав (по одной на мангу).
+
+    Каждый элемент — dict для фронтенда; под ключом '_chapter' лежит исходный
+    объект главы из API (для save_manga_and_chapter_to_db / process_new_chapter).
+    """
+    recent_chapters = []
+    for edge in edges[:limit]:
+        node = edge.get("node") or {}
+        if not node:
+            continue
+        manga_id = node.get("id")
+        manga_slug = node.get("slug")
+
+        # Получаем название манги
+        titles = node.get("titles") or []
+        ru_title = next((t["content"] for t in titles if t.get("lang") == "RU"), None)
+        en_title = next((t["content"] for t in titles if t.get("lang") == "EN"), None)
+        manga_title = ru_title or en_title or manga_slug
+
+        # Получаем обложку
+        cover = node.get("cover") or {}
+        cover_url = (cover.get("original") or {}).get("url", "") or \
+                    (cover.get("preview") or {}).get("url", "")
+
+        # Берем самую последнюю главу этой манги
+        last_chapters = node.get("lastChapters", [])
+        if not last_chapters:
+            continue
+        latest_chapter = last_chapters[0]
+
+        recent_chapters.append({
+            'manga_id': manga_id,
+            'manga_slug': manga_slug,
+            'manga_title': manga_title,
+            'cover_url': cover_url,
+            'chapter_id': latest_chapter.get('id'),
+            'chapter_slug': latest_chapter.get('slug'),
+            'chapter_number': latest_chapter.get('number'),
+            'chapter_volume': latest_chapter.get('volume'),
+            'chapter_name': latest_chapter.get('name'),
+            'created_at': latest_chapter.get('createdAt'),
+            'chapter_url': f"{SITE_URL}/read/{manga_slug}/{latest_chapter.get('slug')}",
+            '_chapter': latest_chapter,
+        })
+    return recent_chapters
+
+
+def _public_chapters(chapters):
+    """Список глав без служебных ключей — для JSON/Socket.IO."""
+    return [{k: v for k, v in ch.items() if not k.startswith('_')} for ch in chapters]
+
+
 def get_recent_chapters_from_api(limit=21):
     """
     Получить последние главы напрямую из API.
@@ -1747,56 +1780,14 @@ def get_recent_chapters_from_api(limit=21):
         
         logger.info(f"📚 Получено {len(edges)} последних глав из API")
         
-        recent_chapters = []
-        
-        for edge in edges[:limit]:
-            node = edge.get("node") or {}
-            if not node:
-                continue
-            manga_id = node.get("id")
-            manga_slug = node.get("slug")
-
-            # Получаем название манги
-            titles = node.get("titles") or []
-            ru_title = next((t["content"] for t in titles if t.get("lang") == "RU"), None)
-            en_title = next((t["content"] for t in titles if t.get("lang") == "EN"), None)
-            manga_title = ru_title or en_title or manga_slug
-
-            # Получаем обложку
-            cover = node.get("cover") or {}
-            cover_url = (cover.get("original") or {}).get("url", "") or \
-                        (cover.get("preview") or {}).get("url", "")
-            
-            # Получаем последние главы этой манги
-            last_chapters = node.get("lastChapters", [])
-            
-            if not last_chapters:
-                continue
-            
-            # Берем самую последнюю главу
-            latest_chapter = last_chapters[0]
-            
-            chapter_data = {
-                'manga_id': manga_id,
-                'manga_slug': manga_slug,
-                'manga_title': manga_title,
-                'cover_url': cover_url,
-                'chapter_id': latest_chapter.get('id'),
-                'chapter_slug': latest_chapter.get('slug'),
-                'chapter_number': latest_chapter.get('number'),
-                'chapter_volume': latest_chapter.get('volume'),
-                'chapter_name': latest_chapter.get('name'),
-                'created_at': latest_chapter.get('createdAt'),
-                'chapter_url': f"{SITE_URL}/read/{manga_slug}/{latest_chapter.get('slug')}"
-            }
-            
-            recent_chapters.append(chapter_data)
-            
+        recent_chapters = _parse_latest_chapters(edges, limit)
+        for ch in recent_chapters:
             # Сохраняем мангу и главу в БД для кеширования
-            save_manga_and_chapter_to_db(manga_id, manga_slug, manga_title, cover_url, latest_chapter)
+            save_manga_and_chapter_to_db(ch['manga_id'], ch['manga_slug'], ch['manga_title'],
+                                         ch['cover_url'], ch['_chapter'])
         
         logger.info(f"✅ Обработано {len(recent_chapters)} последних глав")
-        return recent_chapters
+        return _public_chapters(recent_chapters)
         
     except Exception as e:
         logger.error(f"❌ Ошибка получения последних глав из API: {e}")
@@ -1838,6 +1829,7 @@ def save_manga_and_chapter_to_db(manga_id, manga_slug, manga_title, cover_url, c
                        chapter_info.get('name'), chapter_info.get('createdAt') or datetime.now()))
         
         conn.commit()
+        _manga_changed(manga_id)
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения манги/главы в БД: {e}")
     finally:
@@ -1846,19 +1838,19 @@ def save_manga_and_chapter_to_db(manga_id, manga_slug, manga_title, cover_url, c
 def get_user_subscriptions(user_id, limit=12):
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT m.* FROM manga m
+    c.execute('''SELECT m.manga_id FROM manga m
                  JOIN subscriptions s ON m.manga_id = s.manga_id
                  WHERE s.user_id = ?
                  ORDER BY m.last_updated DESC
                  LIMIT ?''', (user_id, limit))
-    manga = c.fetchall()
+    ids = [r['manga_id'] for r in c.fetchall()]
     conn.close()
-    return [dict(m) for m in manga]
+    return manga_cards.get_many(ids)
 
 def get_user_reading(user_id, limit=12):
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT m.*, rh_agg.last_read_time
+    c.execute('''SELECT m.manga_id, rh_agg.last_read_time
                  FROM manga m
                  JOIN (
                      SELECT manga_id, MAX(last_read) as last_read_time
@@ -1868,9 +1860,9 @@ def get_user_reading(user_id, limit=12):
                  ) rh_agg ON m.manga_id = rh_agg.manga_id
                  ORDER BY rh_agg.last_read_time DESC
                  LIMIT ?''', (user_id, limit))
-    manga = c.fetchall()
+    rows = c.fetchall()
     conn.close()
-    return [dict(m) for m in manga]
+    return manga_cards.hydrate(rows)
 
 def toggle_subscription(user_id, manga_id):
     conn = get_db()
@@ -1895,6 +1887,9 @@ def toggle_subscription(user_id, manga_id):
         subscribed = True
 
     conn.commit()
+    if subscribed:
+        check_achievements(user_id, conn, {'subscriptions'})
+        check_quests(user_id, conn, {'subscriptions'})
     conn.close()
     return subscribed
 
@@ -1930,38 +1925,6 @@ def increment_manga_views(manga_id):
 
 # ==================== ПРОВЕРКА НОВЫХ ГЛАВ ====================
 
-last_known_chapters = {}
-
-async def send_telegram_notification(user_id, manga_title, chapter_info, chapter_url):
-    """Отправка уведомления пользователю через Telegram"""
-    global telegram_app
-    
-    message = f"🆕 <b>Новая глава!</b>\n\n"
-    message += f"📖 <b>{manga_title}</b>\n"
-    message += f"Глава: {chapter_info.get('chapter_number')}"
-    if chapter_info.get('chapter_volume'):
-        message += f" (Том {chapter_info.get('chapter_volume')})"
-    if chapter_info.get('chapter_name'):
-        message += f"\n{chapter_info.get('chapter_name')}"
-    message += f"\n\n🔗 <a href='{chapter_url}'>Читать на сайте</a>"
-    
-    try:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute('SELECT telegram_id FROM users WHERE id = ?', (user_id,))
-        result = c.fetchone()
-        conn.close()
-        
-        if result:
-            telegram_id = result[0]
-            await telegram_app.bot.send_message(
-                chat_id=telegram_id,
-                text=message,
-                parse_mode='HTML'
-            )
-    except Exception as e:
-        print(f"❌ Ошибка отправки уведомления: {e}")
-
 def get_chapter_pages(chapter_slug):
     """Получить страницы главы через API"""
     logger.info(f"Загрузка страниц для главы: {chapter_slug}")
@@ -2018,6 +1981,7 @@ def process_new_chapter(manga_title, manga_slug, manga_id, chapter_info, cover_u
                    chapter_id, chapter_number, chapter_volume,
                    chapter_name, chapter_slug, datetime.now()))
         conn.commit()
+        _manga_changed(manga_id)
     except Exception as e:
         print(f"❌ Ошибка сохранения манги: {e}")
     finally:
@@ -2060,8 +2024,9 @@ def process_new_chapter(manga_title, manga_slug, manga_id, chapter_info, cover_u
         if sub['is_premium']:
             # Премиум: мгновенное уведомление со ссылкой на чтение
             coro = send_telegram_notification(uid, manga_title, chapter_data, chapter_url)
-            if _bot_loop and _bot_loop.is_running():
-                asyncio.run_coroutine_threadsafe(coro, _bot_loop)
+            loop = _bot_module._bot_loop
+            if loop and loop.is_running():
+                asyncio.run_coroutine_threadsafe(coro, loop)
             else:
                 asyncio.run(coro)
         else:
@@ -2083,58 +2048,193 @@ def process_new_chapter(manga_title, manga_slug, manga_id, chapter_info, cover_u
             except Exception as e:
                 print(f"❌ Ошибка добавления в очередь: {e}")
 
+# Адаптивный опрос главной страницы: после найденных обновлений — чаще,
+# в тишине интервал растёт до POLL_MAX (в «горячие» часы релизов — до POLL_HOT_MAX)
+POLL_MIN = 30
+POLL_MAX = 300
+POLL_HOT_MAX = 60
+POLL_BACKOFF = 1.5
+# За сколько дней учитывать историю выхода глав при поиске «горячих» часов
+_RELEASE_HISTORY_DAYS = 14
+
+_poll_state = {'interval': 60, 'release_hours': None}
+
+
+def _release_hours():
+    """Гистограмма выхода глав по часам (UTC) за последние _RELEASE_HISTORY_DAYS дней."""
+    hours = _poll_state['release_hours']
+    if hours is None:
+        hours = [0] * 24
+        since = (datetime.utcnow() - timedelta(days=_RELEASE_HISTORY_DAYS)).isoformat()
+        try:
+            conn = get_db()
+            try:
+                rows = conn.execute('SELECT created_at FROM chapters WHERE created_at >= ?',
+                                    (since,)).fetchall()
+            finally:
+                conn.close()
+            for r in rows:
+                hour = str(r['created_at'])[11:13]
+                if hour.isdigit():
+                    hours[int(hour) % 24] += 1
+        except Exception as e:
+            logger.warning(f"⚠️ История релизов недоступна: {e}")
+        _poll_state['release_hours'] = hours
+    return hours
+
+
+def _is_hot_hour(hour):
+    """Час, в который глав выходит заметно больше среднего."""
+    hours = _release_hours()
+    total = sum(hours)
+    return total >= 24 and hours[hour] > total / 24 * 1.5
+
+
+def _next_poll_interval(changed):
+    """Пересчитать интервал опроса после очередной проверки."""
+    if changed:
+        interval = POLL_MIN
+    else:
+        cap = POLL_HOT_MAX if _is_hot_hour(datetime.utcnow().hour) else POLL_MAX
+        interval = min(_poll_state['interval'] * POLL_BACKOFF, cap)
+    _poll_state['interval'] = int(interval)
+    return _poll_state['interval']
+
+
+# Сколько пропущенных глав одной манги уведомлять при догоняющем прогоне
+CATCHUP_MAX_PER_MANGA = 5
+
+_watch_state = {'last_run': None}
+
+
+def _load_watermarks(conn, manga_ids):
+    """{manga_id: (chapter_id, номер главы)} из chapter_watermarks для указанных манг (один запрос)."""
+    if not manga_ids:
+        return {}
+    ph = ','.join('?' * len(manga_ids))
+    rows = conn.execute(f'SELECT manga_id, chapter_id, chapter_number FROM chapter_watermarks '
+                        f'WHERE manga_id IN ({ph})', list(manga_ids)).fetchall()
+    return {r['manga_id']: (r['chapter_id'], update_crawler.number(r['chapter_number']))
+            for r in rows}
+
+
+def _top_chapter(node_chapters):
+    """Глава с наибольшим номером из lastChapters (без номеров — первая, самая свежая)."""
+    numbered = [c for c in node_chapters if update_crawler.number(c.get('number')) is not None]
+    if not numbered:
+        return node_chapters[0] if node_chapters else None
+    return max(numbered, key=lambda c: update_crawler.number(c.get('number')))
+
+
+def _is_ahead(chapter, watermark):
+    """Глава новее водяного знака: по номеру, как в update_crawler; без номеров — по id."""
+    if watermark is None:
+        return True
+    wm_id, wm_number = watermark
+    number = update_crawler.number(chapter.get('number'))
+    if number is None or wm_number is None:
+        return chapter.get('id') != wm_id
+    return number > wm_number
+
+
+def _missed_chapters(node_chapters, watermark):
+    """Главы из lastChapters новее watermark, по возрастанию номера.
+
+    Не больше CATCHUP_MAX_PER_MANGA последних — если за время простоя вышло
+    больше глав, чем отдаёт лента.
+    """
+    missed = [c for c in node_chapters if _is_ahead(c, watermark)]
+    if all(update_crawler.number(c.get('number')) is not None for c in missed):
+        missed.sort(key=lambda c: update_crawler.number(c.get('number')))
+    else:
+        missed.reverse()  # лента отдаёт от новой к старой
+    return missed[-CATCHUP_MAX_PER_MANGA:]
+
+
 def check_new_chapters():
-    """Проверка новых глав и обновление БД всеми 21 главой из API"""
+    """Проверка новых глав на главной странице API.
+
+    Свежий ответ сравнивается с водяными знаками в chapter_watermarks — последней
+    главой каждой манги, о которой уже разосланы уведомления. Таблица переживает
+    рестарты: первый прогон после запуска догоняет всё, что вышло за время простоя
+    (все главы из lastChapters новее водяного знака), одним пакетом.
+
+    В БД пишутся и через Socket.IO рассылаются только изменившиеся позиции,
+    а для эмита используется уже полученный ответ — без второго запроса к API.
+    """
+    changed = []
     try:
         edges = api.fetch_main_page()
         if not edges:
             logger.error("❌ API не вернул данные при проверке новых глав")
             return
 
-        logger.info(f"\n[{datetime.now().strftime('%H:%M:%S')}] 🔄 Проверка... Получено {len(edges)} глав из API")
-
-        # Обрабатываем ВСЕ полученные главы (обычно 21)
-        for edge in edges:
-            node = edge.get("node") or {}
-            if not node:
-                continue
-            manga_id = node.get("id")
-            manga_slug = node.get("slug")
-
-            titles = node.get("titles") or []
-            ru_title = next((t["content"] for t in titles if t.get("lang") == "RU"), None)
-            en_title = next((t["content"] for t in titles if t.get("lang") == "EN"), None)
-            manga_title = ru_title or en_title or manga_slug
-
-            cover = node.get("cover") or {}
-            cover_url = (cover.get("original") or {}).get("url", "") or \
-                        (cover.get("preview") or {}).get("url", "")
-            
-            last_chapters = node.get("lastChapters", [])
-            
-            if not last_chapters:
-                continue
-
-            latest_chapter = last_chapters[0]
-            chapter_id = latest_chapter.get("id")
+        chapters = _parse_latest_chapters(edges)
+        nodes = {(e.get('node') or {}).get('id'): e['node'] for e in edges if e.get('node')}
+        conn = get_db()
+        try:
+            watermarks = _load_watermarks(conn, {ch['manga_id'] for ch in chapters})
+        finally:
+            conn.close()
+        # Сравнение по номеру, как у update_crawler: общий водяной знак — наибольший номер
+        tops = {ch['manga_id']: _top_chapter(nodes[ch['manga_id']].get('lastChapters') or [])
+                for ch in chapters}
+        changed = [ch for ch in chapters
+                   if tops[ch['manga_id']] and _is_ahead(tops[ch['manga_id']], watermarks.get(ch['manga_id']))]
+
+        catchup = _watch_state['last_run'] is None
+        notified = 0
+        conn = get_db()
+        try:
+            for ch in changed:
+                manga_id, latest_chapter = ch['manga_id'], ch['_chapter']
+                # Сохраняем мангу и главу в БД для отображения в последних обновлениях
+                save_manga_and_chapter_to_db(manga_id, ch['manga_slug'], ch['manga_title'],
+                                             ch['cover_url'], latest_chapter)
+
+                # Водяной знак сдвигается условным UPDATE, как в update_crawler:
+                # ту же главу, найденную crawler'ом параллельно, уведомит только один
+                claimed = update_crawler.claim(
+                    conn, manga_id, (watermarks.get(manga_id) or (None,))[0], tops[manga_id]
+                )
+                if not claimed:
+                    continue
+                # Манга без водяного знака — только регистрируем, без уведомлений
+                if manga_id not in watermarks:
+                    logger.info(f"📝 Зарегистрирована манга: {ch['manga_title']}")
+                    continue
+                missed = _missed_chapters(nodes[manga_id].get('lastChapters') or [], watermarks[manga_id])
+                for chapter in missed:
+                    logger.info(f"🆕 Новая глава обнаружена: {ch['manga_title']} - Глава {chapter.get('number')}")
+                    process_new_chapter(ch['manga_title'], ch['manga_slug'], manga_id,
+                                        chapter, ch['cover_url'])
+                notified += len(missed)
+                hours = _release_hours()
+                hours[datetime.utcnow().hour] += len(missed)
+        finally:
+            conn.close()
+        if catchup:
+            logger.info(f"⏪ Догоняющая проверка: {notified} новых глав с прошлого запуска")
+        _watch_state['last_run'] = datetime.utcnow()
 
-            # Сохраняем мангу и главу в БД для отображения в последних обновлениях
-            save_manga_and_chapter_to_db(manga_id, manga_slug, manga_title, cover_url, latest_chapter)
+        if not changed:
+            return
 
-            # Проверяем, новая ли это глава для уведомлений
-            if manga_id not in last_known_chapters:
-                last_known_chapters[manga_id] = chapter_id
-                logger.info(f"📝 Зарегистрирована манга: {manga_title}")
-            elif last_known_chapters[manga_id] != chapter_id:
-                logger.info(f"🆕 Новая глава обнаружена: {manga_title} - Глава {latest_chapter.get('number')}")
-                process_new_chapter(manga_title, manga_slug, manga_id, latest_chapter, cover_url)
-                last_known_chapters[manga_id] = chapter_id
+        logger.info(f"✅ Проверка завершена: изменилось {len(changed)} из {len(chapters)} глав")
 
-        logger.info(f"✅ Проверка завершена. Обработано {len(edges)} глав")
+        fresh = _public_chapters(chapters)
+        # Обновляем кеш последних глав тем же ответом — get_cached_recent_chapters не пойдёт в API
+        try:
+            conn = get_db()
+            conn.execute('INSERT OR REPLACE INTO cache (key, value, updated_at) VALUES (?, ?, ?)',
+                         ('recent_chapters_cache', json.dumps(fresh), datetime.now().isoformat()))
+            conn.commit()
+            conn.close()
+        except Exception as _ce:
+            logger.warning(f"⚠️ Не удалось обновить кеш последних глав: {_ce}")
 
         # Пушим свежие главы всем подключённым клиентам
         try:
-            fresh = get_recent_chapters_from_api(21)
             socketio.emit('new_chapters', fresh, namespace='/')
         except Exception as _se:
             logger.warning(f"⚠️ SocketIO emit error: {_se}")
@@ -2143,89 +2243,54 @@ def check_new_chapters():
         logger.error(f"❌ Ошибка в check_new_chapters: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        _next_poll_interval(bool(changed))
+
+# ==================== ФОНОВЫЕ ЗАДАЧИ ====================
+
+def _run_daily_digest():
+    """Дайджест для пользователей, у которых digest_hour совпадает с текущим часом МСК."""
+    now_msk = datetime.utcnow() + timedelta(hours=3)
+    coro = send_daily_digest(hour=now_msk.hour)
+    loop = _bot_module._bot_loop
+    if loop and loop.is_running():
+        asyncio.run_coroutine_threadsafe(coro, loop).result(timeout=600)
+    else:
+        asyncio.run(coro)
+
+
+# Расписания cron — в UTC
+background_scheduler = scheduler.Scheduler(max_workers=4)
+background_scheduler.add('check_new_chapters', check_new_chapters,
+                         interval=lambda: _poll_state['interval'], run_on_start=True)
+# Тайтлы из подписок, выпавшие из ленты главной, — со своим бюджетом запросов
+background_scheduler.add('subscription_crawler', lambda: update_crawler.crawl(api, process_new_chapter),
+                         interval=60, jitter=10)
+background_scheduler.add('expiry_sweep', sweeper.sweep_expired, interval=60, jitter=5)
+# Каждый час: send_daily_digest сам отбирает пользователей по digest_hour и last_digest_date
+background_scheduler.add('daily_digest', _run_daily_digest, cron='0 * * * *', run_on_start=True)
+background_scheduler.add('weekly_trophy', award_weekly_collection_trophy, cron='0 0 * * 1')
+background_scheduler.add('leaderboard_rebuild', lambda: leaderboard.rebuild(force=True),
+                         interval=leaderboard.REBUILD_INTERVAL, jitter=30)
+# Ночью по МСК (01:00 UTC = 04:00 МСК)
+background_scheduler.add('reconcile_counters', reconcile_user_counters, cron='0 1 * * *')
+background_scheduler.add('xp_log_compact', xp_ledger.compact, cron='15 1 * * *')
+# Поисковый индекс в памяти (SQLite): сборка при старте и пересборка для записей вне процесса
+if search_index.supported():
+    background_scheduler.add('search_index_rebuild', search_index.rebuild,
+                             interval=search_index.REBUILD_INTERVAL, jitter=60, run_on_start=True)
+background_scheduler.add('suggest_rebuild', suggest_store.rebuild,
+                         interval=suggest_store.REBUILD_INTERVAL, jitter=30, run_on_start=True)
+background_scheduler.add('search_stats_flush', search_stats.flush,
+                         interval=search_stats.FLUSH_INTERVAL, jitter=5)
+background_scheduler.add('search_history_prune', search_stats.prune_history, cron='30 1 * * *')
+background_scheduler.add('search_optimize', search_engine.optimize, cron='45 1 * * *')
+
 
 def background_checker():
-    """Фоновый процесс проверки"""
+    """Запуск фоновых задач (имя сохранено для gunicorn.conf.py)."""
     logger.info("🤖 Фоновый мониторинг запущен!")
-    check_new_chapters()
-    _last_digest_hour_key = None  # "YYYY-MM-DD-HH"
-
-    while True:
-        try:
-            time.sleep(60)  # Проверка каждую минуту
-            check_new_chapters()
-
-            # Ежедневный дайджест: запускаем каждый час для пользователей с matching digest_hour
-            now_msk = datetime.utcnow() + timedelta(hours=3)
-            hour_key = now_msk.strftime('%Y-%m-%d-%H')
-            if _last_digest_hour_key != hour_key:
-                _last_digest_hour_key = hour_key
-                coro = send_daily_digest(hour=now_msk.hour)
-                if _bot_loop and _bot_loop.is_running():
-                    asyncio.run_coroutine_threadsafe(coro, _bot_loop)
-                else:
-                    try:
-                        asyncio.run(coro)
-                    except Exception:
-                        pass
-
-            # Трофей коллекции недели — по понедельникам в полночь
-            if datetime.utcnow().weekday() == 0 and datetime.utcnow().hour == 0:
-                award_weekly_collection_trophy()
-
-            # Проверяем истёкшие Premium подписки
-            try:
-                now_iso = datetime.utcnow().isoformat()
-                conn_bg = get_db()
-                c_bg = conn_bg.cursor()
-                c_bg.execute(
-                    'SELECT id FROM users WHERE is_premium=1 AND premium_expires_at IS NOT NULL AND premium_expires_at < ?',
-                    (now_iso,)
-                )
-                expired = c_bg.fetchall()
-                for row in expired:
-                    c_bg.execute('UPDATE users SET is_premium=0, premium_expires_at=NULL WHERE id=?', (row['id'],))
-                    _revoke_premium_loans(c_bg, row['id'])
-                if expired:
-                    conn_bg.commit()
-                    logger.info(f"⏰ Premium истёк у {len(expired)} пользователей")
-                conn_bg.close()
-            except Exception as e_prem:
-                logger.error(f"❌ Ошибка проверки Premium: {e_prem}")
-
-            # Удаляем истёкшие временные предметы
-            try:
-                conn_tmp = get_db()
-                now_iso = datetime.utcnow().isoformat()
-                exp_rows = conn_tmp.execute(
-                    '''SELECT ui.id, ui.user_id, ui.item_id, si.type, si.name
-                       FROM user_items ui JOIN shop_items si ON ui.item_id = si.id
-                       WHERE ui.expires_at IS NOT NULL AND ui.expires_at < ?''',
-                    (now_iso,)
-                ).fetchall()
-                col_map = {'frame': 'frame_item_id', 'badge': 'badge_item_id', 'title': 'title_item_id'}
-                for row in exp_rows:
-                    col = col_map.get(row['type'])
-                    if col:
-                        conn_tmp.execute(
-                            f'UPDATE user_profile SET {col}=NULL WHERE user_id=? AND {col}=?',
-                            (row['user_id'], row['item_id'])
-                        )
-                    conn_tmp.execute('DELETE FROM user_items WHERE id=?', (row['id'],))
-                if exp_rows:
-                    conn_tmp.commit()
-                conn_tmp.close()
-                for row in exp_rows:
-                    create_site_notification(
-                        row['user_id'], 'item_expired',
-                        f'Предмет истёк: {row["name"]}',
-                        'Временный предмет удалён из инвентаря', '/shop'
-                    )
-            except Exception as e_tmp:
-                logger.error(f"❌ Ошибка очистки временных предметов: {e_tmp}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка в background_checker: {e}")
-            time.sleep(60)
+    background_scheduler.start()
 
 # ==================== ЗАПУСК ====================
 
@@ -2241,9 +2306,8 @@ if __name__ == "__main__":
         print("ℹ️  PostgreSQL mode: init_db() пропускается")
         init_pg_schema()
     
-    # Запуск фонового процесса проверки новых глав
-    checker_thread = threading.Thread(target=background_checker, daemon=True)
-    checker_thread.start()
+    # Запуск фоновых задач (проверка глав, дайджест, очистка, ...)
+    background_checker()
     
     # Запуск Telegram бота (теперь он сам создает поток)
     run_telegram_bot()
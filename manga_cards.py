@@ -0,0 +1,186 @@
+"""
+manga_cards.py — кеш «карточек» манги для списков.
+
+api_catalog, поиск, главная и коллекции каждый раз заново выбирали одни и те же
+поля manga (slug, название, обложка, тип, статус, score, число глав) — каждый
+своим SELECT с JOIN. Теперь списки берут из SQL только упорядоченные manga_id,
+а карточки собираются здесь:
+
+  - get_many(ids) — карточки в порядке ids: сначала LRU в памяти процесса
+    (LOCAL_SIZE записей, живут LOCAL_TTL секунд), затем Redis (одним MGET,
+    если Redis доступен), остаток — из БД пачками по CHUNK через
+    WHERE manga_id IN (...); найденное раскладывается обратно по уровням
+  - карточка — словарь CARD_COLUMNS (даты строками, описание обрезано),
+    в Redis хранится как JSON под ключом card:<manga_id> на REDIS_TTL
+  - invalidate(manga_id) вызывается из всех записей manga в main
+    (_manga_changed); счётчик просмотров карточку не сбрасывает — он
+    догоняет через TTL
+
+Redis подключается через configure() из main, без него работает только LRU.
+"""
+
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+CARD_COLUMNS = ('manga_id', 'manga_slug', 'manga_title', 'manga_type', 'manga_status',
+                'cover_url', 'rating', 'score', 'views', 'chapters_count', 'last_updated',
+                'last_chapter_number', 'last_chapter_slug', 'description', 'tags')
+# Сколько символов описания попадает в карточку
+DESCRIPTION_LEN = 160
+
+LOCAL_SIZE = 5000
+# Короткий срок в памяти: другие воркеры сбрасывают только Redis
+LOCAL_TTL = 30
+REDIS_TTL = 600
+# Параметров в одном IN (...)
+CHUNK = 500
+
+_SELECT = ', '.join(f'SUBSTR(description, 1, {DESCRIPTION_LEN}) AS description'
+                    if c == 'description' else c for c in CARD_COLUMNS)
+_PREFIX = 'card:'
+
+_lock = threading.Lock()
+_local = OrderedDict()   # manga_id → (истекает, карточка)
+_redis = None
+_stats = {'local_hits': 0, 'redis_hits': 0, 'db_reads': 0, 'invalidations': 0}
+
+
+def configure(redis_client):
+    """Второй уровень кеша в Redis (вызывается из main)."""
+    global _redis
+    _redis = redis_client
+
+
+def _card(row):
+    card = dict(row)
+    if card.get('last_updated') is not None:
+        card['last_updated'] = str(card['last_updated'])
+    return card
+
+
+def _local_get(ids):
+    now = time.monotonic()
+    found = {}
+    with _lock:
+        for i in ids:
+            entry = _local.get(i)
+            if entry is None:
+                continue
+            if entry[0] < now:
+                del _local[i]
+                continue
+            _local.move_to_end(i)
+            found[i] = entry[1]
+    return found
+
+
+def _local_put(cards):
+    expires = time.monotonic() + LOCAL_TTL
+    with _lock:
+        for i, card in cards.items():
+            _local[i] = (expires, card)
+            _local.move_to_end(i)
+        while len(_local) > LOCAL_SIZE:
+            _local.popitem(last=False)
+
+
+def _redis_get(ids):
+    if _redis is None or not ids:
+        return {}
+    try:
+        values = _redis.mget([_PREFIX + i for i in ids])
+    except Exception as e:
+        logger.warning(f"manga_cards: Redis недоступен: {e}")
+        return {}
+    return {i: json.loads(v) for i, v in zip(ids, values) if v is not None}
+
+
+def _redis_put(cards):
+    if _redis is None or not cards:
+        return
+    try:
+        pipe = _redis.pipeline(transaction=False)
+        for i, card in cards.items():
+            pipe.setex(_PREFIX + i, REDIS_TTL, json.dumps(card, ensure_ascii=False))
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"manga_cards: запись в Redis не удалась: {e}")
+
+
+def _db_get(ids):
+    found = {}
+    conn = get_db()
+    try:
+        for start in range(0, len(ids), CHUNK):
+            chunk = ids[start:start + CHUNK]
+            rows = conn.execute(
+                f"SELECT {_SELECT} FROM manga WHERE manga_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for r in rows:
+                found[r['manga_id']] = _card(r)
+    finally:
+        conn.close()
+    return found
+
+
+def get_many(ids):
+    """Карточки в порядке ids (копии словарей); удалённые тайтлы пропускаются."""
+    ids = [str(i) for i in ids]
+    if not ids:
+        return []
+    cards = _local_get(ids)
+    _stats['local_hits'] += len(cards)
+
+    missing = list(dict.fromkeys(i for i in ids if i not in cards))
+    if missing:
+        from_redis = _redis_get(missing)
+        _stats['redis_hits'] += len(from_redis)
+        cards.update(from_redis)
+        missing = [i for i in missing if i not in from_redis]
+        from_db = _db_get(missing) if missing else {}
+        _stats['db_reads'] += len(from_db)
+        cards.update(from_db)
+        _redis_put(from_db)
+        _local_put({**from_redis, **from_db})
+
+    return [dict(cards[i]) for i in ids if i in cards]
+
+
+def hydrate(rows):
+    """Строки списка (manga_id + свои поля, например added_at) → карточки с этими полями."""
+    extra = {r['manga_id']: dict(r) for r in rows}
+    cards = get_many(list(extra))
+    for card in cards:
+        card.update(extra[card['manga_id']])
+    return cards
+
+
+def get(manga_id):
+    cards = get_many([manga_id])
+    return cards[0] if cards else None
+
+
+def invalidate(manga_id):
+    """Сбросить карточку после записи в manga."""
+    manga_id = str(manga_id)
+    with _lock:
+        _local.pop(manga_id, None)
+    _stats['invalidations'] += 1
+    if _redis is not None:
+        try:
+            _redis.delete(_PREFIX + manga_id)
+        except Exception as e:
+            logger.warning(f"manga_cards: Redis недоступен: {e}")
+
+
+def status():
+    return dict(_stats, local_size=len(_local), redis_enabled=_redis is not None,
+                local_ttl=LOCAL_TTL, redis_ttl=REDIS_TTL)
@@ -0,0 +1,179 @@
+"""
+media.py — потоковая конвертация анимаций (GIF / WebP) через ffmpeg.
+
+Содержит:
+  - iter_frames()   — покадровый генератор RGBA-кадров Pillow
+  - to_webm()       — GIF/WebP → WebM (VP9); WebP кадры идут в stdin ffmpeg как rawvideo
+  - resize_gif()    — уменьшение анимированного GIF без списка кадров в памяти
+
+Ни одна из функций не собирает список всех кадров: пик памяти ограничен
+одним декодированным кадром (плюс буферы самого ffmpeg).
+"""
+
+import os
+import math
+import time
+import logging
+import subprocess
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Общие параметры VP9-кодирования (раньше копировались в main / routes / convert_animations)
+VP9_ARGS = [
+    '-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '35',
+    '-cpu-used', '5', '-deadline', 'realtime',
+    '-auto-alt-ref', '0', '-an',
+]
+
+# yuv420p требует чётных размеров кадра
+_EVEN_SCALE = 'scale=trunc(iw/2)*2:trunc(ih/2)*2'
+
+# Минимальный шаг кадра в мс (50 fps) — защищает от «1 мс» длительностей в битых файлах
+_MIN_FRAME_MS = 20
+_DEFAULT_FRAME_MS = 50
+
+
+def _fit_size(width, height, max_w):
+    """Размер кадра, вписанный по ширине в max_w (без увеличения)."""
+    if not max_w or width <= max_w:
+        return width, height
+    ratio = max_w / width
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+
+def iter_frames(img, size=None, default_duration=_DEFAULT_FRAME_MS):
+    """Генератор (rgba_frame, duration_ms) — в памяти держится только текущий кадр."""
+    from PIL import Image, ImageSequence
+
+    for frame in ImageSequence.Iterator(img):
+        rgba = frame.convert('RGBA')
+        if size and rgba.size != size:
+            rgba = rgba.resize(size, Image.LANCZOS)
+        yield rgba, frame.info.get('duration') or default_duration
+
+
+def _frame_step(img):
+    """Шаг кадра (мс) = НОД длительностей. Проход только по метаданным, кадры не копируются."""
+    from PIL import ImageSequence
+
+    step = 0
+    for frame in ImageSequence.Iterator(img):
+        step = math.gcd(step, int(frame.info.get('duration') or _DEFAULT_FRAME_MS))
+    return max(step or _DEFAULT_FRAME_MS, _MIN_FRAME_MS)
+
+
+def _run_ffmpeg(cmd, dst, timeout, feed=None):
+    """Запускает ffmpeg, пишет результат во временный файл и атомарно переименовывает в dst.
+
+    feed — необязательная функция(stdin, deadline), которая пишет сырые кадры в stdin.
+    Возвращает (ok, err_tail).
+    """
+    # Уникальное имя: pid не различает потоки одного воркера (gthread)
+    fd, tmp_dst = tempfile.mkstemp(dir=os.path.dirname(dst) or '.',
+                                   prefix=os.path.basename(dst) + '.', suffix='.part')
+    os.close(fd)
+    cmd = cmd + [tmp_dst]
+    deadline = time.monotonic() + timeout
+    # stderr — во временный файл, а не в PIPE: иначе при записи в stdin возможен deadlock
+    with tempfile.TemporaryFile() as err_f:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=err_f,
+        )
+        try:
+            if feed:
+                try:
+                    feed(proc.stdin, deadline)
+                except BrokenPipeError:
+                    pass  # ffmpeg упал — причина будет в stderr
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except OSError:
+                        pass
+            proc.wait(timeout=max(1, deadline - time.monotonic()))
+        except (subprocess.TimeoutExpired, TimeoutError):
+            proc.kill()
+            proc.wait()
+            _unlink(tmp_dst)
+            return False, 'ffmpeg timeout'
+        except Exception:
+            proc.kill()
+            proc.wait()
+            _unlink(tmp_dst)
+            raise
+        err_f.seek(0)
+        err = err_f.read().decode(errors='replace')
+
+    if proc.returncode == 0 and os.path.exists(tmp_dst):
+        # mkstemp создаёт файл 0600 — статику должен читать веб-сервер
+        os.chmod(tmp_dst, 0o644)
+        os.replace(tmp_dst, dst)
+        return True, ''
+    _unlink(tmp_dst)
+    return False, err[-300:]
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _webp_to_webm(src, dst, max_w=None, timeout=300):
+    """Animated WebP → WebM: кадры по одному уходят в stdin ffmpeg (rawvideo rgba)."""
+    from PIL import Image
+
+    with Image.open(src) as img:
+        size = _fit_size(img.width, img.height, max_w)
+        step = _frame_step(img)
+
+        cmd = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgba',
+            '-s', f'{size[0]}x{size[1]}',
+            '-framerate', f'1000/{step}',
+            '-i', 'pipe:0',
+            '-vf', _EVEN_SCALE,
+            *VP9_ARGS, '-f', 'webm',
+        ]
+
+        def _feed(stdin, deadline):
+            for rgba, duration in iter_frames(img, size):
+                if time.monotonic() > deadline:
+                    raise TimeoutError
+                data = rgba.tobytes()
+                # Переменная длительность кадров → повтор кадра на постоянном fps
+                for _ in range(max(1, round(duration / step))):
+                    stdin.write(data)
+
+        return _run_ffmpeg(cmd, dst, timeout, feed=_feed)
+
+
+def to_webm(src, dst, max_w=None, timeout=300):
+    """Конвертирует GIF/WebP в WebM. GIF ffmpeg читает сам, WebP — через покадровый pipe.
+
+    Returns:
+        tuple[bool, str]: (успех, хвост stderr ffmpeg при ошибке)
+    """
+    ext = src.rsplit('.', 1)[-1].lower()
+    if ext == 'webp':
+        return _webp_to_webm(src, dst, max_w=max_w, timeout=timeout)
+    vf = f'scale={max_w}:-2' if max_w else _EVEN_SCALE
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', src,
+           '-vf', vf, *VP9_ARGS, '-f', 'webm']
+    return _run_ffmpeg(cmd, dst, timeout)
+
+
+def resize_gif(src, dst, max_w, timeout=120):
+    """Уменьшает анимированный GIF по ширине. Палитра строится покадрово
+    (stats_mode=single), поэтому ffmpeg не буферизует всю анимацию."""
+    vf = (f'scale={max_w}:-1:flags=lanczos,split[a][b];'
+          f'[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1')
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', src,
+           '-filter_complex', vf, '-loop', '0', '-f', 'gif']
+    return _run_ffmpeg(cmd, dst, timeout)
@@ -1,24 +1,42 @@
 # -*- coding: utf-8 -*-
 """
-Standalone script to populate the `chapters` table for all manga in manga.db.
+Standalone script to populate the `chapters` table for all manga in the DB.
+
+Works on both backends through database.get_db() (DATABASE_URL → PostgreSQL,
+otherwise manga.db next to this script).
+
+Engine:
+  - a pool of --workers threads sharing one global request budget (--rps)
+  - progress is checkpointed per manga in `chapter_sync_checkpoints`;
+    a rerun skips manga synced within the last --max-age hours
+    (use --restart to start over)
+  - per-manga incremental sync: chapter pages are read newest-first and the
+    walk stops at the first page whose chapters are all already stored
+    (use --full for a complete walk)
+  - periodic throughput / ETA reports
 
 Usage examples:
     python parse_all_chapters.py
+    python parse_all_chapters.py --workers 8 --rps 10
     python parse_all_chapters.py --skip-existing --limit 100
-    python parse_all_chapters.py --only-missing --delay 1.0
-    python parse_all_chapters.py --resume some-manga-id
+    python parse_all_chapters.py --only-missing --full
+    python parse_all_chapters.py --max-age 6
+    python parse_all_chapters.py --restart
 """
 
 import argparse
 import logging
 import os
-import sqlite3
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 
-# Allow importing senkuro_api from the same directory
-sys.path.insert(0, os.path.dirname(__file__))
+# Allow importing project modules from the same directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from senkuro_api import SenkuroAPI
+from database import get_db, existing_chapters, upsert_chapters
 
 logging.basicConfig(
     level=logging.INFO,
@@ -27,234 +45,256 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+MAX_PAGES = 200  # safety cap per manga (~20k chapters)
+
+
+# ── Request budget ────────────────────────────────────────────────────────────
+
+class RateLimiter:
+    """Token bucket shared by all workers: at most `rps` API requests per second."""
+
+    def __init__(self, rps):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+        self.requests = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+            self.requests += 1
+        if slot > now:
+            time.sleep(slot - now)
+
 
 # ── DB helpers ────────────────────────────────────────────────────────────────
 
-def open_db(db_path):
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA synchronous=NORMAL")
+def ensure_checkpoint_table(conn):
     conn.execute("""
-        CREATE TABLE IF NOT EXISTS chapters (
-            id              INTEGER PRIMARY KEY AUTOINCREMENT,
-            manga_id        TEXT NOT NULL,
-            chapter_id      TEXT UNIQUE NOT NULL,
-            chapter_slug    TEXT NOT NULL,
-            chapter_number  TEXT,
-            chapter_volume  TEXT,
-            chapter_name    TEXT,
-            chapter_url     TEXT,
-            pages_json      TEXT,
-            pages_count     INTEGER DEFAULT 0,
-            created_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (manga_id) REFERENCES manga(manga_id)
+        CREATE TABLE IF NOT EXISTS chapter_sync_checkpoints (
+            manga_id   TEXT PRIMARY KEY,
+            status     TEXT NOT NULL,
+            chapters   INTEGER DEFAULT 0,
+            error      TEXT,
+            synced_at  TIMESTAMP
         )
     """)
-    conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_chapters_manga_number
-        ON chapters(manga_id, chapter_number)
-    """)
     conn.commit()
-    return conn
-
-
-def has_chapters(conn, manga_id):
-    row = conn.execute(
-        "SELECT 1 FROM chapters WHERE manga_id = ? LIMIT 1", (manga_id,)
-    ).fetchone()
-    return row is not None
-
-
-def save_chapters(conn, chapters, manga_id):
-    if not chapters:
-        return 0
-    rows = [
-        (
-            manga_id,
-            ch["chapter_id"],
-            ch["chapter_slug"],
-            ch["chapter_number"],
-            ch["chapter_volume"],
-            ch["chapter_name"],
-            ch["chapter_url"],
-            ch["created_at"],
-        )
-        for ch in chapters
-    ]
-    conn.executemany(
-        """INSERT OR IGNORE INTO chapters
-           (manga_id, chapter_id, chapter_slug, chapter_number,
-            chapter_volume, chapter_name, chapter_url, created_at)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-        rows,
-    )
+
+
+def save_checkpoint(conn, manga_id, status, chapters=0, error=None):
     conn.execute(
-        "UPDATE manga SET chapters_count = ? WHERE manga_id = ?",
-        (len(chapters), manga_id),
+        """INSERT INTO chapter_sync_checkpoints (manga_id, status, chapters, error, synced_at)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT(manga_id) DO UPDATE
+           SET status = excluded.status, chapters = excluded.chapters,
+               error = excluded.error, synced_at = excluded.synced_at""",
+        (manga_id, status, chapters, error, datetime.utcnow().isoformat()),
     )
     conn.commit()
-    return len(chapters)
 
 
-# ── Chapter fetching ──────────────────────────────────────────────────────────
+def select_manga(conn, args):
+    # 'done' older than --max-age is stale: the manga gets an incremental sync again
+    fresh_since = (datetime.utcnow() - timedelta(hours=args.max_age)).isoformat()
+    where = ["NOT EXISTS (SELECT 1 FROM chapter_sync_checkpoints cp "
+             "WHERE cp.manga_id = m.manga_id AND cp.status = 'done' AND cp.synced_at >= ?)"]
+    if args.only_missing:
+        where.append("m.chapters_count = 0")
+    if args.skip_existing:
+        where.append("NOT EXISTS (SELECT 1 FROM chapters c WHERE c.manga_id = m.manga_id)")
+    sql = (f"SELECT m.manga_id, m.manga_slug, m.branch_id FROM manga m "
+           f"WHERE {' AND '.join(where)} ORDER BY m.id")
+    if args.limit:
+        sql += f" LIMIT {int(args.limit)}"
+    return [dict(r) for r in conn.execute(sql, (fresh_since,)).fetchall()]
+
+
+# ── Per-manga sync ────────────────────────────────────────────────────────────
+
+def fetch_chapters(api, limiter, branch_id, manga_slug, existing, incremental):
+    """Read chapter pages newest-first; stop at a fully known page when incremental.
 
-def paginate_all_chapters(api, branch_id, manga_id, manga_slug, page_delay):
+    Returns (chapters, complete) — complete is True when the last page was reached.
+    """
     chapters = []
     after = None
-    page_num = 0
-
-    while True:
-        page_num += 1
+    for page_num in range(1, MAX_PAGES + 1):
+        limiter.wait()
         result = api.fetch_manga_chapters_page(branch_id, after)
         if not result:
+            if page_num > 1:
+                # A hole mid-walk: fail the checkpoint so the next run retries
+                raise RuntimeError(f"empty response on page {page_num}")
             logger.warning(f"  empty response on page {page_num} for {manga_slug}")
-            break
-
-        page_info = result.get("pageInfo", {})
-        edges = result.get("edges", [])
+            return chapters, False
 
-        for edge in edges:
+        page_known = True
+        for edge in result.get("edges", []):
             node = edge.get("node") or {}
             if not node:
                 continue
+            chapter_id = node.get("id")
+            if chapter_id not in existing or str(existing[chapter_id]) != str(node.get("number")):
+                page_known = False
             chapters.append({
-                "chapter_id":     node.get("id"),
+                "chapter_id":     chapter_id,
                 "chapter_slug":   node.get("slug"),
                 "chapter_number": node.get("number"),
                 "chapter_volume": node.get("volume"),
                 "chapter_name":   node.get("name"),
                 "created_at":     node.get("createdAt"),
-                "chapter_url":    f"/read/{manga_slug}/{node.get('slug')}",
+                "manga_slug":     manga_slug,
             })
 
-        has_next = page_info.get("hasNextPage", False)
+        page_info = result.get("pageInfo", {})
         after = page_info.get("endCursor")
-
-        logger.debug(f"  page {page_num}: {len(edges)} chapters, hasNextPage={has_next}")
-
-        if not has_next or not after:
-            break
-        if page_delay > 0:
-            time.sleep(page_delay)
-
-    return chapters
+        if incremental and page_known:
+            return chapters, False
+        if not page_info.get("hasNextPage") or not after:
+            return chapters, True
+    return chapters, False
+
+
+def sync_manga(api, limiter, row, full):
+    """Sync one manga. Returns (new chapters, updated chapters)."""
+    manga_id, manga_slug, branch_id = row["manga_id"], row["manga_slug"], row["branch_id"]
+    conn = get_db()
+    try:
+        if not branch_id:
+            limiter.wait()
+            details = api.fetch_manga(manga_slug)
+            branch_id = details.get("branch_id") if details else None
+            if not branch_id:
+                raise RuntimeError("no branch_id")
+            conn.execute("UPDATE manga SET branch_id = ? WHERE manga_id = ?", (branch_id, manga_id))
+            conn.commit()
+
+        existing = existing_chapters(conn, manga_id)
+        chapters, complete = fetch_chapters(api, limiter, branch_id, manga_slug, existing,
+                                            incremental=bool(existing) and not full)
+        inserted, updated = upsert_chapters(conn, manga_id, chapters, existing)
+        total = len(existing.keys() | {ch["chapter_id"] for ch in chapters})
+        if complete:
+            # After an early stop the local union may still have holes — keep the known count
+            conn.execute("UPDATE manga SET chapters_count = ? WHERE manga_id = ?", (total, manga_id))
+        save_checkpoint(conn, manga_id, "done", total)
+        return inserted, updated
+    except Exception as e:
+        # On PostgreSQL the failed statement aborted the transaction
+        conn.rollback()
+        save_checkpoint(conn, manga_id, "failed", error=str(e)[:500])
+        raise
+    finally:
+        conn.close()
+
+
+# ── Progress ──────────────────────────────────────────────────────────────────
+
+class Progress:
+    def __init__(self, total, limiter, every):
+        self.total = total
+        self.limiter = limiter
+        self.every = every
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.done = self.failed = self.inserted = self.updated = 0
+
+    def add(self, inserted=0, updated=0, failed=False):
+        self.done += 1
+        self.failed += int(failed)
+        self.inserted += inserted
+        self.updated += updated
+        now = time.monotonic()
+        if now - self.last_report >= self.every or self.done == self.total:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now=None):
+        elapsed = max((now or time.monotonic()) - self.started, 1e-6)
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if rate else 0
+        logger.info(
+            f"[{self.done}/{self.total}] {rate * 60:.1f} manga/min, "
+            f"{self.limiter.requests / elapsed:.1f} req/s, "
+            f"+{self.inserted} new / {self.updated} updated chapters, "
+            f"{self.failed} failed, ETA {eta / 60:.1f} min"
+        )
 
 
 # ── Main ──────────────────────────────────────────────────────────────────────
 
 def parse_args():
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    default_db = os.path.join(script_dir, "manga.db")
-
     p = argparse.ArgumentParser(description="Populate chapters table for all manga in DB")
-    p.add_argument("--db",            default=default_db, help="Path to manga.db")
-    p.add_argument("--delay",         type=float, default=0.5,
-                   help="Seconds between requests per manga (default 0.5)")
-    p.add_argument("--page-delay",    type=float, default=0.2,
-                   help="Seconds between chapter pages within one manga (default 0.2)")
+    p.add_argument("--workers",       type=int, default=4,
+                   help="Parallel workers (default 4)")
+    p.add_argument("--rps",           type=float, default=5.0,
+                   help="Global API request budget, requests per second (default 5)")
+    p.add_argument("--full",          action="store_true",
+                   help="Walk all chapter pages instead of stopping at known chapters")
     p.add_argument("--skip-existing", action="store_true",
                    help="Skip manga that already have chapters in DB")
     p.add_argument("--only-missing",  action="store_true",
                    help="Only process manga with chapters_count = 0 in manga table")
     p.add_argument("--limit",         type=int, default=0,
                    help="Stop after N manga processed (0 = no limit)")
-    p.add_argument("--resume",        default=None,
-                   help="Start from this manga_id (skip all rows before it in ordered list)")
+    p.add_argument("--max-age",       type=float, default=24.0,
+                   help="Re-sync manga whose last successful sync is older than N hours (default 24)")
+    p.add_argument("--restart",       action="store_true",
+                   help="Clear checkpoints and process every manga again")
+    p.add_argument("--report-every",  type=float, default=10.0,
+                   help="Seconds between progress reports (default 10)")
     return p.parse_args()
 
 
 def main():
     args = parse_args()
+    # get_db() opens manga.db relative to the working directory, like the app
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    conn = get_db()
+    try:
+        ensure_checkpoint_table(conn)
+        if args.restart:
+            conn.execute("DELETE FROM chapter_sync_checkpoints")
+            conn.commit()
+            logger.info("Checkpoints cleared")
+        rows = select_manga(conn, args)
+    finally:
+        conn.close()
+
+    logger.info(f"Found {len(rows)} manga rows to process "
+                f"({args.workers} workers, {args.rps} req/s)")
+    if not rows:
+        return
 
-    if not os.path.exists(args.db):
-        logger.error(f"DB not found: {args.db}")
-        sys.exit(1)
-
-    conn = open_db(args.db)
     api = SenkuroAPI()
-
-    # Build query
-    if args.only_missing:
-        rows = conn.execute(
-            "SELECT manga_id, manga_slug, branch_id FROM manga WHERE chapters_count = 0 ORDER BY id"
-        ).fetchall()
-    else:
-        rows = conn.execute(
-            "SELECT manga_id, manga_slug, branch_id FROM manga ORDER BY id"
-        ).fetchall()
-
-    total_manga = len(rows)
-    logger.info(f"Found {total_manga} manga rows to process")
-
-    # Apply --resume: skip until we see the given manga_id
-    if args.resume:
-        ids = [r["manga_id"] for r in rows]
-        if args.resume in ids:
-            start = ids.index(args.resume)
-            rows = rows[start:]
-            logger.info(f"Resuming from manga_id={args.resume} ({len(rows)} remaining)")
-        else:
-            logger.warning(f"--resume manga_id={args.resume!r} not found, starting from beginning")
-
-    processed = 0
-    total_chapters_saved = 0
-    start_time = time.time()
-
-    for idx, row in enumerate(rows, 1):
-        manga_id   = row["manga_id"]
-        manga_slug = row["manga_slug"]
-        branch_id  = row["branch_id"]
-
-        # --skip-existing
-        if args.skip_existing and has_chapters(conn, manga_id):
-            logger.info(f"[{idx}/{len(rows)}] {manga_slug} — skipped (already has chapters)")
-            continue
-
-        # Resolve branch_id if missing
-        if not branch_id:
-            logger.info(f"[{idx}/{len(rows)}] {manga_slug} — fetching branch_id from API...")
-            details = api.fetch_manga(manga_slug)
-            if not details:
-                logger.warning(f"  Could not fetch details for {manga_slug}, skipping")
-                continue
-            branch_id = details.get("branch_id")
-            if branch_id:
-                conn.execute(
-                    "UPDATE manga SET branch_id = ? WHERE manga_id = ?",
-                    (branch_id, manga_id),
-                )
-                conn.commit()
-
-        if not branch_id:
-            logger.warning(f"[{idx}/{len(rows)}] {manga_slug} — no branch_id, skipping")
-            continue
-
-        # Fetch all chapters
-        chapters = paginate_all_chapters(
-            api, branch_id, manga_id, manga_slug, args.page_delay
-        )
-        saved = save_chapters(conn, chapters, manga_id)
-        total_chapters_saved += saved
-        processed += 1
-
-        logger.info(f"[{idx}/{len(rows)}] {manga_slug} — {saved} chapters saved")
-
-        if args.limit and processed >= args.limit:
-            logger.info(f"Reached --limit {args.limit}, stopping")
-            break
-
-        if args.delay > 0:
-            time.sleep(args.delay)
-
-    conn.close()
-
-    elapsed = time.time() - start_time
-    logger.info(
-        f"\nDone. Processed {processed} manga, "
-        f"{total_chapters_saved} chapters saved, "
-        f"elapsed {elapsed:.1f}s"
-    )
+    limiter = RateLimiter(args.rps)
+    progress = Progress(len(rows), limiter, args.report_every)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(sync_manga, api, limiter, row, args.full): row for row in rows}
+        try:
+            for future in as_completed(futures):
+                row = futures[future]
+                try:
+                    inserted, updated = future.result()
+                    logger.debug(f"{row['manga_slug']} — +{inserted} new, {updated} updated")
+                    progress.add(inserted, updated)
+                except Exception as e:
+                    logger.warning(f"{row['manga_slug']} — failed: {e}")
+                    progress.add(failed=True)
+        except KeyboardInterrupt:
+            logger.info("Interrupted — finished manga are checkpointed, rerun to resume")
+            for f in futures:
+                f.cancel()
+            raise
+
+    progress.report()
+    logger.info(f"Done. {progress.done - progress.failed} manga synced, "
+                f"{progress.inserted} chapters added, {progress.failed} failed")
 
 
 if __name__ == "__main__":
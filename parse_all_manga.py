@@ -3,41 +3,58 @@
 Скрипт полного парсинга каталога манг Senkuro.
 
 Использование:
-    python parse_all_manga.py [--db manga.db] [--order POPULARITY_SCORE]
-                              [--delay 0.3] [--no-hentai] [--batch 50]
-                              [--resume]
+    python parse_all_manga.py [--order POPULARITY_SCORE] [--delay 0.3]
+                              [--hentai] [--update] [--changed-only]
+                              [--limit N]
 
-По умолчанию запускается с параметрами из DEFAULT_* ниже.
+По умолчанию запускается с параметрами из DEFAULT_* ниже. БД — та же, что у
+приложения (database.get_db): PostgreSQL при заданном DATABASE_URL, иначе
+manga.db рядом со скриптом.
 
 Что делает:
-  1. Итерирует все страницы fetchMangas через SenkuroAPI.fetch_all_mangas()
-  2. Каждую мангу вставляет в таблицу manga (INSERT OR IGNORE — не трогает
-     уже существующие записи) или обновляет через INSERT OR REPLACE
-     если передан флаг --update
-  3. Показывает прогресс: номер страницы, кол-во записей, скорость.
+  1. Поток-производитель итерирует страницы fetchMangas через
+     SenkuroAPI.fetch_all_mangas() и складывает манги в ограниченную очередь —
+     загрузка следующих страниц идёт параллельно с записью (и пауза --delay
+     больше не задерживает запись)
+  2. Потребитель пишет манги пачками в крупных транзакциях; размер пачки
+     подбирается автоматически под целевое время записи (BatchTuner)
+  3. Без --update новые манги вставляются, существующие не трогаются;
+     с --update — upsert колонок каталога (остальные поля, например
+     description и branch_id, сохраняются)
+  4. --changed-only — перед записью пачка сравнивается с БД, неизменённые
+     строки отбрасываются (подразумевает --update)
+  5. Показывает прогресс: кол-во записей, очередь, размер пачки, скорость.
 """
 
 import argparse
 import json
 import logging
 import os
-import sqlite3
+import queue
 import sys
+import threading
 import time
-from datetime import datetime
+from decimal import Decimal
 
 # ── Рабочий каталог — папка самого скрипта ────────────────────────────────
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, BASE_DIR)
 
 from senkuro_api import SenkuroAPI
+from database import get_db, bulk_upsert, _USE_PG
 
 # ── Настройки по умолчанию ────────────────────────────────────────────────
-DEFAULT_DB      = os.path.join(BASE_DIR, "manga.db")
 DEFAULT_ORDER   = "POPULARITY_SCORE"   # POPULARITY_SCORE | SCORE | UPDATED_AT
 DEFAULT_DIR     = "DESC"
 DEFAULT_DELAY   = 0.3                  # секунд между запросами
-DEFAULT_BATCH   = 50                   # INSERT-батч
+DEFAULT_QUEUE   = 2000                 # манг в очереди между загрузкой и записью
+
+# Автоподбор размера пачки: целимся в такое время одной записи
+BATCH_TARGET_SEC = 0.5
+BATCH_MIN        = 50
+BATCH_MAX        = 5000
+# Неполная пачка сбрасывается, если новых манг нет дольше этого времени
+FLUSH_IDLE_SEC   = 2.0
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(message)s",
@@ -51,15 +68,10 @@ logger = logging.getLogger("parse_all_manga")
 # БД
 # ═══════════════════════════════════════════════════════════════════════════
 
-def open_db(path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA synchronous=NORMAL")
-    conn.execute("PRAGMA busy_timeout=10000")
-    conn.execute("PRAGMA cache_size=-32000")
-    conn.row_factory = sqlite3.Row
-
-    # Создаём таблицу manga если не существует (минимальная схема)
+def ensure_schema(conn):
+    """Минимальная схема manga для SQLite (PostgreSQL — schema_postgresql.sql)."""
+    if _USE_PG:
+        return
     conn.execute("""
         CREATE TABLE IF NOT EXISTS manga (
             id               INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -109,7 +121,11 @@ def open_db(path: str) -> sqlite3.Connection:
         "CREATE INDEX IF NOT EXISTS idx_manga_slug ON manga(manga_slug)"
     )
     conn.commit()
-    return conn
+
+
+COLUMNS = ("manga_id", "manga_slug", "manga_title", "manga_type", "manga_status",
+           "cover_url", "rating", "score", "original_name", "is_licensed", "formats")
+UPDATE_COLUMNS = [c for c in COLUMNS if c != "manga_id"]
 
 
 def build_rows(batch: list[dict]) -> list[tuple]:
@@ -132,30 +148,83 @@ def build_rows(batch: list[dict]) -> list[tuple]:
     return rows
 
 
-INSERT_IGNORE = """
-    INSERT OR IGNORE INTO manga
-        (manga_id, manga_slug, manga_title, manga_type, manga_status,
-         cover_url, rating, score, original_name, is_licensed, formats)
-    VALUES (?,?,?,?,?,?,?,?,?,?,?)
+INSERT_IGNORE = f"""
+    INSERT OR IGNORE INTO manga ({", ".join(COLUMNS)})
+    VALUES ({",".join("?" * len(COLUMNS))})
 """
 
-INSERT_REPLACE = """
-    INSERT OR REPLACE INTO manga
-        (manga_id, manga_slug, manga_title, manga_type, manga_status,
-         cover_url, rating, score, original_name, is_licensed, formats)
-    VALUES (?,?,?,?,?,?,?,?,?,?,?)
-"""
+
+_NUMBERS = (int, float, Decimal)
+
+
+def _same(a, b):
+    # Числа — как числа: score 8 из API и REAL 8.0 из БД равны
+    if isinstance(a, _NUMBERS) and isinstance(b, _NUMBERS):
+        return float(a) == float(b)
+    # Остальное из разных бэкендов сравниваем по строковому представлению
+    return str(a if a is not None else "") == str(b if b is not None else "")
 
 
-def flush(conn: sqlite3.Connection, batch: list[dict], update: bool) -> int:
-    """Записать батч в БД, вернуть кол-во реально вставленных строк."""
+def diff_rows(conn, rows: list[tuple], update: bool) -> tuple[list[tuple], int]:
+    """Отбросить строки, которые ничего не изменят в БД.
+
+    Returns:
+        (строки для записи, число новых манг среди них)
+    """
+    ids = [r[0] for r in rows]
+    existing = {}
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        for r in conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM manga WHERE manga_id IN ({','.join('?' * len(part))})",
+            part,
+        ).fetchall():
+            existing[r["manga_id"]] = tuple(r[c] for c in COLUMNS)
+
+    out, new = [], 0
+    for row in rows:
+        old = existing.get(row[0])
+        if old is None:
+            new += 1
+            out.append(row)
+        elif update and not all(_same(a, b) for a, b in zip(old, row)):
+            out.append(row)
+    return out, new
+
+
+def flush(conn, batch: list[dict], update: bool, changed_only: bool) -> int:
+    """Записать батч одной транзакцией, вернуть кол-во вставленных/обновлённых строк."""
     if not batch:
         return 0
     rows = build_rows(batch)
-    sql  = INSERT_REPLACE if update else INSERT_IGNORE
-    cur  = conn.executemany(sql, rows)
+    if changed_only:
+        rows, _ = diff_rows(conn, rows, update)
+        if not rows:
+            return 0
+    if update:
+        bulk_upsert(conn, "manga", COLUMNS, rows, "manga_id", UPDATE_COLUMNS)
+        saved = len(rows)
+    else:
+        cur = conn.cursor()
+        cur.executemany(INSERT_IGNORE, rows)
+        saved = cur.rowcount if cur.rowcount >= 0 else len(rows)
     conn.commit()
-    return cur.rowcount
+    return saved
+
+
+class BatchTuner:
+    """Подбирает размер пачки так, чтобы одна запись занимала ~BATCH_TARGET_SEC."""
+
+    def __init__(self, size=BATCH_MIN):
+        self.size = size
+
+    def observe(self, rows: int, seconds: float):
+        if rows < self.size or seconds <= 0:
+            return  # неполная пачка ничего не говорит о пропускной способности
+        ideal = rows * BATCH_TARGET_SEC / seconds
+        # Сглаживаем и не прыгаем больше чем вдвое за раз
+        ideal = min(max(ideal, self.size / 2), self.size * 2)
+        self.size = int(min(max((self.size + ideal) / 2, BATCH_MIN), BATCH_MAX))
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -169,104 +238,156 @@ class Progress:
         self.pages   = 0
         self.started = time.time()
 
-    def update(self, fetched: int, saved: int):
-        self.total += fetched
-        self.saved += saved
-        self.pages += 1
-
-    def report(self):
+    def report(self, queued: int = 0, batch: int = 0):
         elapsed = time.time() - self.started
         rps     = self.total / elapsed if elapsed > 0 else 0
         logger.info(
-            f"📊 Страница {self.pages:>4} | "
+            f"📊 Пачка {self.pages:>4} | "
             f"всего получено: {self.total:>6} | "
             f"записано/обновлено: {self.saved:>6} | "
+            f"в очереди: {queued:>5} | пачка: {batch:>5} | "
             f"скорость: {rps:.1f} манг/с"
         )
 
 
+# ═══════════════════════════════════════════════════════════════════════════
+# Конвейер загрузка → запись
+# ═══════════════════════════════════════════════════════════════════════════
+
+_DONE = object()
+
+
+def producer(api, args, out: queue.Queue, stop: threading.Event, errors: list):
+    """Загружает каталог и кладёт манги в очередь (блокируется, если она полна)."""
+    fetched = 0
+    try:
+        for manga in api.fetch_all_mangas(
+            order_field     = args.order,
+            order_direction = args.dir,
+            exclude_hentai  = not args.hentai,
+            delay           = args.delay,
+        ):
+            while not stop.is_set():
+                try:
+                    out.put(manga, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                break
+            fetched += 1
+            # Ограничение по количеству
+            if args.limit and fetched >= args.limit:
+                logger.info(f"⏹ Достигнут лимит {args.limit} манг")
+                break
+    except Exception as e:
+        errors.append(e)
+        logger.error(f"❌ Ошибка загрузки каталога: {e}")
+    finally:
+        out.put(_DONE)
+
+
+def consumer(conn, args, source: queue.Queue, progress: Progress, tuner: BatchTuner):
+    """Собирает манги из очереди в пачки и пишет их; возвращается по маркеру _DONE."""
+    batch: list[dict] = []
+
+    def _flush():
+        started = time.monotonic()
+        progress.saved += flush(conn, batch, args.update, args.changed_only)
+        tuner.observe(len(batch), time.monotonic() - started)
+        progress.pages += 1
+        progress.report(source.qsize(), tuner.size)
+        batch.clear()
+
+    try:
+        while True:
+            try:
+                item = source.get(timeout=FLUSH_IDLE_SEC)
+            except queue.Empty:
+                # Загрузка притормозила — не держим неполную пачку
+                if batch:
+                    _flush()
+                continue
+            if item is _DONE:
+                break
+            batch.append(item)
+            progress.total += 1
+            if len(batch) >= tuner.size:
+                _flush()
+    finally:
+        # Финальный (или прерванный) батч
+        if batch:
+            logger.info(f"   Сохраняем последний батч ({len(batch)} манг)…")
+            _flush()
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # main
 # ═══════════════════════════════════════════════════════════════════════════
 
 def parse_args():
     p = argparse.ArgumentParser(description="Парсинг каталога манг Senkuro")
-    p.add_argument("--db",       default=DEFAULT_DB,    help="Путь к manga.db")
     p.add_argument("--order",    default=DEFAULT_ORDER, help="Поле сортировки")
     p.add_argument("--dir",      default=DEFAULT_DIR,   choices=["ASC","DESC"])
     p.add_argument("--delay",    default=DEFAULT_DELAY, type=float,
                    help="Пауза между запросами (сек)")
-    p.add_argument("--batch",    default=DEFAULT_BATCH, type=int,
-                   help="Размер INSERT-батча")
+    p.add_argument("--queue",    default=DEFAULT_QUEUE, type=int,
+                   help="Максимум манг в очереди между загрузкой и записью")
     p.add_argument("--update",   action="store_true",
-                   help="Перезаписывать существующие записи (INSERT OR REPLACE)")
+                   help="Обновлять существующие записи (upsert колонок каталога)")
+    p.add_argument("--changed-only", action="store_true",
+                   help="Сравнивать с БД и писать только новые/изменённые (подразумевает --update)")
     p.add_argument("--hentai",   action="store_true",
                    help="Включить хентай (по умолчанию исключён)")
     p.add_argument("--limit",    default=0, type=int,
                    help="Остановиться после N манг (0 = без ограничения)")
-    return p.parse_args()
+    args = p.parse_args()
+    if args.changed_only:
+        args.update = True
+    return args
 
 
 def main():
     args = parse_args()
+    # get_db() открывает manga.db относительно рабочего каталога, как приложение
+    os.chdir(BASE_DIR)
 
+    mode = "REPLACE" if args.update else "IGNORE (не перезаписывать)"
+    if args.changed_only:
+        mode = "только изменённые"
     logger.info("═" * 60)
     logger.info("🚀 Парсинг каталога манг Senkuro")
-    logger.info(f"   DB:     {args.db}")
+    logger.info(f"   DB:     {'PostgreSQL' if _USE_PG else os.path.join(BASE_DIR, 'manga.db')}")
     logger.info(f"   Порядок: {args.order} {args.dir}")
-    logger.info(f"   Задержка: {args.delay}s | Батч: {args.batch}")
-    logger.info(f"   Режим:  {'REPLACE' if args.update else 'IGNORE (не перезаписывать)'}")
+    logger.info(f"   Задержка: {args.delay}s | Очередь: {args.queue} | Батч: авто")
+    logger.info(f"   Режим:  {mode}")
     logger.info(f"   Лимит: {args.limit if args.limit else 'нет'}")
     logger.info("═" * 60)
 
-    conn = open_db(args.db)
+    conn = get_db()
+    ensure_schema(conn)
     api  = SenkuroAPI()
 
     progress = Progress()
-    batch: list[dict] = []
+    tuner    = BatchTuner()
+    items    = queue.Queue(maxsize=args.queue)
+    stop     = threading.Event()
+    errors: list = []
+    fetcher  = threading.Thread(target=producer, args=(api, args, items, stop, errors),
+                                name="catalog-fetch", daemon=True)
+    fetcher.start()
 
     try:
-        for manga in api.fetch_all_mangas(
-            order_field     = args.order,
-            order_direction = args.dir,
-            exclude_hentai  = not args.hentai,
-            delay           = args.delay,
-        ):
-            batch.append(manga)
-            progress.total += 1
-
-            # Сбрасываем батч в БД
-            if len(batch) >= args.batch:
-                saved = flush(conn, batch, args.update)
-                progress.saved += saved
-                progress.pages += 1
-                progress.report()
-                batch.clear()
-
-            # Ограничение по количеству
-            if args.limit and progress.total >= args.limit:
-                logger.info(f"⏹ Достигнут лимит {args.limit} манг")
-                break
-
-        # Финальный батч
-        if batch:
-            saved = flush(conn, batch, args.update)
-            progress.saved += saved
-            progress.pages += 1
-            batch.clear()
-
+        consumer(conn, args, items, progress, tuner)
     except KeyboardInterrupt:
         logger.info("⚠️  Прервано пользователем (Ctrl+C)")
-        if batch:
-            logger.info(f"   Сохраняем незакрытый батч ({len(batch)} манг)…")
-            flush(conn, batch, args.update)
-
+        stop.set()
     finally:
         conn.close()
 
     elapsed = time.time() - progress.started
     logger.info("═" * 60)
-    logger.info(f"✅ Готово!")
+    logger.info(f"✅ Готово!" if not errors else f"⚠️  Завершено с ошибкой загрузки: {errors[0]}")
     logger.info(f"   Получено:  {progress.total} манг")
     logger.info(f"   Сохранено: {progress.saved} манг")
     logger.info(f"   Время:     {elapsed:.1f} с")
@@ -0,0 +1,260 @@
+"""
+rewards.py — единый движок наград за прочтение главы.
+
+complete_chapter() заменяет цепочку вызовов в api_chapter_complete
+(антиспам xp_log → user_stats → update_reading_streak →
+update_daily_quest_progress → update_season_quest_progress →
+check_achievements), каждый из которых делал свои SELECT/commit.
+Задания из quests после записи проверяет check_quests из main.
+
+Схема работы:
+  1. два запроса читают всё состояние пользователя
+     (статистика + антиспам + подписки; дневные/сезонные задания + ачивки)
+  2. изменения вычисляются в памяти
+  3. запись — пакетами (executemany) в одной транзакции, один commit
+"""
+
+import logging
+from datetime import date, datetime, timedelta
+
+import leaderboard
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+STREAK_BONUSES = {7: 50, 30: 200}
+
+_STATE_SQL = '''
+    SELECT us.xp, us.coins, us.level, us.total_chapters_read,
+           us.reading_streak, us.max_streak, us.last_read_date,
+           COALESCE(uc.subscriptions_count, 0) AS subs_count,
+           EXISTS(SELECT 1 FROM xp_log
+                  WHERE user_id = ? AND ref_id = ? AND reason = ?
+                    AND created_at > datetime('now', '-1 hour')) AS dup
+    FROM user_stats us
+    LEFT JOIN user_counters uc ON uc.user_id = us.user_id
+    WHERE us.user_id = ?
+'''
+
+# kind: daily | season | achievement — все правила, которые может задеть прочтение главы
+_RULES_SQL = '''
+    SELECT 'daily' AS kind, dq.id AS id, dq.condition_type, dq.condition_value,
+           dq.xp_reward, dq.coins_reward, NULL AS item_reward_id,
+           dq.title AS name, dq.description,
+           udq.id AS uq_id, COALESCE(udq.progress, 0) AS progress, udq.completed_at
+    FROM daily_quests dq
+    LEFT JOIN user_daily_quests udq
+           ON udq.quest_id = dq.id AND udq.user_id = ? AND udq.date = ?
+    WHERE dq.is_active = 1
+    UNION ALL
+    SELECT 'season', sq.id, sq.condition_type, sq.condition_value,
+           sq.xp_reward, sq.coins_reward, sq.item_reward_id,
+           sq.title, sq.description,
+           usq.id, COALESCE(usq.progress, 0), usq.completed_at
+    FROM season_quests sq
+    JOIN (SELECT id FROM seasons WHERE is_active = 1 AND ends_at >= ?
+          ORDER BY id DESC LIMIT 1) s ON sq.season_id = s.id
+    LEFT JOIN user_season_quests usq
+           ON usq.season_quest_id = sq.id AND usq.user_id = ?
+    WHERE sq.condition_type = ?
+    UNION ALL
+    SELECT 'achievement', a.id, a.condition_type, a.condition_value,
+           a.xp_reward, a.xp_reward, NULL,
+           a.name, a.description,
+           NULL, 0, NULL
+    FROM achievements a
+    WHERE a.id NOT IN (SELECT achievement_id FROM user_achievements WHERE user_id = ?)
+'''
+
+
+def _level_from_xp(xp):
+    from main import get_level_from_xp
+    return get_level_from_xp(xp)
+
+
+def _check_quests(user_id, conn, changed):
+    from main import check_quests
+    return check_quests(user_id, conn, changed)
+
+
+def complete_chapter(user_id, chapter_slug, pages_count, xp_amount, coins_amount, conn=None):
+    """Начислить всё, что положено за прочтение главы, одной транзакцией.
+
+    Returns:
+        dict | None: None если глава уже награждена за последний час, иначе
+        {'xp', 'coins', 'total_xp', 'level', 'leveled_up', 'achievements': [dict]}
+    """
+    close = conn is None
+    if conn is None:
+        conn = get_db()
+    try:
+        conn.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
+        st = conn.execute(
+            _STATE_SQL, (user_id, chapter_slug, 'chapter_complete', user_id)
+        ).fetchone()
+        if st is None or st['dup']:
+            return None
+
+        today = date.today()
+        today_iso = today.isoformat()
+        now_iso = datetime.utcnow().isoformat()
+        rules = conn.execute(
+            _RULES_SQL,
+            (user_id, today_iso, now_iso[:10], user_id, 'chapters_read', user_id)
+        ).fetchall()
+
+        xp = (st['xp'] or 0) + xp_amount
+        coins = (st['coins'] or 0) + coins_amount
+        chapters_read = (st['total_chapters_read'] or 0) + 1
+        old_level = st['level'] or 1
+        xp_log = [(user_id, 'chapter_complete', chapter_slug, xp_amount)]
+
+        # ── Стрик (логика update_reading_streak) ─────────────────────────────
+        streak, max_streak = st['reading_streak'] or 0, st['max_streak'] or 0
+        last_read = st['last_read_date']
+        if last_read != today_iso:
+            yesterday = (today - timedelta(1)).isoformat()
+            streak = streak + 1 if last_read == yesterday else 1
+            max_streak = max(max_streak, streak)
+            bonus = STREAK_BONUSES.get(streak)
+            if bonus:
+                xp += bonus
+                coins += bonus
+                xp_log.append((user_id, f'streak_{streak}', None, bonus))
+
+        # ── Дневные и сезонные задания ───────────────────────────────────────
+        daily_rows, season_rows, item_rewards = [], [], []
+        daily_done = []
+        achievements = []
+        for r in rules:
+            kind = r['kind']
+            if kind == 'achievement':
+                achievements.append(r)
+                continue
+            if r['completed_at']:
+                continue
+            progress = r['progress']
+            completed_at = None
+            counts = (kind == 'daily' and r['condition_type'] == 'chapters_today') or kind == 'season'
+            if counts:
+                progress += 1
+                if progress >= r['condition_value']:
+                    progress = r['condition_value']
+                    completed_at = today_iso if kind == 'daily' else now_iso
+                    if r['xp_reward'] > 0 or r['coins_reward'] > 0:
+                        xp += r['xp_reward']
+                        coins += r['coins_reward']
+                        if kind == 'daily':
+                            # ref_id — строка user_daily_quests, её id известен после upsert
+                            daily_done.append((r['id'], r['uq_id'], r['xp_reward']))
+                        else:
+                            xp_log.append((user_id, f'season_quest:{r["id"]}', str(r['id']),
+                                           r['xp_reward']))
+                    if r['item_reward_id']:
+                        item_rewards.append((user_id, r['item_reward_id']))
+            elif r['uq_id'] is not None:
+                continue  # строка уже есть и не меняется
+            if kind == 'daily':
+                daily_rows.append((user_id, r['id'], today_iso, progress, completed_at))
+            else:
+                season_rows.append((user_id, r['id'], progress, completed_at))
+
+        # ── Уровень и ачивки (логика check_achievements) ─────────────────────
+        new_level = _level_from_xp(xp)
+        stat_values = {
+            'chapters_read': chapters_read,
+            'subscriptions': st['subs_count'],
+            'level': max(new_level, old_level),
+        }
+        unlocked = []
+        for a in achievements:
+            if stat_values.get(a['condition_type'], 0) >= a['condition_value']:
+                unlocked.append(a)
+                xp += a['xp_reward']
+                coins += a['xp_reward']
+                if a['xp_reward'] > 0:
+                    xp_log.append((user_id, f'achievement:{a["id"]}', str(a['id']),
+                                   a['xp_reward']))
+
+        notifications = []
+        leveled_up = new_level > old_level
+        if leveled_up:
+            notifications.append((user_id, 'level_up', f'Уровень {new_level}!',
+                                  f'Поздравляем с {new_level} уровнем!', f'/profile/{user_id}'))
+        for a in unlocked:
+            notifications.append((user_id, 'achievement', f'Достижение: {a["name"]}',
+                                  a['description'], f'/profile/{user_id}'))
+
+        # ── Запись одной транзакцией ─────────────────────────────────────────
+        # XP/монеты — приращением, чтобы не затереть параллельный award_xp
+        level = max(new_level, old_level)
+        conn.execute(
+            '''UPDATE user_stats SET xp = xp + ?, coins = coins + ?,
+                      level = CASE WHEN level < ? THEN ? ELSE level END,
+                      total_chapters_read = total_chapters_read + 1,
+                      total_pages_read = total_pages_read + ?,
+                      reading_streak = ?, max_streak = ?, last_read_date = ?
+               WHERE user_id = ?''',
+            (xp - (st['xp'] or 0), coins - (st['coins'] or 0), level, level, pages_count,
+             streak, max_streak, today_iso, user_id)
+        )
+        c = conn.cursor()
+        if daily_rows:
+            c.executemany(
+                '''INSERT INTO user_daily_quests (user_id, quest_id, date, progress, completed_at)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(user_id, quest_id, date) DO UPDATE
+                   SET progress = excluded.progress, completed_at = excluded.completed_at''',
+                daily_rows
+            )
+        if daily_done:
+            if any(uq_id is None for _, uq_id, _ in daily_done):
+                uq_ids = {r['quest_id']: r['id'] for r in conn.execute(
+                    'SELECT id, quest_id FROM user_daily_quests WHERE user_id = ? AND date = ?',
+                    (user_id, today_iso)
+                ).fetchall()}
+            for quest_id, uq_id, reward in daily_done:
+                uq_id = uq_id if uq_id is not None else uq_ids[quest_id]
+                xp_log.append((user_id, f'daily_quest:{uq_id}', str(uq_id), reward))
+        c.executemany(
+            'INSERT INTO xp_log (user_id, reason, ref_id, amount) VALUES (?, ?, ?, ?)', xp_log
+        )
+        if season_rows:
+            c.executemany(
+                '''INSERT INTO user_season_quests (user_id, season_quest_id, progress, completed_at)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT(user_id, season_quest_id) DO UPDATE
+                   SET progress = excluded.progress, completed_at = excluded.completed_at''',
+                season_rows
+            )
+        if item_rewards:
+            c.executemany(
+                'INSERT OR IGNORE INTO user_items (user_id, item_id) VALUES (?, ?)', item_rewards
+            )
+        if unlocked:
+            c.executemany(
+                'INSERT OR IGNORE INTO user_achievements (user_id, achievement_id) VALUES (?, ?)',
+                [(user_id, a['id']) for a in unlocked]
+            )
+        if notifications:
+            c.executemany(
+                'INSERT INTO site_notifications (user_id, type, title, body, url) VALUES (?,?,?,?,?)',
+                notifications
+            )
+        conn.commit()
+        leaderboard.add_xp(user_id, xp - (st['xp'] or 0))
+        # Задания из quests: число глав изменилось; новый уровень открывает
+        # задания с required_level — тогда проверяются все
+        _check_quests(user_id, conn, None if leveled_up else {'chapters_read'})
+
+        return {
+            'xp': xp_amount,
+            'coins': coins_amount,
+            'total_xp': xp,
+            'level': level,
+            'leveled_up': leveled_up,
+            'achievements': [dict(a) for a in unlocked],
+        }
+    finally:
+        if close:
+            conn.close()
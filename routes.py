@@ -21,6 +21,15 @@ from flask import (
     send_from_directory, send_file
 )
 from database import get_db, _USE_PG, _to_dt
+from media import to_webm, resize_gif
+from rewards import complete_chapter
+import rules as _rules
+import leaderboard
+import update_crawler
+import search_engine
+import catalog_cache
+import manga_cards
+import suggest_store
 from config import (
     ADMIN_TELEGRAM_IDS, SITE_URL, COIN_PACKAGES, PREMIUM_PACKAGES,
     TELEGRAM_BOT_TOKEN,
@@ -72,8 +81,7 @@ def serve_upload(filename):
 @bp.route('/thumb')
 def serve_thumb():
     """Отдаёт сжатую миниатюру изображения. Поддерживает анимированные GIF."""
-    import io as _io
-    from PIL import Image, ImageSequence
+    from PIL import Image
 
     src = request.args.get('src', '')
     try:
@@ -110,18 +118,11 @@ def serve_thumb():
         new_size = (max_w, max(1, int(img.height * ratio)))
 
         if ext == 'gif':
-            frames, durations = [], []
-            for frame in ImageSequence.Iterator(img):
-                rgba = frame.convert('RGBA').resize(new_size, Image.LANCZOS)
-                frames.append(rgba.convert('P', palette=Image.ADAPTIVE, colors=256))
-                durations.append(frame.info.get('duration', 100))
-            buf = _io.BytesIO()
-            frames[0].save(buf, format='GIF', save_all=True,
-                           append_images=frames[1:],
-                           loop=img.info.get('loop', 0),
-                           duration=durations, optimize=False)
-            with open(cache_path, 'wb') as f:
-                f.write(buf.getvalue())
+            # Покадрово через ffmpeg — без списка всех кадров в памяти
+            ok, err = resize_gif(abs_path, cache_path, max_w)
+            if not ok:
+                logger.error(f'Thumb ffmpeg failed for {src}: {err}')
+                return send_file(abs_path)
         else:
             out = img.copy()
             out.thumbnail(new_size, Image.LANCZOS)
@@ -141,10 +142,6 @@ def serve_thumb():
 @bp.route('/anim')
 def serve_anim():
     """Конвертирует анимацию (GIF/WebP) в WebM через ffmpeg и отдаёт как <video>."""
-    import subprocess
-    import tempfile
-    from PIL import Image, ImageSequence
-
     src = request.args.get('src', '')
     try:
         max_w = min(int(request.args.get('w', 600)), 800)
@@ -166,51 +163,16 @@ def serve_anim():
         resp.headers['Cache-Control'] = 'public, max-age=86400'
         return resp
 
-    ext = abs_path.rsplit('.', 1)[-1].lower()
-    ffmpeg_input = abs_path
-    tmp_gif = None
-
     try:
-        # Animated WebP ffmpeg не читает напрямую — конвертируем через Pillow в GIF
-        if ext == 'webp':
-            img = Image.open(abs_path)
-            frames, durations = [], []
-            ratio = max_w / img.width if img.width > max_w else 1.0
-            new_size = (max(1, int(img.width * ratio)), max(1, int(img.height * ratio)))
-            for frame in ImageSequence.Iterator(img):
-                rgba = frame.convert('RGBA').resize(new_size, Image.LANCZOS)
-                frames.append(rgba.convert('P', palette=Image.ADAPTIVE, colors=256))
-                durations.append(frame.info.get('duration', 50))
-            tmp = tempfile.NamedTemporaryFile(suffix='.gif', delete=False)
-            frames[0].save(tmp.name, save_all=True, append_images=frames[1:],
-                           loop=0, duration=durations, optimize=False)
-            tmp.close()
-            tmp_gif = tmp.name
-            ffmpeg_input = tmp_gif
-
-        cmd = [
-            'ffmpeg', '-y', '-i', ffmpeg_input,
-            '-vf', f'scale={max_w}:-2' if ext != 'webp' else 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
-            '-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '35',
-            '-cpu-used', '5', '-deadline', 'realtime',
-            '-auto-alt-ref', '0', '-an',
-            cache_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, timeout=120)
-        if tmp_gif:
-            try: os.unlink(tmp_gif)
-            except OSError: pass
-
-        if result.returncode == 0 and os.path.exists(cache_path):
+        # WebP кадры идут в ffmpeg через pipe по одному, GIF ffmpeg читает сам
+        ok, err = to_webm(abs_path, cache_path, max_w=max_w, timeout=120)
+        if ok:
             resp = send_file(cache_path, mimetype='video/webm')
             resp.headers['Cache-Control'] = 'public, max-age=86400'
             return resp
-        logger.error(f'ffmpeg failed for {src}: {result.stderr.decode()[:300]}')
+        logger.error(f'ffmpeg failed for {src}: {err}')
     except Exception as e:
         logger.error(f'Anim convert error {src}: {e}')
-        if tmp_gif:
-            try: os.unlink(tmp_gif)
-            except OSError: pass
 
     return send_file(abs_path)
 
@@ -496,44 +458,13 @@ def search():
                                query=query, results=[],
                                total=0, user_id=user_id)
 
-    if user_id:
-        save_search_history(user_id, query)
-
-    like   = f'%{query}%'
-    starts = f'{query}%'
+    _m().save_search_history(user_id, query)
 
-    conn = get_db()
-    c    = conn.cursor()
-
-    c.execute('''SELECT COUNT(*) FROM manga
-                 WHERE manga_title LIKE ? OR original_name LIKE ? OR manga_slug LIKE ?''',
-              (like, like, like))
-    total = c.fetchone()[0]
-
-    results = []
-    if total > 0:
-        c.execute('''
-            SELECT manga_id, manga_slug, manga_title, manga_type,
-                   manga_status, cover_url, rating, score, views, chapters_count, last_updated,
-                   CASE
-                     WHEN lower(manga_title) = lower(?)    THEN 10
-                     WHEN lower(manga_title) LIKE lower(?) THEN 5
-                     ELSE 1
-                   END AS _rel
-            FROM manga
-            WHERE manga_title LIKE ? OR original_name LIKE ? OR manga_slug LIKE ?
-            ORDER BY _rel DESC, COALESCE(score, 0) DESC
-            LIMIT ?
-        ''', (query, starts, like, like, like, _PER))
-        results = [dict(r) for r in c.fetchall()]
-        for r in results:
-            r.pop('_rel', None)
-
-    conn.close()
+    results, total = search_engine.search(query, 'relevance', 0, _PER)
 
     # Fallback на API только если БД пуста
     if total == 0:
-        api_results = search_manga_api(query, _PER)
+        api_results = _m().search_manga_api(query, _PER)
         total   = len(api_results)
         results = api_results
 
@@ -545,127 +476,18 @@ def search():
 def api_search():
     """AJAX-поиск манги с сортировкой и offset-пагинацией."""
     _PER = 25
-    _SORT = {
-        'relevance': None,                            # специальная логика
-        'score':     'COALESCE(score, 0) DESC',
-        'views':     'COALESCE(views, 0) DESC',
-        'chapters':  'COALESCE(chapters_count, 0) DESC',
-        'updated':   "COALESCE(last_updated, '1970') DESC",
-    }
 
     query  = request.args.get('q', '').strip()
     offset = max(0, request.args.get('offset', 0, type=int))
     limit  = min(max(1, request.args.get('limit', _PER, type=int)), 100)
     sort   = request.args.get('sort', 'relevance')
-    if sort not in _SORT:
-        sort = 'relevance'
 
     if not query or len(query) < 2:
         return jsonify({'results': [], 'total': 0, 'has_more': False})
 
-    like   = f'%{query}%'
-    starts = f'{query}%'
-
-    conn = get_db()
-    c    = conn.cursor()
-
-    rows = None
-    total = 0
-
-    if sort == 'relevance':
-        if _USE_PG:
-            # PostgreSQL tsvector поиск
-            tsq = query  # plainto_tsquery сам нормализует
-            try:
-                c.execute('''SELECT COUNT(*) FROM manga
-                             WHERE search_vector @@ plainto_tsquery('simple', %s)''', (tsq,))
-                total = c.fetchone()[0]
-                if total > 0:
-                    c.execute('''
-                        SELECT manga_id, manga_slug, manga_title, manga_type, manga_status,
-                               cover_url, rating, score, views, chapters_count, last_updated
-                        FROM manga
-                        WHERE search_vector @@ plainto_tsquery('simple', %s)
-                        ORDER BY ts_rank(search_vector, plainto_tsquery('simple', %s)) DESC
-                        LIMIT %s OFFSET %s
-                    ''', (tsq, tsq, limit, offset))
-                    rows = [dict(r) for r in c.fetchall()]
-            except Exception:
-                rows = None
-                total = 0
-        else:
-            # SQLite FTS5 поиск
-            fts_query = query.replace('"', '""')
-            try:
-                c.execute('''SELECT m.manga_id FROM manga_fts
-                             JOIN manga m USING(manga_id)
-                             WHERE manga_fts MATCH ?
-                             ORDER BY rank LIMIT 1''', (fts_query + '*',))
-                use_fts = c.fetchone() is not None
-            except Exception:
-                use_fts = False
-
-            if use_fts:
-                c.execute('''SELECT COUNT(*) FROM manga_fts
-                             JOIN manga m USING(manga_id)
-                             WHERE manga_fts MATCH ?''', (fts_query + '*',))
-                total = c.fetchone()[0]
-                if total > 0:
-                    c.execute('''
-                        SELECT m.manga_id, m.manga_slug, m.manga_title, m.manga_type, m.manga_status,
-                               m.cover_url, m.rating, m.score, m.views, m.chapters_count, m.last_updated
-                        FROM manga_fts
-                        JOIN manga m USING(manga_id)
-                        WHERE manga_fts MATCH ?
-                        ORDER BY rank
-                        LIMIT ? OFFSET ?
-                    ''', (fts_query + '*', limit, offset))
-                    rows = [dict(r) for r in c.fetchall()]
-
-    if rows is None:
-        # LIKE fallback (also used for non-relevance sort)
-        c.execute('''SELECT COUNT(*) FROM manga
-                     WHERE manga_title LIKE ? OR original_name LIKE ? OR manga_slug LIKE ?''',
-                  (like, like, like))
-        total = c.fetchone()[0]
-
-        if total == 0:
-            conn.close()
-            return jsonify({'results': [], 'total': 0, 'has_more': False})
-
-        if sort == 'relevance':
-            c.execute('''
-                SELECT manga_id, manga_slug, manga_title, manga_type, manga_status,
-                       cover_url, rating, score, views, chapters_count, last_updated,
-                       CASE
-                         WHEN lower(manga_title) = lower(?)    THEN 10
-                         WHEN lower(manga_title) LIKE lower(?) THEN 5
-                         ELSE 1
-                       END AS _rel
-                FROM manga
-                WHERE manga_title LIKE ? OR original_name LIKE ? OR manga_slug LIKE ?
-                ORDER BY _rel DESC, COALESCE(score, 0) DESC
-                LIMIT ? OFFSET ?
-            ''', (query, starts, like, like, like, limit, offset))
-        else:
-            order_sql = _SORT[sort]
-            c.execute(f'''
-                SELECT manga_id, manga_slug, manga_title, manga_type, manga_status,
-                       cover_url, rating, score, views, chapters_count, last_updated
-                FROM manga
-                WHERE manga_title LIKE ? OR original_name LIKE ? OR manga_slug LIKE ?
-                ORDER BY {order_sql}
-                LIMIT ? OFFSET ?
-            ''', (like, like, like, limit, offset))
-        rows = [dict(r) for r in c.fetchall()]
-
-    conn.close()
-
-    for r in rows:
-        r.pop('_rel', None)
-
+    rows, total = search_engine.search(query, sort, offset, limit)
     return jsonify({
-        'results': rows,
+        'results':  rows,
         'total':    total,
         'has_more': offset + len(rows) < total,
     })
@@ -673,40 +495,14 @@ def api_search():
 
 @bp.route('/api/search/suggestions')
 def search_suggestions():
-    query   = request.args.get('q', '').strip()
-    user_id = session.get('user_id')
-
-    if len(query) < 2:
-        return jsonify([])
+    """Подсказки из предрасчитанной таблицы префиксов — одинаковы для всех пользователей."""
+    query = request.args.get('q', '').strip()
+    suggestions = suggest_store.lookup(query, 8) if len(query) >= 2 else []
 
-    # Сначала — тайтлы из каталога БД
-    conn = get_db()
-    c    = conn.cursor()
-    c.execute('''SELECT manga_title FROM manga
-                 WHERE manga_title LIKE ? OR original_name LIKE ?
-                 ORDER BY COALESCE(score, 0) DESC
-                 LIMIT 8''', (f'{query}%', f'{query}%'))
-    from_catalog = [row[0] for row in c.fetchall()]
-
-    # Добавляем из истории поиска (только если мало результатов)
-    from_history = []
-    if len(from_catalog) < 5:
-        c.execute('''SELECT DISTINCT query FROM search_history
-                     WHERE query LIKE ?
-                     ORDER BY created_at DESC
-                     LIMIT ?''', (f'{query}%', 8 - len(from_catalog)))
-        from_history = [row[0] for row in c.fetchall()]
-    conn.close()
-
-    # Объединяем, дедупликация с сохранением порядка
-    seen = set()
-    suggestions = []
-    for s in from_catalog + from_history:
-        if s.lower() not in seen:
-            seen.add(s.lower())
-            suggestions.append(s)
-
-    return jsonify(suggestions[:8])
+    resp = jsonify(suggestions)
+    resp.headers['Cache-Control'] = 'public, max-age=300'
+    resp.set_etag(f'{suggest_store.version()}-{hashlib.md5(query.lower().encode()).hexdigest()[:12]}')
+    return resp.make_conditional(request)
 
 _GENRE_GROUPS = {
     'Жанры': [
@@ -815,7 +611,7 @@ def api_catalog():
         'score':    'COALESCE(score, 0) DESC, manga_id ASC',
         'views':    'COALESCE(views, 0) DESC, manga_id ASC',
         'chapters': 'COALESCE(chapters_count, 0) DESC, manga_id ASC',
-        'updated':  "COALESCE(last_updated, '1970') DESC, manga_id ASC",
+        'updated':  'last_updated IS NULL, last_updated DESC, manga_id ASC',
         'title':    'manga_title ASC, manga_id ASC',
     }
     manga_type = request.args.get('type', '').strip().upper()
@@ -830,42 +626,47 @@ def api_catalog():
 
     selected_genres = [g.strip() for g in genres_raw.split(',') if g.strip()] if genres_raw else []
 
-    where = ['1=1']
-    params = []
+    if manga_type not in ('MANGA', 'MANHWA', 'MANHUA', 'OEL', 'NOVEL', 'ONE_SHOT', 'DOUJINSHI', 'COMICS'):
+        manga_type = ''
+    if manga_status not in ('ONGOING', 'FINISHED', 'CANCELLED', 'HIATUS', 'ANNOUNCED'):
+        manga_status = ''
+    key = catalog_cache.normalize(manga_type, manga_status, selected_genres[:10], sort, offset, limit)
+
+    def _page_ids():
+        where = ['1=1']
+        params = []
+        if manga_type:
+            where.append('manga_type = ?')
+            params.append(manga_type)
+        if manga_status:
+            where.append('manga_status = ?')
+            params.append(manga_status)
+        for genre in key[2]:
+            safe = genre.replace('"', '').replace('%', '').replace('_', '\\_')
+            where.append('tags LIKE ?')
+            params.append(f'%"{safe}"%')
 
-    if manga_type and manga_type in ('MANGA', 'MANHWA', 'MANHUA', 'OEL', 'NOVEL', 'ONE_SHOT', 'DOUJINSHI', 'COMICS'):
-        where.append('manga_type = ?')
-        params.append(manga_type)
-
-    if manga_status and manga_status in ('ONGOING', 'FINISHED', 'CANCELLED', 'HIATUS', 'ANNOUNCED'):
-        where.append('manga_status = ?')
-        params.append(manga_status)
-
-    for genre in selected_genres[:10]:
-        safe = genre.replace('"', '').replace('%', '').replace('_', '\\_')
-        where.append('tags LIKE ?')
-        params.append(f'%"{safe}"%')
-
-    where_sql = ' AND '.join(where)
-    order_sql = _SORT[sort]
-
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(f'SELECT COUNT(*) FROM manga WHERE {where_sql}', params)
-    total = c.fetchone()[0]
+        conn = get_db()
+        try:
+            rows = conn.execute(
+                f'''SELECT manga_id, COUNT(*) OVER () AS total FROM manga
+                    WHERE {' AND '.join(where)}
+                    ORDER BY {_SORT[sort]}
+                    LIMIT ? OFFSET ?''',
+                params + [limit, offset]
+            ).fetchall()
+            total = rows[0]['total'] if rows else 0
+            if not rows and offset:
+                # Страница за концом списка — total всё равно нужен клиенту
+                total = conn.execute(f"SELECT COUNT(*) FROM manga WHERE {' AND '.join(where)}",
+                                     params).fetchone()[0]
+        finally:
+            conn.close()
+        return [r['manga_id'] for r in rows], total
 
-    c.execute(
-        f'''SELECT manga_id, manga_slug, manga_title, manga_type, manga_status,
-                   cover_url, rating, score, views, chapters_count, last_updated,
-                   SUBSTR(description, 1, 160) AS description, tags
-            FROM manga WHERE {where_sql}
-            ORDER BY {order_sql}
-            LIMIT ? OFFSET ?''',
-        params + [limit, offset]
-    )
-    rows = [dict(r) for r in c.fetchall()]
-    conn.close()
+    ids, total = catalog_cache.get_ids(key, _page_ids)
 
+    rows = manga_cards.get_many(ids)
     return jsonify({'results': rows, 'total': total, 'has_more': offset + len(rows) < total})
 
 
@@ -1158,7 +959,9 @@ def _bg_load_all_chapters(manga_slug):
     """Фоновый поток: загрузить все главы и сохранить в БД"""
     try:
         logger.info(f"🔄 [BG] Фоновая загрузка всех глав для {manga_slug}")
-        get_manga_chapters_api(manga_slug, limit=10000)
+        # Догрузка пропусков: нужны старые главы — инкрементальный обход остановился бы
+        # на первой известной странице
+        get_manga_chapters_api(manga_slug, limit=10000, incremental=False)
         logger.info(f"✅ [BG] Фоновая загрузка завершена для {manga_slug}")
     except Exception as e:
         logger.error(f"❌ [BG] Ошибка фоновой загрузки для {manga_slug}: {e}")
@@ -1265,75 +1068,28 @@ def api_chapter_complete(chapter_slug):
 
     xp_amount, coins_amount = _calc_chapter_reward(pages_count)
 
-    conn = get_db()
     try:
-        # Антиспам: не начислять повторно за одну главу в течение 1 часа
-        dup = conn.execute(
-            'SELECT id FROM xp_log WHERE user_id=? AND ref_id=? AND reason="chapter_complete"'
-            ' AND created_at > datetime("now", "-1 hour")',
-            (user_id, chapter_slug)
-        ).fetchone()
-        if dup:
+        # Вся цепочка (антиспам, стрик, задания, уровень, ачивки) — одна транзакция
+        result = complete_chapter(user_id, chapter_slug, pages_count, xp_amount, coins_amount)
+        if result is None:
             return jsonify({'ok': False, 'error': 'already_rewarded'}), 200
 
-        # Счётчики
-        conn.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
-        conn.execute(
-            'UPDATE user_stats SET total_chapters_read = total_chapters_read + 1,'
-            ' total_pages_read = total_pages_read + ? WHERE user_id = ?',
-            (pages_count, user_id)
-        )
-
-        # XP + монеты
-        conn.execute(
-            'UPDATE user_stats SET xp = xp + ?, coins = coins + ? WHERE user_id = ?',
-            (xp_amount, coins_amount, user_id)
-        )
-        conn.execute(
-            'INSERT INTO xp_log (user_id, reason, ref_id, amount) VALUES (?, ?, ?, ?)',
-            (user_id, 'chapter_complete', chapter_slug, xp_amount)
-        )
-        conn.commit()
-
-        # Стрик чтения
-        update_reading_streak(user_id, conn)
-        # Дневные задания
-        update_daily_quest_progress(user_id, 'chapters_today', conn)
-        # Сезонные задания
-        update_season_quest_progress(user_id, 'chapters_read', 1, conn)
-
-        # Уровень и ачивки
-        row = conn.execute('SELECT xp, level FROM user_stats WHERE user_id=?', (user_id,)).fetchone()
-        new_xp = row['xp'] if row else xp_amount
-        new_level = get_level_from_xp(new_xp)
-        old_level = row['level'] if row else 1
-        leveled_up = new_level > old_level
-        if leveled_up:
-            conn.execute('UPDATE user_stats SET level=? WHERE user_id=?', (new_level, user_id))
-            conn.commit()
-            create_site_notification(user_id, 'level_up', f'Уровень {new_level}!',
-                                     f'Поздравляем с {new_level} уровнем!',
-                                     f'/profile/{user_id}', conn=conn)
-        new_achievements = check_achievements(user_id, conn)
-
         # Инвалидируем кеш
         with _stats_cache_lock:
             _stats_cache.pop(user_id, None)
 
         return jsonify({
             'ok': True,
-            'xp': xp_amount,
-            'coins': coins_amount,
-            'total_xp': new_xp,
-            'level': new_level,
-            'leveled_up': leveled_up,
-            'achievements': [a['name'] for a in new_achievements],
+            'xp': result['xp'],
+            'coins': result['coins'],
+            'total_xp': result['total_xp'],
+            'level': result['level'],
+            'leveled_up': result['leveled_up'],
+            'achievements': [a['name'] for a in result['achievements']],
         })
     except Exception as e:
         logger.error(f'chapter_complete error: {e}')
         return jsonify({'ok': False, 'error': str(e)}), 500
-    finally:
-        conn.close()
 
 
 @bp.route('/api/manga/<manga_slug>/similar')
@@ -1683,25 +1439,66 @@ def _top_make_display(r):
            f"#{r['id']}"
 
 
-@cache.cached(timeout=120, key_prefix='top_leaders')
-def _get_top_leaders():
-    """Кешированный запрос топ-50 и числа пользователей (TTL 2 мин)."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) as cnt FROM user_stats')
-    _cnt_row = c.fetchone()
-    total_users = (_cnt_row['cnt'] if _cnt_row else 1) or 1
-    c.execute(_TOP_ROW_SQL + ' ORDER BY s.xp DESC LIMIT 50')
-    rows = c.fetchall()
+_TOP_PROFILES_TTL = 600
+
+
+def _get_top_leaders(period='all', limit=50):
+    """Топ из leaderboard + профили участников.
+
+    Порядок и счёт берутся из доски (O(log n)); профили кешируются и
+    перечитываются только когда меняется состав топа (или по TTL),
+    поэтому начисление XP больше не сбрасывает кеш.
+    """
+    board = leaderboard.top(limit, period)
+    ids = [uid for uid, _ in board]
+    total_users = leaderboard.size('all') or 1
+    if not ids:
+        return [], total_users
+
+    cache_key = f'top_leaders:{period}:{limit}'
+    cached = cache.get(cache_key)
+    if cached and cached['ids'] == ids:
+        profiles = cached['profiles']
+    else:
+        conn = get_db()
+        placeholders = ','.join('?' * len(ids))
+        rows = conn.execute(_TOP_ROW_SQL + f' WHERE u.id IN ({placeholders})', ids).fetchall()
+        conn.close()
+        profiles = {}
+        for row in rows:
+            r = dict(row)
+            r['display_name'] = _top_make_display(r)
+            profiles[r['id']] = r
+        cache.set(cache_key, {'ids': ids, 'profiles': profiles}, timeout=_TOP_PROFILES_TTL)
+
     leaders = []
-    for row in rows:
-        r = dict(row)
-        r['display_name'] = _top_make_display(r)
-        leaders.append(r)
-    conn.close()
+    for uid, score in board:
+        if uid in profiles:
+            r = dict(profiles[uid])
+            r['score'] = score
+            if period == 'all':
+                r['xp'] = score
+            leaders.append(r)
     return leaders, total_users
 
 
+def _get_my_rank(user_id, period='all'):
+    """Строка пользователя с местом в таблице (для тех, кто не попал в топ)."""
+    rank, score = leaderboard.rank(user_id, period)
+    if rank is None:
+        return None
+    conn = get_db()
+    ur = conn.execute(_TOP_ROW_SQL + ' WHERE u.id = ?', (user_id,)).fetchone()
+    conn.close()
+    if not ur:
+        return None
+    my_data = dict(ur)
+    my_data['display_name'] = _top_make_display(my_data)
+    my_data['rank'] = rank
+    my_data['score'] = score
+    return my_data
+
+
 @bp.route('/top')
 def top_page():
     """Таблица лидеров"""
@@ -1711,26 +1508,28 @@ def top_page():
     user_id = session.get('user_id')
     my_rank_data = None
     if user_id and user_id not in top_ids:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute('''SELECT COUNT(*) + 1 AS rank FROM user_stats
-                     WHERE xp > (SELECT xp FROM user_stats WHERE user_id = ?)''',
-                  (user_id,))
-        rank_row = c.fetchone()
-        if rank_row:
-            c.execute(_TOP_ROW_SQL + ' WHERE u.id = ?', (user_id,))
-            ur = c.fetchone()
-            if ur:
-                my_data = dict(ur)
-                my_data['display_name'] = _top_make_display(my_data)
-                my_data['rank'] = rank_row['rank']
-                my_rank_data = my_data
-        conn.close()
+        my_rank_data = _get_my_rank(user_id)
 
     return render_template('top.html', leaders=leaders, user_id=user_id,
                            my_rank_data=my_rank_data, total_users=total_users)
 
 
+@bp.route('/api/top')
+def api_top():
+    """Таблица лидеров за период. ?period=all|week|season&limit=N"""
+    period = request.args.get('period', 'all')
+    if period not in leaderboard.PERIODS:
+        return jsonify({'error': 'Неизвестный период'}), 400
+    limit = max(1, min(request.args.get('limit', 50, type=int), 100))
+    leaders, total_users = _get_top_leaders(period, limit)
+    user_id = session.get('user_id')
+    me = None
+    if user_id and user_id not in {r['id'] for r in leaders}:
+        me = _get_my_rank(user_id, period)
+    return jsonify({'period': period, 'leaders': leaders, 'me': me,
+                    'total_users': total_users})
+
+
 @bp.route('/shop')
 def shop_page():
     """Страница магазина"""
@@ -2341,10 +2140,8 @@ def api_user_reading_list():
         return jsonify([])
     status = request.args.get('status')
     conn = get_db()
-    q = '''SELECT m.manga_id, m.manga_slug, m.manga_title, m.cover_url, m.manga_type,
-                  ums.status, ums.updated_at
+    q = '''SELECT ums.manga_id, ums.status, ums.updated_at
            FROM user_manga_status ums
-           JOIN manga m ON ums.manga_id = m.manga_id
            WHERE ums.user_id=?'''
     params = [target_id]
     if status:
@@ -2353,7 +2150,7 @@ def api_user_reading_list():
     q += ' ORDER BY ums.updated_at DESC'
     rows = conn.execute(q, params).fetchall()
     conn.close()
-    return jsonify([dict(r) for r in rows])
+    return jsonify(manga_cards.hydrate(rows))
 
 
 @bp.route('/api/manga/<manga_id>/rate', methods=['POST'])
@@ -2492,16 +2289,13 @@ def api_user_wishlist():
         return jsonify({'error': 'Не авторизован'}), 401
     conn = get_db()
     rows = conn.execute(
-        '''SELECT m.manga_id, m.manga_slug, m.manga_title, m.cover_url, m.manga_type,
-                  m.manga_status, rw.added_at
-           FROM reading_wishlist rw
-           JOIN manga m ON rw.manga_id = m.manga_id
-           WHERE rw.user_id=?
-           ORDER BY rw.added_at DESC''',
+        '''SELECT manga_id, added_at FROM reading_wishlist
+           WHERE user_id=?
+           ORDER BY added_at DESC''',
         (user_id,)
     ).fetchall()
     conn.close()
-    return jsonify([dict(r) for r in rows])
+    return jsonify(manga_cards.hydrate(rows))
 
 
 # ==================== COMMENT LIKES ====================
@@ -2737,7 +2531,7 @@ def post_comment(manga_slug):
               (manga_slug, user_id, text, parent_id))
     comment_id = c.lastrowid
     conn.commit()
-    check_quests(user_id, conn)
+    check_quests(user_id, conn, {'comments_posted'})
     update_daily_quest_progress(user_id, 'comments_today', conn)
     update_season_quest_progress(user_id, 'comments_posted', 1, conn)
     c.execute(_COMMENT_QUERY + 'WHERE cm.id = ?', (comment_id,))
@@ -3082,17 +2876,14 @@ def api_user_subscriptions():
     conn = get_db()
     c = conn.cursor()
     c.execute(
-        '''SELECT m.manga_id, m.manga_title, m.manga_slug, m.cover_url,
-                  m.manga_type, m.manga_status, s.subscribed_at
-           FROM subscriptions s
-           JOIN manga m ON s.manga_id = m.manga_id
-           WHERE s.user_id = ?
-           ORDER BY s.subscribed_at DESC''',
+        '''SELECT manga_id, subscribed_at FROM subscriptions
+           WHERE user_id = ?
+           ORDER BY subscribed_at DESC''',
         (target_id,)
     )
-    rows = [dict(r) for r in c.fetchall()]
+    rows = c.fetchall()
     conn.close()
-    return jsonify(rows)
+    return jsonify(manga_cards.hydrate(rows))
 
 
 @bp.route('/api/user/collections')
@@ -3170,7 +2961,8 @@ def api_follow_curator(author_id):
                   (user_id, author_id))
         following = True
     conn.commit()
-    cnt = c.execute('SELECT COUNT(*) FROM curator_follows WHERE author_id=?', (author_id,)).fetchone()[0]
+    row = c.execute('SELECT followers_count FROM user_counters WHERE user_id=?', (author_id,)).fetchone()
+    cnt = row[0] if row else 0
     conn.close()
     return jsonify({'following': following, 'followers_count': cnt})
 
@@ -3181,7 +2973,8 @@ def api_curator_followers(author_id):
     user_id = session.get('user_id')
     conn = get_db()
     c = conn.cursor()
-    cnt = c.execute('SELECT COUNT(*) FROM curator_follows WHERE author_id=?', (author_id,)).fetchone()[0]
+    row = c.execute('SELECT followers_count FROM user_counters WHERE user_id=?', (author_id,)).fetchone()
+    cnt = row[0] if row else 0
     following = False
     if user_id:
         following = bool(c.execute('SELECT id FROM curator_follows WHERE follower_id=? AND author_id=?',
@@ -3299,16 +3092,14 @@ def api_collection_items(coll_id):
     conn = get_db()
     c = conn.cursor()
     c.execute(
-        '''SELECT m.manga_id, m.manga_title, m.manga_slug, m.cover_url, m.manga_type, ci.added_at
-           FROM collection_items ci
-           JOIN manga m ON ci.manga_id = m.manga_id
-           WHERE ci.collection_id = ?
-           ORDER BY ci.added_at DESC''',
+        '''SELECT manga_id, added_at FROM collection_items
+           WHERE collection_id = ?
+           ORDER BY added_at DESC''',
         (coll_id,)
     )
-    rows = [dict(r) for r in c.fetchall()]
+    rows = c.fetchall()
     conn.close()
-    return jsonify(rows)
+    return jsonify(manga_cards.hydrate(rows))
 
 
 @bp.route('/api/collections/<int:coll_id>/manga', methods=['POST'])
@@ -3459,15 +3250,14 @@ def collection_detail(coll_id):
         c.execute('SELECT 1 FROM collection_likes WHERE user_id = ? AND collection_id = ?', (user_id, coll_id))
         my_like = c.fetchone() is not None
     c.execute(
-        '''SELECT m.manga_id, m.manga_title, m.manga_slug, m.cover_url, m.manga_type
-           FROM collection_items ci
-           JOIN manga m ON ci.manga_id = m.manga_id
-           WHERE ci.collection_id = ?
-           ORDER BY ci.added_at DESC''',
+        '''SELECT manga_id FROM collection_items
+           WHERE collection_id = ?
+           ORDER BY added_at DESC''',
         (coll_id,)
     )
-    items = [dict(r) for r in c.fetchall()]
+    ids = [r['manga_id'] for r in c.fetchall()]
     conn.close()
+    items = manga_cards.get_many(ids)
     owner_name = (coll['owner_name'] or coll['telegram_first_name'] or
                   coll['telegram_username'] or f'#{coll["user_id"]}')
     is_owner = (user_id == coll['user_id'])
@@ -3705,11 +3495,12 @@ def api_admin_users():
                COALESCE(up.avatar_url,'') as avatar_url,
                COALESCE(s.xp,0) as xp, COALESCE(s.level,1) as level, COALESCE(s.coins,0) as coins,
                COALESCE(s.total_chapters_read,0) as chapters_read,
-               (SELECT COUNT(*) FROM subscriptions WHERE user_id=u.id) as sub_count,
-               (SELECT COUNT(*) FROM comments WHERE user_id=u.id) as comment_count
+               COALESCE(uc.subscriptions_count,0) as sub_count,
+               COALESCE(uc.comments_count,0) as comment_count
         FROM users u
         LEFT JOIN user_profile up ON up.user_id = u.id
         LEFT JOIN user_stats s ON s.user_id = u.id
+        LEFT JOIN user_counters uc ON uc.user_id = u.id
         {where}
         ORDER BY u.id DESC
         LIMIT ? OFFSET ?
@@ -3793,6 +3584,8 @@ def api_admin_set_xp(uid):
         c.execute('UPDATE user_stats SET level = ? WHERE user_id = ?', (new_level, uid))
     conn.commit()
     conn.close()
+    if row:
+        leaderboard.set_xp(uid, row['xp'])
     return jsonify({'success': True})
 
 
@@ -4045,11 +3838,17 @@ def api_admin_manga():
 @bp.route('/api/admin/xp_log')
 @admin_required
 def api_admin_xp_log():
+    """Журнал XP. ?view=daily — дневные суммы: свёрнутая история из xp_log_daily
+    плюс свежие дни, сгруппированные на лету (?from=&to= — диапазон дат YYYY-MM-DD)."""
     page = int(request.args.get('page', 1))
     per_page = int(request.args.get('per_page', 50))
     uid = request.args.get('uid')
     offset = (page - 1) * per_page
 
+    if request.args.get('view') == 'daily':
+        return _admin_xp_log_daily(uid, request.args.get('from'), request.args.get('to'),
+                                   per_page, offset)
+
     conn = get_db()
     c = conn.cursor()
 
@@ -4075,6 +3874,72 @@ def api_admin_xp_log():
     return jsonify({'logs': rows, 'total': total})
 
 
+def _admin_xp_log_daily(uid, date_from, date_to, per_page, offset):
+    conn = get_db()
+    c = conn.cursor()
+    # (условие для xp_log, условие для xp_log_daily, значение)
+    conds = []
+    if uid:
+        conds.append(('user_id = ?', 'user_id = ?', int(uid)))
+    if date_from:
+        conds.append(('created_at >= ?', 'day >= ?', date_from))
+    if date_to:
+        conds.append(('SUBSTR(CAST(created_at AS TEXT), 1, 10) <= ?', 'day <= ?', date_to))
+    live_sql = ('WHERE ' + ' AND '.join(cd[0] for cd in conds)) if conds else ''
+    hist_sql = ('WHERE ' + ' AND '.join(cd[1] for cd in conds)) if conds else ''
+    values = [cd[2] for cd in conds]
+    union = f'''
+        SELECT user_id, day, reason, SUM(amount) AS amount, SUM(entries) AS entries FROM (
+            SELECT user_id, SUBSTR(CAST(created_at AS TEXT), 1, 10) AS day, reason,
+                   amount, 1 AS entries
+            FROM xp_log {live_sql}
+            UNION ALL
+            SELECT user_id, day, reason, amount, entries FROM xp_log_daily {hist_sql}
+        ) t GROUP BY user_id, day, reason'''
+    params = values + values
+
+    c.execute(f'SELECT COUNT(*) FROM ({union}) d', params)
+    total = c.fetchone()[0]
+    c.execute(f'''
+        SELECT d.user_id, d.day, d.reason, d.amount, d.entries,
+               u.telegram_username, u.telegram_first_name,
+               COALESCE(up.custom_name,'') as custom_name
+        FROM ({union}) d
+        JOIN users u ON u.id = d.user_id
+        LEFT JOIN user_profile up ON up.user_id = d.user_id
+        ORDER BY d.day DESC, d.amount DESC
+        LIMIT ? OFFSET ?
+    ''', params + [per_page, offset])
+    rows = [dict(r) for r in c.fetchall()]
+    conn.close()
+    return jsonify({'logs': rows, 'total': total, 'view': 'daily'})
+
+
+# ── Фоновые задачи ───────────────────────────────────────────────────────────
+
+@bp.route('/api/admin/scheduler')
+@admin_required
+def api_admin_scheduler():
+    """Состояние и метрики задач планировщика."""
+    return jsonify({'tasks': _m().background_scheduler.status()})
+
+
+@bp.route('/api/admin/crawler')
+@admin_required
+def api_admin_crawler():
+    """Метрики краулера подписок: очередь, задержка обнаружения новых глав."""
+    return jsonify(update_crawler.status())
+
+
+@bp.route('/api/admin/scheduler/<name>/run', methods=['POST'])
+@admin_required
+def api_admin_scheduler_run(name):
+    """Запустить задачу вне расписания."""
+    if not _m().background_scheduler.run_now(name):
+        return jsonify({'error': 'Задача не найдена или уже выполняется'}), 409
+    return jsonify({'success': True})
+
+
 # ── Достижения (admin CRUD) ──────────────────────────────────────────────────
 
 ACHIEVEMENT_UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'uploads', 'achievements')
@@ -4132,6 +3997,7 @@ def api_admin_achievements_create():
         conn.close()
         return jsonify({'error': 'Ключ уже существует'}), 409
     conn.close()
+    _rules.invalidate()
     return jsonify({'success': True, 'id': ach_id})
 
 
@@ -4153,6 +4019,7 @@ def api_admin_achievements_update(ach_id):
     c.execute(f'UPDATE achievements SET {", ".join(fields)} WHERE id=?', vals)
     conn.commit()
     conn.close()
+    _rules.invalidate()
     return jsonify({'success': True})
 
 
@@ -4164,6 +4031,7 @@ def api_admin_achievements_delete(ach_id):
     c.execute('DELETE FROM achievements WHERE id=?', (ach_id,))
     conn.commit()
     conn.close()
+    _rules.invalidate()
     return jsonify({'success': True})
 
 
@@ -4222,6 +4090,7 @@ def api_admin_quests_create():
     conn.commit()
     qid = c.lastrowid
     conn.close()
+    _rules.invalidate()
     return jsonify({'success': True, 'id': qid})
 
 
@@ -4243,6 +4112,7 @@ def api_admin_quests_update(qid):
     c.execute(f'UPDATE quests SET {", ".join(fields)} WHERE id=?', vals)
     conn.commit()
     conn.close()
+    _rules.invalidate()
     return jsonify({'success': True})
 
 
@@ -4255,6 +4125,7 @@ def api_admin_quests_delete(qid):
     c.execute('DELETE FROM quests WHERE id=?', (qid,))
     conn.commit()
     conn.close()
+    _rules.invalidate()
     return jsonify({'success': True})
 
 
@@ -0,0 +1,101 @@
+"""
+rules.py — кеш правил ачивок/заданий и счётчиков пользователей.
+
+check_achievements / check_quests раньше на каждое начисление XP перечитывали
+таблицы achievements и quests целиком и считали COUNT(*) по subscriptions и
+comments. Теперь:
+
+  - определения правил загружаются один раз и хранятся в памяти,
+    сгруппированными по condition_type; кеш версионируется и сбрасывается
+    админскими CRUD-эндпоинтами (invalidate()), а также по TTL — чтобы
+    другие воркеры подхватили изменения
+  - счётчики пользователя (подписки, комментарии) читаются одной строкой
+    из user_counters — их поддерживают триггеры БД (database.USER_COUNTERS)
+  - проверяются только правила тех condition_type, чьи значения изменились
+"""
+
+import time
+import threading
+
+# Перечитывать правила не реже, чем раз в RULES_TTL секунд
+RULES_TTL = 300
+
+# Поля user_stats, которые служат значениями правил
+STAT_FIELDS = {
+    'chapters_read': 'total_chapters_read',
+    'level': 'level',
+}
+
+# Поля user_counters, которые раньше считались COUNT(*) на каждую проверку
+COUNTER_FIELDS = {
+    'subscriptions':   'subscriptions_count',
+    'comments_posted': 'comments_count',
+}
+
+
+class _RuleCache:
+    """Правила, сгруппированные по condition_type и отсортированные по condition_value."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._loaded_version = -1
+        self._loaded_at = 0.0
+        self._achievements = {}
+        self._quests = {}
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+    def _ensure(self, conn):
+        now = time.monotonic()
+        with self._lock:
+            if self._loaded_version == self.version and now - self._loaded_at < RULES_TTL:
+                return
+            version = self.version
+        achievements, quests = {}, {}
+        for r in conn.execute('SELECT * FROM achievements').fetchall():
+            achievements.setdefault(r['condition_type'], []).append(dict(r))
+        for r in conn.execute('SELECT * FROM quests WHERE is_active = 1').fetchall():
+            quests.setdefault(r['condition_type'], []).append(dict(r))
+        for group in (achievements, quests):
+            for rules in group.values():
+                rules.sort(key=lambda r: r['condition_value'])
+        with self._lock:
+            # Если за время загрузки прилетел invalidate() — версия не совпадёт,
+            # и следующий вызов перечитает правила ещё раз
+            self._achievements, self._quests = achievements, quests
+            self._loaded_version = version
+            self._loaded_at = now
+
+    def achievements(self, conn, types=None):
+        """{condition_type: [rule, ...]} для указанных типов (None — все)."""
+        self._ensure(conn)
+        with self._lock:
+            data = self._achievements
+        return data if types is None else {t: data[t] for t in types if t in data}
+
+    def quests(self, conn, types=None):
+        self._ensure(conn)
+        with self._lock:
+            data = self._quests
+        return data if types is None else {t: data[t] for t in types if t in data}
+
+
+rule_cache = _RuleCache()
+
+
+def invalidate():
+    """Сбросить кеш правил (вызывается после изменения achievements / quests)."""
+    rule_cache.invalidate()
+
+
+def stat_values(conn, user_id, stats, types):
+    """Значения правил нужных типов: поля user_stats + счётчики user_counters."""
+    values = {t: stats[f] or 0 for t, f in STAT_FIELDS.items() if t in types}
+    wanted = [t for t in types if t in COUNTER_FIELDS]
+    if wanted:
+        row = conn.execute('SELECT * FROM user_counters WHERE user_id = ?', (user_id,)).fetchone()
+        values.update({t: (row[COUNTER_FIELDS[t]] if row else 0) for t in wanted})
+    return values
@@ -0,0 +1,226 @@
+"""
+scheduler.py — планировщик фоновых задач.
+
+Заменяет цикл `while True: time.sleep(60)` в background_checker, где все
+задачи шли подряд и медленная проверка глав задерживала остальные.
+
+  - у каждой задачи свой интервал (секунды) или cron-выражение (UTC,
+    5 полей: минута час день месяц день_недели; *, списки, диапазоны, шаги);
+    интервал может быть функцией — тогда он пересчитывается перед каждым
+    планированием (адаптивный опрос)
+  - jitter — случайная добавка к каждому запуску, чтобы задачи не
+    стартовали в одну секунду
+  - перекрытия исключены: пока задача выполняется, следующий запуск
+    пропускается (и учитывается в метриках)
+  - задачи выполняются параллельно в ограниченном пуле потоков
+  - status() — метрики по каждой задаче для админки
+"""
+
+import time
+import random
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_TICK = 1.0
+
+
+class CronSpec:
+    """Cron-выражение из 5 полей. День недели: 0 или 7 — воскресенье, 1 — понедельник."""
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError(f'cron: нужно 5 полей, получено {expr!r}')
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, dows = (
+            self._parse(p, lo, hi) for p, (lo, hi) in zip(parts, self._RANGES)
+        )
+        self.dows = {d % 7 for d in dows}
+        self._any_day = parts[2] == '*'
+        self._any_dow = parts[4] == '*'
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step_s = part.split('/', 1)
+                step = int(step_s)
+            if part == '*':
+                start, end = lo, hi
+            elif '-' in part:
+                start, end = (int(x) for x in part.split('-', 1))
+            else:
+                start = end = int(part)
+            if start < lo or end > hi or step < 1:
+                raise ValueError(f'cron: значение вне диапазона в {field!r}')
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt):
+        dom = dt.day in self.days
+        dow = (dt.isoweekday() % 7) in self.dows
+        # Как в cron: если заданы оба поля — достаточно совпадения одного
+        if self._any_day:
+            return dow
+        if self._any_dow:
+            return dom
+        return dom or dow
+
+    def next_after(self, dt):
+        """Ближайший момент (с точностью до минуты) строго после dt."""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months or not self._day_matches(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+                continue
+            if dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+                continue
+            return dt
+        raise ValueError(f'cron: выражение {self.expr!r} никогда не срабатывает')
+
+
+class Task:
+    def __init__(self, name, func, interval=None, cron=None, jitter=0, run_on_start=False):
+        if (interval is None) == (cron is None):
+            raise ValueError('нужно указать ровно одно из interval / cron')
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.cron = CronSpec(cron) if cron else None
+        self.jitter = jitter
+        self.running = False
+        self.next_run = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_started = None
+        self.last_duration = None
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.last_error = None
+        self._schedule(time.time(), first=True, run_on_start=run_on_start)
+
+    def _schedule(self, now, first=False, run_on_start=False):
+        if first and run_on_start:
+            base = now
+        elif self.cron:
+            base = self.cron.next_after(datetime.utcfromtimestamp(now)) - datetime(1970, 1, 1)
+            base = base.total_seconds()
+        else:
+            base = now + self._interval()
+        self.next_run = base + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def _interval(self):
+        return self.interval() if callable(self.interval) else self.interval
+
+    def status(self):
+        def _iso(ts):
+            return datetime.utcfromtimestamp(ts).isoformat(timespec='seconds') if ts else None
+        return {
+            'name': self.name,
+            'schedule': self.cron.expr if self.cron else f'every {self._interval()}s',
+            'running': self.running,
+            'next_run': _iso(self.next_run),
+            'last_started': _iso(self.last_started),
+            'last_duration': round(self.last_duration, 3) if self.last_duration is not None else None,
+            'avg_duration': round(self.total_duration / self.runs, 3) if self.runs else None,
+            'max_duration': round(self.max_duration, 3),
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped_overlaps': self.skipped,
+            'last_error': self.last_error,
+        }
+
+
+class Scheduler:
+    def __init__(self, max_workers=4):
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sched')
+        self._thread = None
+        self._stop = threading.Event()
+
+    def add(self, name, func, interval=None, cron=None, jitter=0, run_on_start=False):
+        task = Task(name, func, interval=interval, cron=cron, jitter=jitter,
+                    run_on_start=run_on_start)
+        with self._lock:
+            self._tasks[name] = task
+        return task
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+        self._thread.start()
+        logger.info(f"🗓  Планировщик запущен: {', '.join(self._tasks)}")
+
+    def stop(self):
+        self._stop.set()
+
+    def run_now(self, name):
+        """Запустить задачу вне расписания. False — задача не найдена или уже выполняется."""
+        with self._lock:
+            task = self._tasks.get(name)
+            if not task or task.running:
+                return False
+            task.running = True
+        self._pool.submit(self._run, task)
+        return True
+
+    def status(self):
+        with self._lock:
+            return [t.status() for t in self._tasks.values()]
+
+    def _loop(self):
+        while not self._stop.wait(_TICK):
+            now = time.time()
+            with self._lock:
+                due = [t for t in self._tasks.values() if t.next_run <= now]
+                for task in due:
+                    task._schedule(now)
+                    if task.running:
+                        task.skipped += 1
+                        continue
+                    task.running = True
+                    try:
+                        self._pool.submit(self._run, task)
+                    except RuntimeError:
+                        # Пул закрыт — интерпретатор завершается
+                        return
+
+    def _run(self, task):
+        started = time.time()
+        error = None
+        try:
+            task.func()
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            logger.error(f"❌ Задача {task.name}: {error}")
+        duration = time.time() - started
+        with self._lock:
+            task.running = False
+            task.runs += 1
+            task.last_started = started
+            task.last_duration = duration
+            task.total_duration += duration
+            task.max_duration = max(task.max_duration, duration)
+            if callable(task.interval):
+                # Адаптивный интервал зависит от результата прогона — отсчитываем от его конца
+                task._schedule(time.time())
+            if error:
+                task.failures += 1
+                task.last_error = error
@@ -52,7 +52,7 @@ $$ LANGUAGE plpgsql;
 
 DROP TRIGGER IF EXISTS manga_search_vector_trig ON manga;
 CREATE TRIGGER manga_search_vector_trig
-    BEFORE INSERT OR UPDATE ON manga
+    BEFORE INSERT OR UPDATE OF manga_title, original_name, description ON manga
     FOR EACH ROW EXECUTE FUNCTION manga_search_vector_update();
 
 -- ── Главы ───────────────────────────────────────────────────────────────────
@@ -72,6 +72,8 @@ CREATE TABLE IF NOT EXISTS chapters (
     FOREIGN KEY (manga_id) REFERENCES manga(manga_id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_chapters_manga_number ON chapters(manga_id, chapter_number);
+
 -- ── Пользователи ────────────────────────────────────────────────────────────
 
 CREATE TABLE IF NOT EXISTS users (
@@ -96,6 +98,8 @@ CREATE TABLE IF NOT EXISTS users (
 CREATE INDEX IF NOT EXISTS idx_users_telegram_id   ON users(telegram_id);
 CREATE INDEX IF NOT EXISTS idx_users_login_token   ON users(login_token);
 CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code);
+CREATE INDEX IF NOT EXISTS idx_users_premium_expires ON users(premium_expires_at)
+    WHERE premium_expires_at IS NOT NULL;
 
 -- ── Подписки ─────────────────────────────────────────────────────────────────
 
@@ -145,6 +149,17 @@ CREATE TABLE IF NOT EXISTS search_history (
 );
 
 CREATE INDEX IF NOT EXISTS idx_search_user ON search_history(user_id);
+CREATE INDEX IF NOT EXISTS idx_search_history_created ON search_history(created_at);
+
+-- Популярность запросов (search_stats): одна строка на нормализованный запрос
+CREATE TABLE IF NOT EXISTS search_query_stats (
+    query_norm TEXT PRIMARY KEY,
+    query      TEXT NOT NULL,
+    count      INTEGER NOT NULL DEFAULT 0,
+    last_seen  TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_search_query_stats_count ON search_query_stats(count DESC);
 
 -- ── Кеш ─────────────────────────────────────────────────────────────────────
 
@@ -181,7 +196,20 @@ CREATE TABLE IF NOT EXISTS xp_log (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX IF NOT EXISTS idx_xp_log ON xp_log(user_id, ref_id);
+CREATE INDEX IF NOT EXISTS idx_xp_log_dedup   ON xp_log(user_id, ref_id, reason, created_at);
+CREATE INDEX IF NOT EXISTS idx_xp_log_created ON xp_log(created_at);
+
+-- Дневные агрегаты свёрнутого xp_log (xp_ledger.compact)
+CREATE TABLE IF NOT EXISTS xp_log_daily (
+    user_id INTEGER NOT NULL,
+    day     TEXT    NOT NULL,
+    reason  TEXT    NOT NULL,
+    amount  INTEGER NOT NULL DEFAULT 0,
+    entries INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day, reason)
+);
+
+CREATE INDEX IF NOT EXISTS idx_xp_log_daily_day ON xp_log_daily(day);
 
 -- ── Достижения ───────────────────────────────────────────────────────────────
 
@@ -231,6 +259,9 @@ CREATE TABLE IF NOT EXISTS user_items (
     UNIQUE(user_id, item_id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_user_items_expires ON user_items(expires_at)
+    WHERE expires_at IS NOT NULL;
+
 -- ── Профиль ──────────────────────────────────────────────────────────────────
 
 CREATE TABLE IF NOT EXISTS user_profile (
@@ -311,6 +342,24 @@ CREATE TABLE IF NOT EXISTS notification_queue (
 
 CREATE INDEX IF NOT EXISTS idx_notification_queue_user ON notification_queue(user_id);
 
+-- Последняя глава каждой манги, о которой уже разосланы уведомления
+CREATE TABLE IF NOT EXISTS chapter_watermarks (
+    manga_id       TEXT PRIMARY KEY,
+    chapter_id     TEXT NOT NULL,
+    chapter_number TEXT,
+    updated_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Расписание краулера подписок (update_crawler)
+CREATE TABLE IF NOT EXISTS crawl_state (
+    manga_id         TEXT PRIMARY KEY,
+    next_check_at    TIMESTAMP,
+    last_checked_at  TIMESTAMP,
+    interval_seconds INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_crawl_state_next ON crawl_state(next_check_at);
+
 -- ── Уведомления на сайте ─────────────────────────────────────────────────────
 
 CREATE TABLE IF NOT EXISTS site_notifications (
@@ -538,6 +587,16 @@ CREATE TABLE IF NOT EXISTS curator_follows (
 CREATE INDEX IF NOT EXISTS idx_curator_follows          ON curator_follows(author_id);
 CREATE INDEX IF NOT EXISTS idx_curator_follows_follower ON curator_follows(follower_id);
 
+-- ── Счётчики пользователя (триггеры — в database.init_pg_schema) ─────────────
+
+CREATE TABLE IF NOT EXISTS user_counters (
+    user_id             INTEGER PRIMARY KEY REFERENCES users(id),
+    subscriptions_count INTEGER NOT NULL DEFAULT 0,
+    comments_count      INTEGER NOT NULL DEFAULT 0,
+    collections_count   INTEGER NOT NULL DEFAULT 0,
+    followers_count     INTEGER NOT NULL DEFAULT 0
+);
+
 -- ── Дедупликация рекомендаций ────────────────────────────────────────────────
 
 CREATE TABLE IF NOT EXISTS sent_similar_notifications (
@@ -0,0 +1,239 @@
+"""
+search_engine.py — единый поиск по каталогу для SQLite и PostgreSQL.
+
+Раньше у api_search было три расходящиеся ветки (tsvector с plainto_tsquery,
+FTS5 с пробным запросом перед настоящим, LIKE), каждая с отдельным COUNT(*),
+а HTML-страница /search шла мимо полнотекстового поиска. Теперь оба маршрута
+вызывают search() — один запрос на страницу, общее число совпадений берётся
+оконной функцией COUNT(*) OVER (), сам запрос выбирает только manga_id,
+карточки страницы берутся из manga_cards:
+
+  - SQLite: индекс в памяти (search_index), если он собран; иначе FTS5
+    (префиксный поиск по словам запроса)
+  - PostgreSQL: search_vector @@ префиксный tsquery ИЛИ триграммное
+    сходство названия (pg_trgm, индекс idx_manga_trgm) — опечатки в
+    запросе всё равно находят тайтл; ранжирование ts_rank + similarity
+  - ноль совпадений полнотекстового поиска на любом бэкенде — LIKE-поиск
+    подстроки (страница за концом выдачи — пустая, с настоящим total)
+
+ensure_schema() поддерживает индексы каждого бэкенда: manga_fts и триггеры
+синхронизации с manga (SQLite), триггер search_vector и триграммный индекс
+(PostgreSQL). Вызывается из init_db / init_pg_schema.
+"""
+
+import re
+import logging
+
+import manga_cards
+import search_index
+from database import get_db, _USE_PG
+
+logger = logging.getLogger(__name__)
+
+SORTS = {
+    'relevance': None,
+    'score':     'COALESCE(m.score, 0) DESC',
+    'views':     'COALESCE(m.views, 0) DESC',
+    'chapters':  'COALESCE(m.chapters_count, 0) DESC',
+    'updated':   'm.last_updated IS NULL, m.last_updated DESC',
+}
+
+_RE_WORD = re.compile(r'\w+')
+
+
+def _words(query):
+    return _RE_WORD.findall(query.lower())
+
+
+# ── Поддержка индексов ──────────────────────────────────────────────────────
+
+_FTS_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS manga_fts_ai AFTER INSERT ON manga BEGIN
+         INSERT INTO manga_fts(rowid, manga_id, manga_title, original_name, description)
+         VALUES (new.id, new.manga_id, new.manga_title,
+                 COALESCE(new.original_name, ''), COALESCE(new.description, ''));
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS manga_fts_au
+       AFTER UPDATE OF manga_title, original_name, description ON manga BEGIN
+         DELETE FROM manga_fts WHERE rowid = old.id;
+         INSERT INTO manga_fts(rowid, manga_id, manga_title, original_name, description)
+         VALUES (new.id, new.manga_id, new.manga_title,
+                 COALESCE(new.original_name, ''), COALESCE(new.description, ''));
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS manga_fts_ad AFTER DELETE ON manga BEGIN
+         DELETE FROM manga_fts WHERE rowid = old.id;
+       END''',
+)
+
+
+def _ensure_sqlite(conn):
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS manga_fts
+                    USING fts5(manga_id UNINDEXED, manga_title, original_name, description,
+                               tokenize="unicode61 remove_diacritics 1")''')
+    has_triggers = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name = 'manga_fts_ai'"
+    ).fetchone()[0]
+    if not has_triggers:
+        # rowid строки FTS = manga.id: триггеры удаляют по rowid, а не сканом по manga_id
+        conn.execute('DELETE FROM manga_fts')
+        conn.execute('''INSERT INTO manga_fts(rowid, manga_id, manga_title, original_name, description)
+                        SELECT id, manga_id, manga_title, COALESCE(original_name, ''),
+                               COALESCE(description, '')
+                        FROM manga''')
+        for sql in _FTS_TRIGGERS:
+            conn.execute(sql)
+    conn.commit()
+
+
+def _ensure_pg(conn):
+    try:
+        conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"pg_trgm недоступен: {e}")
+    conn.execute(
+        "CREATE OR REPLACE FUNCTION manga_search_vector_update() "
+        "RETURNS trigger AS $func$ "
+        "BEGIN "
+        "  NEW.search_vector := to_tsvector('simple', "
+        "    COALESCE(NEW.manga_title,'') || ' ' || "
+        "    COALESCE(NEW.original_name,'') || ' ' || "
+        "    COALESCE(NEW.description,'')); "
+        "  RETURN NEW; "
+        "END; "
+        "$func$ LANGUAGE plpgsql"
+    )
+    conn.execute("DROP TRIGGER IF EXISTS manga_search_vector_trig ON manga")
+    conn.execute(
+        "CREATE TRIGGER manga_search_vector_trig "
+        "BEFORE INSERT OR UPDATE OF manga_title, original_name, description ON manga "
+        "FOR EACH ROW EXECUTE FUNCTION manga_search_vector_update()"
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_manga_fts_gin ON manga USING GIN(search_vector)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_manga_trgm ON manga USING GIN(manga_title gin_trgm_ops)')
+    # Строки, вставленные в обход триггера (COPY, старые дампы)
+    conn.execute('''UPDATE manga SET search_vector = to_tsvector('simple',
+                        COALESCE(manga_title, '') || ' ' || COALESCE(original_name, '') || ' ' ||
+                        COALESCE(description, ''))
+                    WHERE search_vector IS NULL''')
+    conn.commit()
+
+
+def ensure_schema(conn):
+    """Создать/проверить поисковые индексы и триггеры текущего бэкенда."""
+    if _USE_PG:
+        _ensure_pg(conn)
+    else:
+        _ensure_sqlite(conn)
+
+
+def optimize():
+    """Ночное обслуживание: сироты FTS после INSERT OR REPLACE и слияние сегментов FTS5."""
+    conn = get_db()
+    try:
+        if _USE_PG:
+            conn.execute('ANALYZE manga')
+        else:
+            # REPLACE удаляет строку manga без DELETE-триггера — её FTS-строка остаётся
+            conn.execute('DELETE FROM manga_fts WHERE rowid NOT IN (SELECT id FROM manga)')
+            conn.execute("INSERT INTO manga_fts(manga_fts) VALUES ('optimize')")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ── Запросы ─────────────────────────────────────────────────────────────────
+
+def _page(c, sql, params):
+    """manga_id страницы и общее число совпадений."""
+    rows = c.execute(sql, params).fetchall()
+    return [r['manga_id'] for r in rows], (rows[0]['_total'] if rows else 0)
+
+
+def _search_pg(c, query, words, order, offset, limit):
+    tsq = ' & '.join(f'{w}:*' for w in words)
+    rank = ("ts_rank(m.search_vector, to_tsquery('simple', ?)) + similarity(m.manga_title, ?) DESC, "
+            "COALESCE(m.score, 0) DESC")
+    # %% — оператор сходства pg_trgm (символ % экранирован для psycopg2)
+    return _page(c, f'''
+        SELECT m.manga_id, COUNT(*) OVER () AS _total
+        FROM manga m
+        WHERE m.search_vector @@ to_tsquery('simple', ?) OR m.manga_title %% ?
+        ORDER BY {order or rank}
+        LIMIT ? OFFSET ?''',
+        (tsq, query) + (() if order else (tsq, query)) + (limit, offset))
+
+
+def _search_fts(c, words, order, offset, limit):
+    match = ' '.join(f'"{w}"*' for w in words)
+    return _page(c, f'''
+        SELECT m.manga_id, COUNT(*) OVER () AS _total
+        FROM manga_fts f
+        JOIN manga m ON m.id = f.rowid
+        WHERE manga_fts MATCH ?
+        ORDER BY {order or 'f.rank'}
+        LIMIT ? OFFSET ?''',
+        (match, limit, offset))
+
+
+def _search_like(c, query, order, offset, limit):
+    like, starts = f'%{query}%', f'{query}%'
+    rel = ('CASE WHEN lower(m.manga_title) = lower(?) THEN 10 '
+           'WHEN lower(m.manga_title) LIKE lower(?) THEN 5 ELSE 1 END DESC, '
+           'COALESCE(m.score, 0) DESC')
+    return _page(c, f'''
+        SELECT m.manga_id, COUNT(*) OVER () AS _total
+        FROM manga m
+        WHERE m.manga_title LIKE ? OR m.original_name LIKE ? OR m.manga_slug LIKE ?
+        ORDER BY {order or rel}
+        LIMIT ? OFFSET ?''',
+        (like, like, like) + (() if order else (query, starts)) + (limit, offset))
+
+
+def _paged(run, offset, limit):
+    """run(offset, limit) → (ids, total); за концом выдачи total — с первой строки.
+
+    Окно COUNT(*) OVER () на пустой странице не даёт total, а без него
+    бесконечная прокрутка приняла бы конец выдачи за «ничего не найдено».
+    """
+    ids, total = run(offset, limit)
+    if not ids and offset:
+        _, total = run(0, 1)
+    return ids, total
+
+
+def search(query, sort='relevance', offset=0, limit=25):
+    """Страница карточек (manga_cards) и общее число совпадений."""
+    query = (query or '').strip()
+    if len(query) < 2:
+        return [], 0
+    if sort not in SORTS:
+        sort = 'relevance'
+    if not _USE_PG and search_index.enabled():
+        return search_index.search(query, sort, offset, limit)
+
+    order = SORTS[sort]
+    words = _words(query)
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        ids, total = [], 0
+        if words:
+            try:
+                if _USE_PG:
+                    ids, total = _paged(lambda o, n: _search_pg(c, query, words, order, o, n),
+                                        offset, limit)
+                else:
+                    ids, total = _paged(lambda o, n: _search_fts(c, words, order, o, n),
+                                        offset, limit)
+            except Exception as e:
+                conn.rollback()
+                logger.warning(f"search_engine: полнотекстовый поиск не удался: {e}")
+        if not total:
+            # Полнотекстовый поиск не нашёл ничего — подстрока внутри слова
+            # (на PostgreSQL LIKE по названию тоже идёт по idx_manga_trgm)
+            ids, total = _paged(lambda o, n: _search_like(c, query, order, o, n), offset, limit)
+    finally:
+        conn.close()
+    return manga_cards.get_many(ids), total
@@ -0,0 +1,335 @@
+"""
+search_index.py — поисковый индекс каталога в памяти процесса (SQLite).
+
+На SQLite /search и LIKE-ветка api_search делали `%query%` по трём колонкам
+плюс отдельный COUNT(*), подсказки — LIKE по manga_title/original_name:
+каждый запрос — полный проход по manga. Теперь поиск идёт по индексу в
+памяти, а карточки страницы берутся из manga_cards:
+
+  - нормализация: casefold, ё → е, пунктуация → пробел, кириллица
+    транслитерируется в латиницу — «ван пис», «Van Piece» и «van-pis»
+    попадают в одно пространство ключей
+  - триграммный инвертированный индекс по названию, оригинальному названию
+    и slug: кандидаты — пересечение списков триграмм запроса, затем
+    проверка вхождения подстроки (как LIKE '%q%'); если точных совпадений
+    нет — нечёткий поиск по доле общих триграмм (опечатки)
+  - префиксный индекс (отсортированный список начал слов, bisect) для
+    подсказок
+  - ранжирование: точное совпадение названия > начало названия > начало
+    слова > подстрока > оригинальное название/slug > нечёткое, внутри —
+    по score
+
+Индекс строится при старте (задача планировщика) и целиком перестраивается
+раз в REBUILD_INTERVAL — так подхватываются записи скриптов вне процесса.
+Пока первая сборка не закончилась, enabled() → False и поиск идёт через FTS.
+Записи manga внутри процесса сразу передаются в refresh().
+На PostgreSQL индекс не используется (enabled() → False).
+"""
+
+import re
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+
+import manga_cards
+from database import get_db, _USE_PG
+
+logger = logging.getLogger(__name__)
+
+# Полная пересборка из БД (секунды)
+REBUILD_INTERVAL = 900
+# Минимальная доля общих триграмм для нечёткого совпадения
+FUZZY_THRESHOLD = 0.5
+# Сколько записей префиксного индекса просматривать на одну подсказку
+SUGGEST_SCAN = 2000
+
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n',
+    'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f',
+    'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y',
+    'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya', 'і': 'i', 'ї': 'i', 'є': 'e',
+})
+_RE_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """Ключ для сравнения: нижний регистр, ё → е, транслит, только буквы/цифры и пробелы."""
+    if not text:
+        return ''
+    text = str(text).casefold().replace('ё', 'е').translate(_TRANSLIT)
+    return _RE_NON_WORD.sub(' ', text).strip()
+
+
+def _trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+class _Doc:
+    __slots__ = ('manga_id', 'title', 'fields', 'score', 'views', 'chapters', 'updated')
+
+    def __init__(self, row):
+        self.manga_id = row['manga_id']
+        self.title = row['manga_title'] or ''
+        # Ключи: название, оригинальное название, slug
+        self.fields = tuple(normalize(row[col]) for col in
+                            ('manga_title', 'original_name', 'manga_slug'))
+        self.score = row['score'] or 0
+        self.views = row['views'] or 0
+        self.chapters = row['chapters_count'] or 0
+        self.updated = str(row['last_updated'] or '')
+
+    def grams(self):
+        grams = set()
+        for key in self.fields:
+            if key:
+                # Пробелы по краям — триграммы начала и конца слова
+                grams |= _trigrams(f' {key} ')
+        return grams
+
+    def prefixes(self):
+        """Начала слов названия и оригинального названия: 'van pis' → 'van pis', 'pis'."""
+        keys = set()
+        for key in self.fields[:2]:
+            for m in re.finditer(r'(?:^| )(?=\S)', key):
+                keys.add(key[m.end():])
+        return keys
+
+    def quality(self, key):
+        title, original, slug = self.fields
+        if title == key:
+            return 100
+        if title.startswith(key):
+            return 50
+        if f' {key}' in f' {title}':
+            return 30
+        if key in title:
+            return 20
+        if original == key or original.startswith(key) or slug.startswith(key):
+            return 15
+        return 10
+
+
+_SORT_KEYS = {
+    'score':    lambda d: -d.score,
+    'views':    lambda d: -d.views,
+    'chapters': lambda d: -d.chapters,
+}
+
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}        # manga_id → _Doc
+        self._grams = {}       # триграмма → set(manga_id)
+        self._prefixes = []    # отсортированные (префиксный ключ, manga_id)
+        self.built_at = None
+        self.build_seconds = None
+
+    # ── Построение ──────────────────────────────────────────────────────────
+
+    def _add(self, doc):
+        self._docs[doc.manga_id] = doc
+        for gram in doc.grams():
+            self._grams.setdefault(gram, set()).add(doc.manga_id)
+
+    def _remove(self, manga_id):
+        doc = self._docs.pop(manga_id, None)
+        if doc is None:
+            return
+        for gram in doc.grams():
+            ids = self._grams.get(gram)
+            if ids:
+                ids.discard(manga_id)
+                if not ids:
+                    del self._grams[gram]
+        for key in doc.prefixes():
+            i = bisect.bisect_left(self._prefixes, (key, manga_id))
+            if i < len(self._prefixes) and self._prefixes[i] == (key, manga_id):
+                del self._prefixes[i]
+
+    def load(self, rows):
+        """Собрать индекс заново из строк manga и атомарно подменить текущий."""
+        started = time.perf_counter()
+        fresh = SearchIndex()
+        prefixes = []
+        for row in rows:
+            doc = _Doc(row)
+            fresh._add(doc)
+            prefixes.extend((key, doc.manga_id) for key in doc.prefixes())
+        prefixes.sort()
+        with self._lock:
+            self._docs, self._grams, self._prefixes = fresh._docs, fresh._grams, prefixes
+            self.built_at = time.time()
+            self.build_seconds = time.perf_counter() - started
+
+    def upsert(self, row):
+        doc = _Doc(row)
+        with self._lock:
+            self._remove(doc.manga_id)
+            self._add(doc)
+            for key in doc.prefixes():
+                bisect.insort(self._prefixes, (key, doc.manga_id))
+
+    def remove(self, manga_id):
+        with self._lock:
+            self._remove(manga_id)
+
+    def __len__(self):
+        return len(self._docs)
+
+    # ── Запросы ─────────────────────────────────────────────────────────────
+
+    def _match(self, key):
+        """[(doc, quality)] — подстрока в любом поле, иначе нечёткие по триграммам."""
+        grams = _trigrams(key)
+        if not grams:
+            # Двухсимвольный запрос: триграмм нет, проверяем вхождение напрямую
+            return [(d, d.quality(key)) for d in self._docs.values()
+                    if any(key in f for f in d.fields)]
+
+        postings = sorted((self._grams.get(g, ()) for g in grams), key=len)
+        if postings[0]:
+            candidates = set(postings[0]).intersection(*postings[1:])
+            exact = [(self._docs[i], self._docs[i].quality(key)) for i in candidates
+                     if any(key in f for f in self._docs[i].fields)]
+            if exact:
+                return exact
+
+        # Опечатка: доля триграмм запроса, встречающихся в документе
+        counts = Counter()
+        for ids in postings:
+            counts.update(ids)
+        need = len(grams) * FUZZY_THRESHOLD
+        return [(self._docs[i], int(10 * n / len(grams))) for i, n in counts.items()
+                if n >= need]
+
+    def search(self, query, sort='relevance', offset=0, limit=25):
+        """Страница manga_id и общее число совпадений."""
+        key = normalize(query)
+        if len(key) < 2:
+            return [], 0
+        with self._lock:
+            matches = self._match(key)
+        if sort in _SORT_KEYS:
+            by = _SORT_KEYS[sort]
+            matches.sort(key=lambda m: by(m[0]))
+        elif sort == 'updated':
+            matches.sort(key=lambda m: m[0].updated, reverse=True)
+        else:
+            matches.sort(key=lambda m: (-m[1], -m[0].score))
+        return [d.manga_id for d, _ in matches[offset:offset + limit]], len(matches)
+
+    def suggest(self, query, limit=8):
+        """Названия, у которых название или слово в нём начинается с запроса."""
+        key = normalize(query)
+        if len(key) < 2:
+            return []
+        found = {}
+        with self._lock:
+            i = bisect.bisect_left(self._prefixes, (key,))
+            for prefix, manga_id in self._prefixes[i:i + SUGGEST_SCAN]:
+                if not prefix.startswith(key):
+                    break
+                doc = self._docs.get(manga_id)
+                if doc and manga_id not in found:
+                    found[manga_id] = (doc.fields[0].startswith(key), doc.score, doc.title)
+        ranked = sorted(found.values(), key=lambda v: (not v[0], -v[1]))
+        titles, seen = [], set()
+        for _, _, title in ranked:
+            if title and title.lower() not in seen:
+                seen.add(title.lower())
+                titles.append(title)
+                if len(titles) >= limit:
+                    break
+        return titles
+
+
+_index = SearchIndex()
+_build_lock = threading.Lock()
+_failed = False
+
+_SELECT = ('SELECT manga_id, manga_slug, manga_title, original_name, '
+           'score, views, chapters_count, last_updated FROM manga')
+
+
+def supported():
+    """Индекс вообще используется на этом бэкенде (SQLite)."""
+    return not _USE_PG
+
+
+def enabled():
+    """Индекс обслуживает поиск: SQLite, первая сборка прошла и не упала.
+
+    До конца первой сборки (задача планировщика) поиск идёт через FTS/LIKE,
+    а не ждёт полного чтения manga в запросе пользователя.
+    """
+    return not _USE_PG and not _failed and _index.built_at is not None
+
+
+def rebuild(force=True):
+    """Перечитать manga и пересобрать индекс. force=False — только если ещё не собран."""
+    global _failed
+    if _USE_PG:
+        return
+    with _build_lock:
+        # Ждавшие блокировку вызовы не пересобирают индекс повторно
+        if not force and _index.built_at is not None:
+            return
+        conn = get_db()
+        try:
+            rows = conn.execute(_SELECT).fetchall()
+        except Exception as e:
+            _failed = True
+            logger.error(f"❌ Поисковый индекс не собран: {e}")
+            return
+        finally:
+            conn.close()
+        _index.load(rows)
+        _failed = False
+    logger.info(f"🔎 Поисковый индекс: {len(_index)} тайтлов за {_index.build_seconds:.2f}с")
+
+
+def _ensure_built():
+    if _index.built_at is None:
+        rebuild(force=False)
+
+
+def refresh(manga_id):
+    """Переиндексировать один тайтл после записи в manga (до первой сборки — ничего)."""
+    if _USE_PG or _index.built_at is None:
+        return
+    conn = get_db()
+    try:
+        row = conn.execute(f'{_SELECT} WHERE manga_id = ?', (manga_id,)).fetchone()
+    finally:
+        conn.close()
+    if row:
+        _index.upsert(row)
+    else:
+        _index.remove(manga_id)
+
+
+def search(query, sort='relevance', offset=0, limit=25):
+    """Страница карточек (manga_cards) в порядке ранжирования и total."""
+    _ensure_built()
+    ids, total = _index.search(query, sort, offset, limit)
+    return manga_cards.get_many(ids), total
+
+
+def suggest(query, limit=8):
+    _ensure_built()
+    return _index.suggest(query, limit)
+
+
+def status():
+    return {
+        'enabled': enabled(),
+        'documents': len(_index),
+        'trigrams': len(_index._grams),
+        'prefixes': len(_index._prefixes),
+        'built_at': _index.built_at,
+        'build_seconds': round(_index.build_seconds, 3) if _index.build_seconds else None,
+    }
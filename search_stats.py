@@ -0,0 +1,134 @@
+"""
+search_stats.py — агрегированная статистика поисковых запросов.
+
+save_search_history вставлял строку на каждый поиск каждого пользователя и
+держал историю вечно, а подсказки сканировали её через DISTINCT + LIKE.
+Теперь популярность запросов живёт в маленькой search_query_stats:
+
+  - record() копит запросы в памяти процесса (Counter по нормализованному
+    тексту), flush() сбрасывает буфер одним executemany-upsert
+    count = count + n — раз в FLUSH_INTERVAL (задача планировщика), при
+    переполнении буфера и при выходе процесса
+  - prune_history() — политика хранения сырой search_history: не старше
+    HISTORY_DAYS и не больше HISTORY_PER_USER последних запросов на
+    пользователя (ночная задача вместо DELETE на каждый поиск)
+  - popular() — запросы по убыванию count для подсказок
+"""
+
+import atexit
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from database import get_db
+from search_index import normalize
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 30
+# Сбросить буфер сразу, если в нём столько разных запросов
+FLUSH_SIZE = 1000
+# Хранение сырой истории поиска
+HISTORY_DAYS = 90
+HISTORY_PER_USER = 50
+# Запросы длиннее не учитываются (мусор, вставленные тексты)
+MAX_QUERY_LEN = 100
+
+_lock = threading.Lock()
+_counts = Counter()
+_texts = {}       # query_norm → последний исходный текст
+_last_seen = {}   # query_norm → время последнего запроса
+
+
+def record(query):
+    """Учесть поисковый запрос (без обращения к БД)."""
+    query = (query or '').strip()
+    key = normalize(query)
+    if len(key) < 2 or len(query) > MAX_QUERY_LEN:
+        return
+    with _lock:
+        _counts[key] += 1
+        _texts[key] = query
+        _last_seen[key] = datetime.utcnow().isoformat()
+        full = len(_counts) >= FLUSH_SIZE
+    if full:
+        flush()
+
+
+def flush():
+    """Сбросить накопленные запросы в search_query_stats. Возвращает число строк."""
+    global _counts, _texts, _last_seen
+    with _lock:
+        if not _counts:
+            return 0
+        counts, texts, last_seen = _counts, _texts, _last_seen
+        _counts, _texts, _last_seen = Counter(), {}, {}
+    rows = [(key, texts[key], n, last_seen[key]) for key, n in counts.items()]
+    conn = get_db()
+    try:
+        conn.executemany(
+            '''INSERT INTO search_query_stats (query_norm, query, count, last_seen)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(query_norm) DO UPDATE
+               SET count = search_query_stats.count + excluded.count,
+                   query = excluded.query,
+                   last_seen = excluded.last_seen''',
+            rows
+        )
+        conn.commit()
+    except Exception as e:
+        # Не теряем буфер: вернём счётчики, следующий flush попробует снова
+        with _lock:
+            _counts.update(counts)
+            for key in counts:
+                _texts.setdefault(key, texts[key])
+                _last_seen.setdefault(key, last_seen[key])
+        logger.error(f"❌ search_stats.flush: {e}")
+        return 0
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def popular(limit=1000, min_count=1):
+    """[(query, count)] по убыванию популярности."""
+    conn = get_db()
+    try:
+        rows = conn.execute(
+            '''SELECT query, count FROM search_query_stats
+               WHERE count >= ? ORDER BY count DESC LIMIT ?''',
+            (min_count, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [(r['query'], r['count']) for r in rows]
+
+
+def prune_history(now=None):
+    """Удалить сырую историю старше HISTORY_DAYS и сверх HISTORY_PER_USER на пользователя."""
+    # Формат CURRENT_TIMESTAMP: 'YYYY-MM-DD HH:MM:SS'
+    cutoff = ((now or datetime.utcnow()) - timedelta(days=HISTORY_DAYS)).isoformat(' ', 'seconds')
+    conn = get_db()
+    try:
+        cur = conn.execute('DELETE FROM search_history WHERE created_at < ?', (cutoff,))
+        old = max(cur.rowcount, 0)
+        cur = conn.execute(
+            '''DELETE FROM search_history WHERE id IN (
+                   SELECT id FROM (
+                       SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id
+                                                     ORDER BY created_at DESC, id DESC) AS rn
+                       FROM search_history
+                   ) ranked WHERE rn > ?)''',
+            (HISTORY_PER_USER,)
+        )
+        extra = max(cur.rowcount, 0)
+        conn.commit()
+    finally:
+        conn.close()
+    if old or extra:
+        logger.info(f"🧹 search_history: удалено {old} старых и {extra} сверх лимита")
+    return old + extra
+
+
+atexit.register(flush)
@@ -6,6 +6,8 @@ import os
 import time
 from pathlib import Path
 
+from downloader import AssetDownloader, DUPLICATE, DOWNLOADED, FAILED, NOT_MODIFIED, SKIPPED
+
 class MiraiCollectiblesParser:
     def __init__(self, base_url="https://api.senkuro.com/graphql", delay=1):
         self.base_url = base_url
@@ -215,109 +217,63 @@ class MiraiCollectiblesParser:
         
         return all_images
     
-    def download_images(self, images, download_dir="static/wallpaper"):
-        """Скачивает все изображения в указанную директорию"""
-        # Создаем директорию если её нет
-        Path(download_dir).mkdir(parents=True, exist_ok=True)
-        
+    @staticmethod
+    def local_filename(img):
+        """Имя локального файла для варианта изображения: <slug>_<variant>.<ext>"""
+        file_ext = img['format'].lower()
+        if file_ext == 'jpeg':
+            file_ext = 'jpg'
+        safe_slug = "".join(c for c in img['slug'] if c.isalnum() or c in '-_').rstrip()
+        if not safe_slug:
+            safe_slug = f"collectible_{img['id']}"
+        return f"{safe_slug}_{img['variant_type']}.{file_ext}"
+
+    def download_images(self, images, download_dir="static/wallpaper", workers=8, rate=10.0):
+        """Скачивает все изображения в указанную директорию (параллельно, с докачкой)"""
         if not images:
             print("Нет изображений для скачивания")
             return 0
-        
-        print(f"\nНачинаем скачивание {len(images)} файлов в {download_dir}...")
-        
-        # Для отслеживания уже скачанных файлов (избегаем дубликатов)
-        downloaded_files = set()
-        downloaded_count = 0
-        skipped_count = 0
-        error_count = 0
-        
-        for idx, img in enumerate(images, 1):
-            try:
-                # Создаем имя файла
-                slug = img['slug']
-                variant = img['variant_type']
-                file_ext = img['format'].lower()
-                
-                # Нормализуем расширения
-                if file_ext == 'jpeg':
-                    file_ext = 'jpg'
-                
-                # Очищаем имя файла от недопустимых символов
-                safe_slug = "".join(c for c in slug if c.isalnum() or c in '-_').rstrip()
-                if not safe_slug:
-                    safe_slug = f"collectible_{img['id']}"
-                
-                filename = f"{safe_slug}_{variant}.{file_ext}"
-                filepath = os.path.join(download_dir, filename)
-                
-                # Пропускаем если файл уже скачан
-                if filename in downloaded_files or os.path.exists(filepath):
-                    print(f"[{idx}/{len(images)}] Пропущено (уже есть): {filename}")
-                    skipped_count += 1
-                    continue
-                
-                # Скачиваем файл
-                response = self.session.get(img['url'], stream=True, timeout=30)
-                response.raise_for_status()
-                
-                # Проверяем размер контента
-                content_length = response.headers.get('content-length')
-                if content_length:
-                    size_mb = int(content_length) / (1024 * 1024)
-                    if size_mb > 0:
-                        print(f"  Размер: {size_mb:.2f} MB")
-                
-                with open(filepath, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                
-                downloaded_files.add(filename)
-                downloaded_count += 1
-                print(f"[{idx}/{len(images)}] Скачано: {filename}")
-                
-                # Небольшая задержка между скачиваниями
-                time.sleep(0.5)
-                
-            except requests.exceptions.Timeout:
-                print(f"[{idx}/{len(images)}] Таймаут при скачивании {img.get('url')}")
-                error_count += 1
-            except requests.exceptions.RequestException as e:
-                print(f"[{idx}/{len(images)}] Ошибка сети: {e}")
-                error_count += 1
-            except Exception as e:
-                print(f"[{idx}/{len(images)}] Ошибка: {e}")
-                error_count += 1
-        
+
+        jobs = [(img['url'], self.local_filename(img)) for img in images]
+        print(f"\nНачинаем скачивание {len(jobs)} файлов в {download_dir} "
+              f"({workers} потоков, до {rate:g} запросов/с)...")
+
+        downloader = AssetDownloader(download_dir, max_workers=workers, rate=rate,
+                                     headers={'User-Agent': self.session.headers['User-Agent']})
+        progress = {'n': 0}
+
+        def _on_result(status, filename, nbytes, err):
+            progress['n'] += 1
+            prefix = f"[{progress['n']}/{len(jobs)}]"
+            if status == FAILED:
+                print(f"{prefix} Ошибка: {filename}: {err}")
+            elif status in (SKIPPED, NOT_MODIFIED):
+                print(f"{prefix} Пропущено (уже есть): {filename}")
+            else:
+                print(f"{prefix} Скачано: {filename} ({nbytes / (1024 * 1024):.2f} MB)")
+
+        counts = downloader.download_many(jobs, on_result=_on_result)
+
         # Сохраняем информацию о файлах
         self.save_download_info(images, download_dir)
-        
+
+        downloaded_count = counts[DOWNLOADED] + counts[DUPLICATE]
         print(f"\nИтоги скачивания:")
-        print(f"  Скачано: {downloaded_count}")
-        print(f"  Пропущено: {skipped_count}")
-        print(f"  Ошибок: {error_count}")
-        
+        print(f"  Скачано: {downloaded_count} (дубликатов по содержимому: {counts[DUPLICATE]})")
+        print(f"  Пропущено: {counts[SKIPPED] + counts[NOT_MODIFIED]}")
+        print(f"  Ошибок: {counts[FAILED]}")
+        print(f"  Скорость: {counts['bytes'] / (1024 * 1024) / counts['elapsed']:.2f} MB/s")
+
         return downloaded_count
-    
+
     def save_download_info(self, images, download_dir):
         """Сохраняет информацию о скачанных файлах"""
         info = []
         seen = set()
         
         for img in images:
-            slug = img['slug']
             variant = img['variant_type']
-            file_ext = img['format'].lower()
-            
-            if file_ext == 'jpeg':
-                file_ext = 'jpg'
-            
-            safe_slug = "".join(c for c in slug if c.isalnum() or c in '-_').rstrip()
-            if not safe_slug:
-                safe_slug = f"collectible_{img['id']}"
-            
-            filename = f"{safe_slug}_{variant}.{file_ext}"
+            filename = self.local_filename(img)
             
             if filename not in seen:
                 seen.add(filename)
@@ -0,0 +1,158 @@
+"""
+suggest_store.py — предрасчитанные подсказки автодополнения.
+
+/api/search/suggestions вызывается на каждое нажатие клавиши. Раньше это был
+LIKE по manga с сортировкой по score, а при малом числе результатов ещё и
+SELECT DISTINCT ... LIKE по неограниченной search_history. Теперь подсказки
+считаются заранее, и запрос — это поиск в словаре:
+
+  - кандидаты: названия и оригинальные названия из manga (вес — score) и
+    популярные запросы из search_query_stats (вес — число повторов)
+  - ключи нормализуются как в search_index (регистр, ё, транслит), индексируются
+    начало текста и начала слов
+  - для каждого префикса длиной MIN_PREFIX..MAX_PREFIX хранится top-K
+    подсказок; на префиксе длины MAX_PREFIX — до LONG_LIST кандидатов, из
+    которых более длинный запрос отбирается по startswith
+  - таблица пересобирается раз в REBUILD_INTERVAL и атомарно подменяется;
+    до первой сборки lookup() не строит её сам, а отвечает через search_index
+
+Работает одинаково на SQLite и PostgreSQL.
+"""
+
+import time
+import heapq
+import logging
+import threading
+
+from database import get_db
+import search_index
+import search_stats
+from search_index import normalize
+
+logger = logging.getLogger(__name__)
+
+REBUILD_INTERVAL = 600
+TOP_K = 8
+MIN_PREFIX = 2
+MAX_PREFIX = 8
+# Сколько кандидатов хранить на самом длинном префиксе
+LONG_LIST = 200
+# Запрос из истории становится подсказкой после стольких повторов
+MIN_QUERY_COUNT = 3
+# Сколько популярных запросов брать в таблицу
+MAX_QUERIES = 20000
+# Популярный запрос стоит стольких баллов score за каждое повторение
+QUERY_WEIGHT = 0.5
+
+_table = {}
+_lock = threading.Lock()
+_build_lock = threading.RLock()
+_meta = {'built_at': None, 'build_seconds': None, 'prefixes': 0, 'candidates': 0}
+
+
+def _starts(key):
+    """Начало текста и начала слов: 'van pis' → 'van pis', 'pis'."""
+    words = key.split(' ')
+    return {' '.join(words[i:]) for i in range(len(words)) if words[i]}
+
+
+def _candidates(conn):
+    """[(вес, текст)] из каталога и истории поиска."""
+    out = []
+    rows = conn.execute(
+        'SELECT manga_title, original_name, score FROM manga WHERE manga_title IS NOT NULL'
+    ).fetchall()
+    for r in rows:
+        weight = float(r['score'] or 0)
+        out.append((weight, r['manga_title']))
+        if r['original_name'] and r['original_name'] != r['manga_title']:
+            # Оригинальное название чуть ниже русского при равном score
+            out.append((weight - 0.01, r['original_name']))
+
+    # Статистика уже свёрнута по нормализованному тексту (search_stats)
+    for query, count in search_stats.popular(MAX_QUERIES, MIN_QUERY_COUNT):
+        out.append((count * QUERY_WEIGHT, query))
+    return out
+
+
+def build(candidates):
+    """Таблица префикс → кортеж подсказок (по убыванию веса, без повторов)."""
+    buckets = {}
+    for weight, text in candidates:
+        key = normalize(text)
+        seen = set()
+        for start in _starts(key):
+            for n in range(MIN_PREFIX, min(len(start), MAX_PREFIX) + 1):
+                prefix = start[:n]
+                if prefix in seen:
+                    continue
+                seen.add(prefix)
+                buckets.setdefault(prefix, []).append((weight, text, key))
+
+    table = {}
+    for prefix, items in buckets.items():
+        size = LONG_LIST if len(prefix) == MAX_PREFIX else TOP_K
+        picked, texts = [], set()
+        for weight, text, key in heapq.nlargest(size * 2, items, key=lambda i: i[0]):
+            if text.lower() in texts:
+                continue
+            texts.add(text.lower())
+            picked.append((text, key))
+            if len(picked) >= size:
+                break
+        table[prefix] = tuple(picked)
+    return table
+
+
+def rebuild():
+    global _table
+    with _build_lock:
+        started = time.perf_counter()
+        conn = get_db()
+        try:
+            candidates = _candidates(conn)
+        finally:
+            conn.close()
+        table = build(candidates)
+        with _lock:
+            _table = table
+            _meta.update(built_at=time.time(),
+                         build_seconds=round(time.perf_counter() - started, 3),
+                         prefixes=len(table), candidates=len(candidates))
+    logger.info(f"💡 Подсказки поиска: {len(table)} префиксов из {len(candidates)} кандидатов "
+                f"за {_meta['build_seconds']}с")
+
+
+def lookup(query, limit=TOP_K):
+    """Подсказки для введённого текста.
+
+    До первой сборки (задача планировщика suggest_rebuild) таблица не строится
+    в запросе: отвечает префиксный индекс каталога, если он готов, иначе [].
+    """
+    key = normalize(query)
+    if len(key) < MIN_PREFIX:
+        return []
+    if _meta['built_at'] is None:
+        return search_index.suggest(query, limit) if search_index.enabled() else []
+    entries = _table.get(key[:MAX_PREFIX], ())
+    if len(key) <= MAX_PREFIX:
+        return [text for text, _ in entries[:limit]]
+
+    # Запрос длиннее хранимого префикса — досматриваем длинный список кандидатов
+    result = [text for text, k in entries
+              if any(s.startswith(key) for s in _starts(k))][:limit]
+    if len(result) < limit and search_index.enabled():
+        # Длинный список мог обрезаться — добираем из префиксного индекса каталога
+        seen = {t.lower() for t in result}
+        result += [t for t in search_index.suggest(query, limit)
+                   if t.lower() not in seen][:limit - len(result)]
+    return result
+
+
+def version():
+    """Метка сборки — для ETag ответов с подсказками."""
+    return int(_meta['built_at'] or 0)
+
+
+def status():
+    return dict(_meta)
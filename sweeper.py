@@ -0,0 +1,119 @@
+"""
+sweeper.py — пакетная очистка истёкших Premium-подписок и временных предметов.
+
+Раньше background_checker раз в минуту делал работу построчно: UPDATE и
+_revoke_premium_loans (SELECT + UPDATE на каждый предмет) для каждого
+пользователя, UPDATE/DELETE для каждого предмета и по отдельному соединению
+на каждое уведомление. Теперь sweep_expired() — несколько set-based
+запросов в одной транзакции:
+
+  1. UPDATE users ... RETURNING id           — все истёкшие Premium разом
+  2. снятие надетых «заёмных» украшений и DELETE их из user_items
+  3. DELETE FROM user_items ... RETURNING    — все истёкшие временные предметы
+  4. снятие этих предметов с профиля и executemany уведомлений
+
+RETURNING требует SQLite 3.35+ (или PostgreSQL).
+"""
+
+import logging
+from datetime import datetime
+
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+# Тип предмета → колонка user_profile, в которой он «надет»
+_PROFILE_COLS = {'frame': 'frame_item_id', 'badge': 'badge_item_id', 'title': 'title_item_id'}
+# Ограничение на длину списков IN (...)
+_CHUNK = 500
+
+
+def _chunks(seq, size=_CHUNK):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _expire_premium(c, now_iso):
+    c.execute(
+        '''UPDATE users SET is_premium = 0, premium_expires_at = NULL
+           WHERE is_premium = 1 AND premium_expires_at IS NOT NULL AND premium_expires_at < ?
+           RETURNING id''',
+        (now_iso,)
+    )
+    user_ids = [r['id'] for r in c.fetchall()]
+    for part in _chunks(user_ids):
+        ph = ','.join('?' * len(part))
+        # Снимаем надетые предметы, выданные на время Premium (логика _revoke_premium_loans)
+        for item_type, col in _PROFILE_COLS.items():
+            c.execute(
+                f'''UPDATE user_profile SET {col} = NULL
+                    WHERE user_id IN ({ph}) AND {col} IN (
+                        SELECT ui.item_id FROM user_items ui
+                        JOIN shop_items si ON si.id = ui.item_id
+                        WHERE ui.user_id = user_profile.user_id
+                          AND ui.is_premium_loan = 1 AND si.type = ?)''',
+                part + [item_type]
+            )
+        c.execute(f'DELETE FROM user_items WHERE is_premium_loan = 1 AND user_id IN ({ph})', part)
+    return user_ids
+
+
+def _expire_items(c, now_iso):
+    c.execute(
+        '''DELETE FROM user_items
+           WHERE expires_at IS NOT NULL AND expires_at < ?
+           RETURNING user_id, item_id''',
+        (now_iso,)
+    )
+    expired = [(r['user_id'], r['item_id']) for r in c.fetchall()]
+    if not expired:
+        return []
+
+    items = {}
+    item_ids = sorted({item_id for _, item_id in expired})
+    for part in _chunks(item_ids):
+        c.execute(f'SELECT id, type, name FROM shop_items WHERE id IN ({",".join("?" * len(part))})',
+                  part)
+        items.update({r['id']: (r['type'], r['name']) for r in c.fetchall()})
+
+    by_col = {}
+    for user_id, item_id in expired:
+        col = _PROFILE_COLS.get(items.get(item_id, (None,))[0])
+        if col:
+            by_col.setdefault(col, []).append((user_id, item_id))
+    for col, pairs in by_col.items():
+        c.executemany(f'UPDATE user_profile SET {col} = NULL WHERE user_id = ? AND {col} = ?', pairs)
+
+    c.executemany(
+        'INSERT INTO site_notifications (user_id, type, title, body, url) VALUES (?,?,?,?,?)',
+        [(user_id, 'item_expired', f'Предмет истёк: {items.get(item_id, (None, "?"))[1]}',
+          'Временный предмет удалён из инвентаря', '/shop')
+         for user_id, item_id in expired]
+    )
+    return expired
+
+
+def sweep_expired(conn=None, now=None):
+    """Снять истёкшие Premium и временные предметы одной транзакцией.
+
+    Returns:
+        dict: {'premium': число пользователей, 'items': число предметов}
+    """
+    close = conn is None
+    if conn is None:
+        conn = get_db()
+    now_iso = (now or datetime.utcnow()).isoformat()
+    try:
+        c = conn.cursor()
+        users = _expire_premium(c, now_iso)
+        items = _expire_items(c, now_iso)
+        conn.commit()
+    finally:
+        if close:
+            conn.close()
+    if users:
+        logger.info(f"⏰ Premium истёк у {len(users)} пользователей")
+    if items:
+        logger.info(f"⏰ Удалено истёкших временных предметов: {len(items)}")
+    return {'premium': len(users), 'items': len(items)}
+
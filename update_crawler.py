@@ -0,0 +1,323 @@
+"""
+update_crawler.py — обход подписок в поисках новых глав вне ленты главной.
+
+check_new_chapters видит только ~21 позицию fetchMainPage: тайтл, выпавший
+из ленты между двумя опросами, не даёт уведомлений вовсе. Краулер проходит
+по всем манг из subscriptions и проверяет каждую через fetchMangaChapters:
+
+  - собственный бюджет запросов (токен-бакет RATE_PER_MINUTE), не зависящий
+    от опроса главной
+  - приоритет: сначала просроченные, среди них — по числу подписчиков
+  - интервал перепроверки по частоте выхода глав (по createdAt первой
+    страницы), но не реже MAX_RECHECK — это и есть верхняя граница задержки
+    уведомления при достаточном бюджете
+  - страницы глав (NUMBER DESC) читаются до первой уже известной главы
+    (водяной знак chapter_watermarks), обычно это один запрос
+  - status() — задержка обнаружения (createdAt → уведомление) и отставание
+    очереди от расписания, для админки
+
+Состояние расписания хранится в crawl_state, водяные знаки — общие с
+check_new_chapters.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+# Бюджет запросов к API на краулер
+RATE_PER_MINUTE = 20
+# Границы интервала перепроверки одного тайтла (секунды)
+MIN_RECHECK = 15 * 60
+MAX_RECHECK = 6 * 60 * 60
+# Проверяем примерно через такую долю среднего интервала между главами
+CADENCE_FRACTION = 0.1
+# Начиная с этого числа подписчиков интервал делится пополам
+HOT_SUBSCRIBERS = 10
+# Максимум страниц глав за одну проверку (страховка от исчезнувшего водяного знака)
+MAX_PAGES = 3
+# Сколько пропущенных глав одного тайтла уведомлять за раз
+MAX_NOTIFY_PER_MANGA = 5
+
+_SAMPLES = 500
+
+
+class _TokenBucket:
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = float(rate_per_minute)
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+_bucket = _TokenBucket(RATE_PER_MINUTE)
+_lock = threading.Lock()
+_metrics = {
+    'runs': 0,
+    'checked': 0,
+    'api_calls': 0,
+    'new_chapters': 0,
+    'last_due': 0,
+    'last_run': None,
+}
+# Задержка обнаружения: от createdAt главы до уведомления (секунды)
+_detect_latency = deque(maxlen=_SAMPLES)
+# Отставание проверки от запланированного next_check_at (секунды)
+_schedule_lag = deque(maxlen=_SAMPLES)
+
+
+def _parse_ts(value):
+    """ISO-строка API/БД или datetime → naive UTC datetime (None, если не разобрать)."""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if dt.tzinfo:
+        dt = (dt - dt.utcoffset()).replace(tzinfo=None)
+    return dt
+
+
+def number(value):
+    """Номер главы числом (None, если не число) — по нему сравнивают оба детектора."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _recheck_interval(nodes, subscribers, now):
+    """Интервал до следующей проверки по частоте выхода глав на первой странице."""
+    dates = sorted(d for d in (_parse_ts(n.get('createdAt')) for n in nodes) if d)
+    if len(dates) < 2 or (now - dates[-1]).days > 90:
+        # Мало данных или тайтл давно не выходит
+        return MAX_RECHECK
+    cadence = (dates[-1] - dates[0]).total_seconds() / (len(dates) - 1)
+    interval = cadence * CADENCE_FRACTION
+    if subscribers >= HOT_SUBSCRIBERS:
+        interval /= 2
+    return int(min(max(interval, MIN_RECHECK), MAX_RECHECK))
+
+
+def _due(conn, now, limit):
+    """Тайтлы из подписок, которые пора проверить, в порядке приоритета."""
+    return conn.execute(
+        '''SELECT m.manga_id, m.manga_slug, m.manga_title, m.cover_url, m.branch_id,
+                  s.subs, cs.next_check_at, w.chapter_id AS wm_id, w.chapter_number AS wm_number
+           FROM (SELECT manga_id, COUNT(*) AS subs FROM subscriptions GROUP BY manga_id) s
+           JOIN manga m ON m.manga_id = s.manga_id
+           LEFT JOIN crawl_state cs ON cs.manga_id = s.manga_id
+           LEFT JOIN chapter_watermarks w ON w.manga_id = s.manga_id
+           WHERE cs.next_check_at IS NULL OR cs.next_check_at <= ?
+           ORDER BY CASE WHEN cs.next_check_at IS NULL THEN 0 ELSE 1 END, s.subs DESC,
+                    cs.next_check_at
+           LIMIT ?''',
+        (now.isoformat(), limit)
+    ).fetchall()
+
+
+def _fetch_new(api, row):
+    """Главы новее водяного знака (от новой к старой) и первая страница для оценки частоты.
+
+    None — бюджет кончился или API не ответил; тайтл останется в очереди.
+    """
+    branch_id = row['branch_id']
+    if not branch_id:
+        if not _bucket.take():
+            return None
+        _metrics['api_calls'] += 1
+        details = api.fetch_manga(row['manga_slug'])
+        if not details:
+            return None
+        branch_id = details['branch_id']
+        conn = get_db()
+        try:
+            conn.execute('UPDATE manga SET branch_id = ? WHERE manga_id = ?',
+                         (branch_id, row['manga_id']))
+            conn.commit()
+        finally:
+            conn.close()
+
+    wm_id, wm_number = row['wm_id'], number(row['wm_number'])
+    new, first_page, after = [], None, None
+    for _ in range(MAX_PAGES):
+        if not _bucket.take():
+            return None if first_page is None else (new, first_page)
+        _metrics['api_calls'] += 1
+        page = api.fetch_manga_chapters_page(branch_id, after)
+        if not page:
+            return None if first_page is None else (new, first_page)
+        nodes = [e['node'] for e in page.get('edges', []) if e.get('node')]
+        if first_page is None:
+            first_page = nodes
+            if wm_id is None:
+                # Тайтл ещё не отслеживается — водяным знаком станет последняя глава
+                return nodes[:1], first_page
+        for node in nodes:
+            num = number(node.get('number'))
+            # Водяной знак или глава с номером не выше — дальше всё уже известно
+            if node.get('id') == wm_id or \
+                    (wm_number is not None and num is not None and num <= wm_number):
+                return new, first_page
+            new.append(node)
+        page_info = page.get('pageInfo') or {}
+        if not page_info.get('hasNextPage'):
+            break
+        after = page_info.get('endCursor')
+    return new, first_page
+
+
+def claim(conn, manga_id, old_id, node):
+    """Передвинуть водяной знак old_id → node, только если его не сдвинул параллельный
+    обход (этот же crawler или check_new_chapters), и только вперёд по номеру главы:
+    свежая по времени глава с меньшим номером (другая ветка, перезалив) знак не
+    откатывает. True — уведомлять нам."""
+    raw = node.get('number')
+    values = (node.get('id'), str(raw) if raw is not None else None,
+              datetime.utcnow().isoformat())
+    new_number = number(raw)
+    if old_id is None:
+        cur = conn.execute(
+            '''INSERT INTO chapter_watermarks (manga_id, chapter_id, chapter_number, updated_at)
+               VALUES (?, ?, ?, ?) ON CONFLICT(manga_id) DO NOTHING''',
+            (manga_id,) + values
+        )
+    else:
+        forward, params = '', values + (manga_id, old_id)
+        if new_number is not None:
+            forward = ' AND (chapter_number IS NULL OR CAST(chapter_number AS REAL) < ?)'
+            params += (new_number,)
+        cur = conn.execute(
+            '''UPDATE chapter_watermarks SET chapter_id = ?, chapter_number = ?, updated_at = ?
+               WHERE manga_id = ? AND chapter_id = ?''' + forward,
+            params
+        )
+    conn.commit()
+    return cur.rowcount > 0
+
+
+def _reschedule(conn, manga_id, interval, now):
+    conn.execute(
+        '''INSERT INTO crawl_state (manga_id, next_check_at, last_checked_at, interval_seconds)
+           VALUES (?, ?, ?, ?)
+           ON CONFLICT(manga_id) DO UPDATE
+           SET next_check_at = excluded.next_check_at,
+               last_checked_at = excluded.last_checked_at,
+               interval_seconds = excluded.interval_seconds''',
+        (manga_id, (now + timedelta(seconds=interval)).isoformat(), now.isoformat(), interval)
+    )
+    conn.commit()
+
+
+def crawl(api, notify):
+    """Один проход по просроченным тайтлам из подписок в пределах бюджета.
+
+    Args:
+        api: SenkuroAPI
+        notify: process_new_chapter(manga_title, manga_slug, manga_id, chapter, cover_url)
+
+    Returns:
+        int: число уведомлённых новых глав
+    """
+    if not _lock.acquire(blocking=False):
+        return 0
+    try:
+        now = datetime.utcnow()
+        conn = get_db()
+        try:
+            due = _due(conn, now, RATE_PER_MINUTE)
+        finally:
+            conn.close()
+        _metrics['runs'] += 1
+        _metrics['last_due'] = len(due)
+        _metrics['last_run'] = now.isoformat(timespec='seconds')
+
+        notified = 0
+        for row in due:
+            result = _fetch_new(api, row)
+            if result is None:
+                break
+            new, first_page = result
+            checked_at = datetime.utcnow()
+            planned = _parse_ts(row['next_check_at'])
+            if planned:
+                _schedule_lag.append(max((checked_at - planned).total_seconds(), 0))
+            _metrics['checked'] += 1
+
+            conn = get_db()
+            try:
+                if new and claim(conn, row['manga_id'], row['wm_id'], new[0]):
+                    # Без водяного знака тайтл только регистрируется
+                    missed = list(reversed(new[:MAX_NOTIFY_PER_MANGA])) if row['wm_id'] else []
+                    for node in missed:
+                        logger.info(f"🆕 Краулер: {row['manga_title']} - Глава {node.get('number')}")
+                        notify(row['manga_title'], row['manga_slug'], row['manga_id'],
+                               node, row['cover_url'])
+                        created = _parse_ts(node.get('createdAt'))
+                        if created:
+                            _detect_latency.append(
+                                max((datetime.utcnow() - created).total_seconds(), 0))
+                    notified += len(missed)
+                _reschedule(conn, row['manga_id'],
+                            _recheck_interval(first_page, row['subs'], checked_at), checked_at)
+            finally:
+                conn.close()
+
+        _metrics['new_chapters'] += notified
+        if notified:
+            logger.info(f"✅ Краулер подписок: {notified} новых глав")
+        return notified
+    finally:
+        _lock.release()
+
+
+def _percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(int(len(ordered) * q), len(ordered) - 1)], 1)
+
+
+def status():
+    """Метрики краулера для админки."""
+    conn = get_db()
+    try:
+        now = datetime.utcnow().isoformat()
+        row = conn.execute(
+            '''SELECT COUNT(*) AS total,
+                      SUM(CASE WHEN cs.next_check_at IS NULL OR cs.next_check_at <= ? THEN 1 ELSE 0 END)
+                          AS overdue
+               FROM (SELECT DISTINCT manga_id FROM subscriptions) s
+               LEFT JOIN crawl_state cs ON cs.manga_id = s.manga_id''',
+            (now,)
+        ).fetchone()
+    finally:
+        conn.close()
+    latency, lag = list(_detect_latency), list(_schedule_lag)
+    return dict(
+        _metrics,
+        tracked=row['total'] or 0,
+        overdue=row['overdue'] or 0,
+        max_recheck=MAX_RECHECK,
+        detect_latency_p50=_percentile(latency, 0.5),
+        detect_latency_p95=_percentile(latency, 0.95),
+        schedule_lag_p95=_percentile(lag, 0.95),
+        schedule_lag_max=round(max(lag), 1) if lag else None,
+    )
@@ -0,0 +1,82 @@
+"""
+xp_ledger.py — журнал начислений XP (xp_log) и его компакция.
+
+xp_log пополняется каждым путём награды и раньше рос бесконечно. Детальные
+строки нужны только недавно: антиспам смотрит на последний час, недельная
+таблица лидеров — на текущую неделю. Поэтому журнал разбит по времени:
+
+  - xp_log        — детальные строки за последние RETENTION_DAYS дней;
+                    антиспам-проверка покрыта индексом idx_xp_log_dedup
+  - xp_log_daily  — дневные агрегаты (user_id, day, reason) → amount, entries
+                    для всего, что старше
+
+compact() переносит старые дни из xp_log в xp_log_daily: по одному дню
+за транзакцию, чтобы не держать длинных блокировок.
+"""
+
+import logging
+from datetime import date, datetime, timedelta
+
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+# Сколько дней детальные строки живут в xp_log
+RETENTION_DAYS = 30
+# Максимум дней за один запуск compact() — догоняем историю порциями
+MAX_DAYS_PER_RUN = 60
+
+_DEDUP_SQL = '''SELECT 1 FROM xp_log
+                WHERE user_id = ? AND ref_id = ? AND reason = ?
+                  AND created_at > datetime('now', '-1 hour')
+                LIMIT 1'''
+
+
+def is_duplicate(conn, user_id, reason, ref_id):
+    """Было ли уже такое начисление за последний час (только по индексу)."""
+    return conn.execute(_DEDUP_SQL, (user_id, str(ref_id), reason)).fetchone() is not None
+
+
+def compact(conn=None, retention_days=RETENTION_DAYS, max_days=MAX_DAYS_PER_RUN):
+    """Свернуть строки xp_log старше retention_days в дневные агрегаты.
+
+    Returns:
+        int: сколько строк xp_log перенесено
+    """
+    close = conn is None
+    if conn is None:
+        conn = get_db()
+    try:
+        cutoff = (date.today() - timedelta(days=retention_days)).isoformat()
+        moved = 0
+        for _ in range(max_days):
+            # Следующий самый старый день — пропуски в истории не обходим по дням
+            row = conn.execute(
+                'SELECT MIN(created_at) AS first FROM xp_log WHERE created_at < ?', (cutoff,)
+            ).fetchone()
+            if not row or not row['first']:
+                break
+            day = datetime.fromisoformat(str(row['first'])[:10]).date()
+            start, end = day.isoformat(), (day + timedelta(days=1)).isoformat()
+            conn.execute(
+                '''INSERT INTO xp_log_daily (user_id, day, reason, amount, entries)
+                   SELECT user_id, ?, reason, SUM(amount), COUNT(*)
+                   FROM xp_log
+                   WHERE created_at >= ? AND created_at < ?
+                   GROUP BY user_id, reason
+                   ON CONFLICT(user_id, day, reason) DO UPDATE
+                   SET amount = xp_log_daily.amount + excluded.amount,
+                       entries = xp_log_daily.entries + excluded.entries''',
+                (start, start, end)
+            )
+            cur = conn.execute('DELETE FROM xp_log WHERE created_at >= ? AND created_at < ?',
+                               (start, end))
+            conn.commit()
+            moved += max(cur.rowcount, 0)
+
+        if moved:
+            logger.info(f"xp_ledger.compact: {moved} строк xp_log свёрнуто в дневные агрегаты")
+        return moved
+    finally:
+        if close:
+            conn.close()